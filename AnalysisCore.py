@@ -0,0 +1,1969 @@
+# -----------------------------------------------------------------------------
+# Image Analyzer - analysis core
+#
+# Tk-independent part of the Image Analyzer: measurement geometry, filters,
+# intensity profiles, overlay rendering/export, analysis file (de)serialization
+# and the headless batch jobs. Plain data in, plain data out, so it can be used
+# from batch jobs, services and tests without a display. ImageAnalyzer.py (the
+# GUI) calls into this module.
+# -----------------------------------------------------------------------------
+import os
+import math
+import json
+import datetime
+import importlib
+import threading
+import time
+import html
+import csv
+import glob
+import zlib
+import functools
+from collections import deque
+from contextlib import contextmanager
+from PIL import Image, ImageDraw
+
+
+# --- Startup Profiling & Lazy Imports ---
+class StartupProfile:
+    """Collects startup phase timings (relative to process start); printed with --profile-startup."""
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.perf_counter() # The GUI entry point resets this to its own process start
+        self.phases = [] # (name, start_s, end_s, thread name)
+        self._lock = threading.Lock()
+
+    def record(self, name, start, end):
+        """Records a phase given perf_counter() start/end times."""
+        if self.enabled:
+            with self._lock:
+                self.phases.append((name, start - self.origin, end - self.origin, threading.current_thread().name))
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def mark(self, name):
+        """Records an instant (e.g. 'window interactive')."""
+        now = time.perf_counter()
+        self.record(name, now, now)
+
+    def report(self):
+        with self._lock:
+            phases = sorted(self.phases, key=lambda p: p[1])
+        print("--- Startup profile (ms since process start) ---")
+        print(f"{'phase':<34}{'start':>9}{'end':>9}{'took':>9}  thread")
+        for name, start, end, thread_name in phases:
+            took = f"{(end - start) * 1000:9.1f}" if end > start else f"{'':>9}"
+            print(f"{name:<34}{start * 1000:9.1f}{end * 1000:9.1f}{took}  {thread_name}")
+
+
+STARTUP_PROFILE = StartupProfile()
+
+
+class LazyModule:
+    """Stands in for a heavy module and imports it on first attribute access.
+
+    cv2 and numpy take several hundred ms to import on lab machines; deferring them lets the
+    window appear first. After loading, the name in `namespace` (default: this module) is rebound
+    to the real module, so later accesses cost nothing. Optional modules evaluate as False when
+    not installed.
+    """
+    def __init__(self, name, alias, namespace=None, optional=False):
+        self._name = name
+        self._alias = alias
+        self._namespace = namespace if namespace is not None else globals()
+        self._optional = optional
+        self._module = None
+        self._missing = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None and not self._missing:
+                with STARTUP_PROFILE.phase(f"import {self._name} (lazy)"):
+                    try:
+                        self._module = importlib.import_module(self._name)
+                    except ImportError:
+                        if not self._optional:
+                            raise
+                        self._missing = True
+                if self._module is not None:
+                    self._namespace[self._alias] = self._module
+        return self._module
+
+    def __getattr__(self, attr):
+        module = self._load()
+        if module is None:
+            raise AttributeError(f"Optional module '{self._name}' is not installed")
+        return getattr(module, attr)
+
+    def __bool__(self):
+        return self._load() is not None
+
+
+cv2 = LazyModule("cv2", "cv2")
+np = LazyModule("numpy", "np")
+tifffile = LazyModule("tifffile", "tifffile", optional=True) # Optional: only for the tiled TIFF/BigTIFF export
+
+
+def preload_heavy_modules():
+    """Imports the lazily loaded modules in the background so the first filter does not wait for them."""
+    def load():
+        for module in (np, cv2):
+            if isinstance(module, LazyModule):
+                module._load()
+    thread = threading.Thread(target=load, name="module-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff')
+
+
+# --- Filters (shared by the GUI and the batch CLI) ---
+def to_gray_array(img):
+    """Converts a PIL image to the uint8 grayscale array all filters run on."""
+    img_np_rgb = np.array(img.convert("RGB"))
+    return cv2.cvtColor(img_np_rgb, cv2.COLOR_RGB2GRAY)
+
+
+def canny_edges(gray, low, high, roi=None):
+    """Runs Canny on the whole gray array or on roi = (x1, y1, x2, y2) in image coords."""
+    if roi:
+        x1, y1, x2, y2 = roi
+        gray = gray[y1:y2, x1:x2]
+    return cv2.Canny(gray, low, high)
+
+
+def render_canny_result(img_rgba, edges_np, roi=None):
+    """Builds the displayed filter result: edges as the image (global) or green edges pasted into the ROI."""
+    if not roi:
+        return Image.fromarray(edges_np).convert("RGBA")
+    processed_image = img_rgba.copy()
+    if processed_image.mode != 'RGBA':
+        processed_image = processed_image.convert('RGBA')
+    mask = Image.fromarray(edges_np).convert("L")
+    colored_edges = Image.new("RGBA", mask.size, (0, 255, 0, 255)) # Green edges
+    processed_image.paste(colored_edges, (roi[0], roi[1]), mask=mask)
+    return processed_image
+
+
+def clamp_roi(roi, width, height):
+    """Clamps an (x1, y1, x2, y2) ROI to the image, returning None if nothing is left."""
+    x1, x2 = sorted((int(roi[0]), int(roi[2])))
+    y1, y2 = sorted((int(roi[1]), int(roi[3])))
+    x1, y1 = max(0, x1), max(0, y1)
+    x2, y2 = min(width, x2), min(height, y2)
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return (x1, y1, x2, y2)
+
+
+# --- Filter Pipeline ---
+def _stage_gaussian_blur(gray, sigma=1.5):
+    return cv2.GaussianBlur(gray, (0, 0), sigma)
+
+
+def _stage_clahe(gray, clip_limit=2.0, tile_grid=8):
+    return cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(tile_grid, tile_grid)).apply(gray)
+
+
+def _stage_threshold(gray, method="otsu", value=128, block_size=31):
+    """Binary threshold: 'otsu', 'fixed' (at value) or 'adaptive' (Gaussian, block_size window, offset value - 128)."""
+    if method == "adaptive":
+        return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                     block_size | 1, value - 128)
+    if method == "otsu":
+        return cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+    if method == "fixed":
+        return cv2.threshold(gray, value, 255, cv2.THRESH_BINARY)[1]
+    raise ValueError(f"Unknown threshold method '{method}' (otsu, fixed or adaptive).")
+
+
+_MORPHOLOGY_OPS = {"erode": "MORPH_ERODE", "dilate": "MORPH_DILATE", "open": "MORPH_OPEN",
+                   "close": "MORPH_CLOSE", "gradient": "MORPH_GRADIENT", "tophat": "MORPH_TOPHAT", "blackhat": "MORPH_BLACKHAT"}
+
+
+def _stage_morphology(gray, operation="open", kernel=3, iterations=1):
+    if operation not in _MORPHOLOGY_OPS:
+        raise ValueError(f"Unknown morphology operation '{operation}' ({', '.join(_MORPHOLOGY_OPS)}).")
+    element = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel, kernel))
+    return cv2.morphologyEx(gray, getattr(cv2, _MORPHOLOGY_OPS[operation]), element, iterations=iterations)
+
+
+def _stage_unsharp_mask(gray, sigma=2.0, amount=1.0):
+    blurred = cv2.GaussianBlur(gray, (0, 0), sigma)
+    return cv2.addWeighted(gray, 1.0 + amount, blurred, -amount, 0)
+
+
+# Stage name -> (function of (gray uint8, **params) -> gray uint8, default params)
+FILTER_STAGES = {
+    "gaussian_blur": (_stage_gaussian_blur, {"sigma": 1.5}),
+    "clahe": (_stage_clahe, {"clip_limit": 2.0, "tile_grid": 8}),
+    "threshold": (_stage_threshold, {"method": "otsu", "value": 128, "block_size": 31}),
+    "morphology": (_stage_morphology, {"operation": "open", "kernel": 3, "iterations": 1}),
+    "unsharp_mask": (_stage_unsharp_mask, {"sigma": 2.0, "amount": 1.0}),
+}
+
+
+def normalize_stage_params(name, params=None):
+    """Defaults merged with params, each cast to its default's type. Raises ValueError for bad names/values."""
+    if name not in FILTER_STAGES:
+        raise ValueError(f"Unknown filter stage '{name}' ({', '.join(FILTER_STAGES)}).")
+    defaults = FILTER_STAGES[name][1]
+    params = dict(params or {})
+    unknown = set(params) - set(defaults)
+    if unknown:
+        raise ValueError(f"Unknown parameter(s) for {name}: {', '.join(sorted(unknown))}.")
+    normalized = {}
+    for key, default in defaults.items():
+        value = params.get(key, default)
+        try:
+            normalized[key] = type(default)(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name}.{key} must be a {type(default).__name__}, got {value!r}.")
+    if name in ("gaussian_blur", "unsharp_mask") and normalized["sigma"] <= 0:
+        raise ValueError(f"{name}.sigma must be positive.")
+    if name == "morphology" and (normalized["kernel"] < 1 or normalized["iterations"] < 1):
+        raise ValueError("morphology.kernel and morphology.iterations must be at least 1.")
+    if name == "morphology" and normalized["operation"] not in _MORPHOLOGY_OPS:
+        raise ValueError(f"Unknown morphology operation '{normalized['operation']}' ({', '.join(_MORPHOLOGY_OPS)}).")
+    if name == "threshold" and normalized["method"] not in ("otsu", "fixed", "adaptive"):
+        raise ValueError(f"Unknown threshold method '{normalized['method']}' (otsu, fixed or adaptive).")
+    if name == "threshold" and normalized["method"] == "fixed" and not 0 <= normalized["value"] <= 255:
+        raise ValueError("threshold.value must be between 0 and 255.")
+    if name == "threshold" and normalized["method"] == "adaptive":
+        # value is the offset + 128, so 0..255 keeps the offset within -128..127 gray levels
+        if normalized["block_size"] < 3:
+            raise ValueError("threshold.block_size must be at least 3 for the adaptive method.")
+        if not 0 <= normalized["value"] <= 255:
+            raise ValueError("threshold.value (adaptive offset + 128) must be between 0 and 255.")
+    if name == "clahe" and (normalized["clip_limit"] <= 0 or normalized["tile_grid"] < 1):
+        raise ValueError("clahe.clip_limit must be positive and clahe.tile_grid at least 1.")
+    return normalized
+
+
+class FilterPipeline:
+    """Ordered preprocessing stages applied to the gray array before edge detection.
+
+    Each stage caches its last output under a key built from its name, its parameters and the
+    key of its input, so changing a stage recomputes only that stage and the ones after it.
+    Stages are plain dicts {"name", "params", "enabled"}; to_json()/from_json() round-trip them
+    through the analysis file.
+    """
+    def __init__(self, stages=None):
+        self.stages = []
+        self._cache = {} # Chain key -> output of the last run
+        self.last_recomputed = 0 # Stages actually computed by the last run()
+        for stage in stages or []:
+            self.add(stage["name"], stage.get("params"), stage.get("enabled", True))
+
+    def add(self, name, params=None, enabled=True, index=None):
+        stage = {"name": name, "params": normalize_stage_params(name, params), "enabled": bool(enabled)}
+        self.stages.insert(len(self.stages) if index is None else index, stage)
+        return stage
+
+    def remove(self, index):
+        del self.stages[index]
+
+    def move(self, index, offset):
+        """Moves a stage up (offset < 0) or down; returns its new index."""
+        new_index = max(0, min(len(self.stages) - 1, index + offset))
+        self.stages.insert(new_index, self.stages.pop(index))
+        return new_index
+
+    def update(self, index, params=None, enabled=None):
+        stage = self.stages[index]
+        if params is not None:
+            stage["params"] = normalize_stage_params(stage["name"], {**stage["params"], **params})
+        if enabled is not None:
+            stage["enabled"] = bool(enabled)
+
+    def signature(self):
+        """Hashable description of what run() computes (enabled stages and their parameters)."""
+        return tuple((stage["name"], tuple(sorted(stage["params"].items())))
+                     for stage in self.stages if stage["enabled"])
+
+    def __bool__(self):
+        return any(stage["enabled"] for stage in self.stages)
+
+    def run(self, gray, source_key):
+        """Returns gray after all enabled stages. source_key identifies the input (e.g. image path)."""
+        key = source_key
+        output = gray
+        cache = {}
+        self.last_recomputed = 0
+        for name, params in self.signature():
+            key = (key, name, params)
+            cached = self._cache.get(key)
+            if cached is None:
+                with TRACE.span(f"filter {name}", "filter"):
+                    cached = FILTER_STAGES[name][0](output, **dict(params))
+                self.last_recomputed += 1
+            cache[key] = output = cached
+        self._cache = cache # Only the current chain is kept
+        return output
+
+    def clear_cache(self):
+        self._cache = {}
+
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self._cache.values())
+
+    @staticmethod
+    def describe(stage):
+        params = ", ".join(f"{key}={value}" for key, value in stage["params"].items())
+        return f"{stage['name']}({params})" + ("" if stage["enabled"] else " [off]")
+
+    def to_json(self):
+        return [{"name": stage["name"], "params": dict(stage["params"]), "enabled": stage["enabled"]}
+                for stage in self.stages]
+
+    @classmethod
+    def from_json(cls, data):
+        """Builds a pipeline from to_json() output. Raises ValueError if it is malformed."""
+        if not isinstance(data, list):
+            raise ValueError("'filter_pipeline' must be a list of stages.")
+        for i, stage in enumerate(data):
+            if not isinstance(stage, dict) or not isinstance(stage.get("name"), str):
+                raise ValueError(f"Filter stage {i + 1} has no 'name'.")
+            if not isinstance(stage.get("params", {}), dict):
+                raise ValueError(f"Filter stage {i + 1} ({stage['name']}) has invalid 'params'.")
+        return cls(data)
+
+
+def run_filter_pipeline(gray, stages):
+    """One-off run of a pipeline given as to_json() data (no caching needed)."""
+    return FilterPipeline.from_json(stages).run(gray, None)
+
+
+def load_filter_pipeline(path):
+    """Reads pipeline stages from a saved analysis (its filters.filter_pipeline) or a plain JSON list."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = (data.get("filters") or {}).get("filter_pipeline", [])
+    return FilterPipeline.from_json(data).to_json()
+
+
+# --- Automatic Canny Thresholds ---
+AUTO_CANNY_METHODS = ("median", "otsu")
+GRADIENT_BINS = 2041 # L1 Sobel magnitude |dx| + |dy| as Canny computes it: 0..2040
+
+
+def threshold_histograms(gray, roi=None):
+    """Intensity (256 bins) and L1 gradient magnitude (GRADIENT_BINS) histograms of gray or its ROI.
+
+    They are all the automatic threshold methods need, so callers cache them per image/ROI and
+    every later suggestion costs microseconds.
+    """
+    if roi:
+        x1, y1, x2, y2 = roi
+        gray = gray[y1:y2, x1:x2]
+    intensity = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    dx = cv2.Sobel(gray, cv2.CV_16S, 1, 0, ksize=3)
+    dy = cv2.Sobel(gray, cv2.CV_16S, 0, 1, ksize=3)
+    magnitude = (np.abs(dx) + np.abs(dy)).view(np.uint16) # Non-negative and <= 2040, so the view is exact
+    gradient = cv2.calcHist([magnitude], [0], None, [GRADIENT_BINS], [0, GRADIENT_BINS]).ravel()
+    return {"intensity": intensity, "gradient": gradient}
+
+
+def _histogram_median(hist):
+    cumulative = np.cumsum(hist)
+    return int(np.searchsorted(cumulative, cumulative[-1] / 2.0))
+
+
+def _histogram_otsu(hist):
+    """Otsu threshold of a histogram: the bin maximizing the between-class variance."""
+    bins = np.arange(len(hist), dtype=np.float64)
+    weight_low = np.cumsum(hist)
+    weight_high = weight_low[-1] - weight_low
+    mass_low = np.cumsum(hist * bins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_low = mass_low / weight_low
+        mean_high = (mass_low[-1] - mass_low) / weight_high
+        between = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return int(np.nanargmax(between)) if np.isfinite(between).any() else 0
+
+
+def auto_canny_thresholds(histograms, method="median", sigma=0.33, max_value=255):
+    """Suggests (low, high) Canny thresholds from threshold_histograms() output.
+
+    'median': low/high = (1 -/+ sigma) * median intensity, the usual zero-parameter Canny.
+    'otsu': high = Otsu threshold of the gradient magnitude histogram (edge vs. background
+    gradients), low = high / 2. Both are clamped to [0, max_value] (the GUI slider range).
+    """
+    if method == "median":
+        median = _histogram_median(histograms["intensity"])
+        low, high = (1.0 - sigma) * median, (1.0 + sigma) * median
+    elif method == "otsu":
+        high = _histogram_otsu(histograms["gradient"])
+        low = high / 2.0
+    else:
+        raise ValueError(f"Unknown threshold method '{method}' ({', '.join(AUTO_CANNY_METHODS)}).")
+    low = int(max(0, min(max_value, round(low))))
+    high = int(max(low + 1, min(max_value, round(high))))
+    return min(low, max_value - 1), min(high, max_value)
+
+
+# --- ROI Intensity Statistics ---
+POINT_STATS_RADIUS = 5 # Stats around a measured point cover an 11x11 px window
+
+
+class IntensityIntegrals:
+    """Summed-area tables of a gray image: mean and std of any rectangle in constant time.
+
+    Built once per image with cv2.integral2 (float64 sums are exact for 8-bit images up to
+    ~100 GP). Min and max are not decomposable into prefix sums, so region_extrema() scans
+    the region instead; callers use it when a selection is final, not while dragging.
+    """
+
+    def __init__(self, gray):
+        self.sum, self.sqsum = cv2.integral2(gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        self.height, self.width = gray.shape[:2]
+
+    @property
+    def nbytes(self):
+        return self.sum.nbytes + self.sqsum.nbytes
+
+    def _clamp(self, box):
+        x1, y1, x2, y2 = (int(round(v)) for v in box)
+        x1, x2 = sorted((max(0, min(self.width, x1)), max(0, min(self.width, x2))))
+        y1, y2 = sorted((max(0, min(self.height, y1)), max(0, min(self.height, y2))))
+        return x1, y1, x2, y2
+
+    def stats(self, box):
+        """{"box", "pixels", "mean", "std"} of box = (x1, y1, x2, y2) (exclusive end), or None if empty."""
+        x1, y1, x2, y2 = self._clamp(box)
+        pixels = (x2 - x1) * (y2 - y1)
+        if pixels == 0:
+            return None
+        total = self.sum[y2, x2] - self.sum[y1, x2] - self.sum[y2, x1] + self.sum[y1, x1]
+        squares = self.sqsum[y2, x2] - self.sqsum[y1, x2] - self.sqsum[y2, x1] + self.sqsum[y1, x1]
+        mean = total / pixels
+        variance = max(0.0, squares / pixels - mean * mean) # Clip float rounding below zero
+        return {"box": [x1, y1, x2, y2], "pixels": pixels, "mean": round(float(mean), 3),
+                "std": round(math.sqrt(variance), 3)}
+
+    def point_stats(self, point, radius=POINT_STATS_RADIUS):
+        x, y = int(math.floor(point[0])), int(math.floor(point[1]))
+        return self.stats((x - radius, y - radius, x + radius + 1, y + radius + 1))
+
+
+def region_extrema(gray, box):
+    """(min, max) of gray in box. Integral tables cannot answer this, so it is a linear scan (cv2.minMaxLoc)."""
+    x1, y1, x2, y2 = box
+    region = gray[y1:y2, x1:x2]
+    if region.size == 0:
+        return None, None
+    low, high, _, _ = cv2.minMaxLoc(region)
+    return int(low), int(high)
+
+
+def measurement_intensity_stats(integrals, measurements, radius=POINT_STATS_RADIUS):
+    """Window stats around every point of every measurement, for the analysis JSON."""
+    return {
+        "point_window_px": 2 * radius + 1,
+        "measurements": [
+            {"type": meas.get("type"),
+             "points": [dict(integrals.point_stats(p, radius) or {}, point=[round(p[0], 1), round(p[1], 1)])
+                        for p in meas.get("points", [])]}
+            for meas in measurements
+        ],
+    }
+
+
+# --- Canny Parameter Sweep ---
+SWEEP_MAX_PIXELS = 1e6 # Larger sources are downsampled before sweeping
+SWEEP_THUMB_SIZE = 200 # Longest side of one contact sheet tile
+SWEEP_LABEL_HEIGHT = 16
+
+
+def sweep_source(gray, roi=None, max_pixels=SWEEP_MAX_PIXELS):
+    """Gray region to sweep (the ROI, or the whole image) downsampled to at most max_pixels.
+
+    Returns (region, scale) with scale = region pixels per image pixel (<= 1).
+    """
+    if roi:
+        x1, y1, x2, y2 = roi
+        gray = gray[y1:y2, x1:x2]
+    height, width = gray.shape
+    scale = min(1.0, math.sqrt(max_pixels / max(width * height, 1)))
+    if scale < 1.0:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+
+def sweep_gradients(gray, blur=0):
+    """Sobel dx/dy (CV_16S, as cv2.Canny computes them) of gray after an optional Gaussian blur (sigma)."""
+    if blur > 0:
+        gray = cv2.GaussianBlur(gray, (0, 0), blur)
+    dx = cv2.Sobel(gray, cv2.CV_16S, 1, 0, ksize=3, borderType=cv2.BORDER_REPLICATE)
+    dy = cv2.Sobel(gray, cv2.CV_16S, 0, 1, ksize=3, borderType=cv2.BORDER_REPLICATE)
+    return dx, dy
+
+
+def canny_sweep(gray, lows, highs, blurs=(0,), workers=None, cancelled=None):
+    """Edge maps for every (blur, low, high) combination with low < high.
+
+    Gradients are computed once per blur value and shared by all threshold pairs, since
+    cv2.Canny(dx, dy, low, high) only redoes suppression and hysteresis (bit-identical to
+    cv2.Canny(gray, low, high) on the blurred image). The pairs run on a thread pool.
+    Returns a list of {"blur", "low", "high", "edges", "edge_density"} in grid order, or
+    None if cancelled() turns true.
+    """
+    from concurrent.futures import ThreadPoolExecutor # cv2 releases the GIL, so threads scale
+    combos = [(blur, low, high) for blur in blurs for low in lows for high in highs if low < high]
+    gradients = {}
+
+    def run(combo):
+        if cancelled and cancelled():
+            return None
+        blur, low, high = combo
+        dx, dy = gradients[blur]
+        edges = cv2.Canny(dx, dy, low, high)
+        return {"blur": blur, "low": low, "high": high, "edges": edges,
+                "edge_density": cv2.countNonZero(edges) / edges.size}
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1, thread_name_prefix="CannySweep") as pool:
+        for blur, gradient in zip(blurs, pool.map(lambda b: sweep_gradients(gray, b), blurs)):
+            gradients[blur] = gradient
+        results = list(pool.map(run, combos))
+    if cancelled and cancelled():
+        return None
+    return results
+
+
+def sweep_label(result):
+    label = f"{result['low']}/{result['high']}"
+    if result["blur"]:
+        label += f" blur {result['blur']:g}"
+    return f"{label}  {result['edge_density']:.1%}"
+
+
+def render_contact_sheet(results, columns=None, thumb_size=SWEEP_THUMB_SIZE):
+    """Tiles the sweep edge maps into one labelled RGB image.
+
+    Returns (sheet, boxes): boxes[i] = (x1, y1, x2, y2) of results[i] in the sheet, for hit tests.
+    """
+    if not results:
+        raise ValueError("Nothing to render: the sweep has no (low < high) combinations.")
+    height, width = results[0]["edges"].shape
+    scale = thumb_size / max(width, height)
+    thumb = (max(1, round(width * scale)), max(1, round(height * scale)))
+    columns = columns or math.ceil(math.sqrt(len(results)))
+    rows = math.ceil(len(results) / columns)
+    cell_w, cell_h = thumb[0] + 4, thumb[1] + SWEEP_LABEL_HEIGHT + 4
+    sheet = Image.new("RGB", (columns * cell_w, rows * cell_h), (40, 40, 40))
+    draw = ImageDraw.Draw(sheet)
+    boxes = []
+    for i, result in enumerate(results):
+        x, y = (i % columns) * cell_w + 2, (i // columns) * cell_h + 2
+        # INTER_AREA keeps thin edges visible as gray instead of dropping them
+        small = cv2.resize(result["edges"], thumb, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_NEAREST)
+        sheet.paste(Image.fromarray(small).convert("RGB"), (x, y))
+        draw.text((x + 2, y + thumb[1] + 2), sweep_label(result), fill=(255, 255, 0))
+        boxes.append((x, y, x + thumb[0], y + thumb[1] + SWEEP_LABEL_HEIGHT))
+    return sheet, boxes
+
+
+# --- Tiled Canny ---
+CANNY_TILE_SIZE = 1024
+CANNY_TILE_HALO = 8 # Sobel and non-maximum suppression each need 1 px of context; 8 leaves margin
+TILED_CANNY_MIN_PIXELS = 16e6 # Below this one cv2.Canny call is fast enough
+
+
+def canny_tiles(width, height, tile_size=CANNY_TILE_SIZE, priority_box=None):
+    """Tile boxes (x1, y1, x2, y2) covering the image, ordered by distance from the center of
+    priority_box (e.g. the visible area). Returns (tiles, n_priority): the first n_priority
+    tiles intersect priority_box."""
+    tiles = [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+             for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+    if not priority_box:
+        return tiles, 0
+    px1, py1, px2, py2 = priority_box
+    cx, cy = (px1 + px2) / 2, (py1 + py2) / 2
+
+    def rank(tile):
+        visible = tile[0] < px2 and tile[2] > px1 and tile[1] < py2 and tile[3] > py1
+        return (not visible, ((tile[0] + tile[2]) / 2 - cx) ** 2 + ((tile[1] + tile[3]) / 2 - cy) ** 2)
+    tiles.sort(key=rank)
+    n_priority = sum(1 for tile in tiles if not rank(tile)[0])
+    return tiles, n_priority
+
+
+def canny_tile_candidates(gray, box, low, high, halo=CANNY_TILE_HALO):
+    """Per-tile half of Canny: (candidates, strong) for box, both uint8 0/255.
+
+    candidates are the pixels that survive non-maximum suppression above `low`, strong the
+    ones above `high`. Both are taken from cv2.Canny with equal thresholds (no hysteresis
+    left to do), on the tile plus a halo so gradients at the tile border see real neighbours.
+    """
+    height, width = gray.shape
+    x1, y1, x2, y2 = box
+    wx1, wy1 = max(0, x1 - halo), max(0, y1 - halo)
+    wx2, wy2 = min(width, x2 + halo), min(height, y2 + halo)
+    window = gray[wy1:wy2, wx1:wx2]
+    inner = (slice(y1 - wy1, y2 - wy1), slice(x1 - wx1, x2 - wx1))
+    return cv2.Canny(window, low, low)[inner], cv2.Canny(window, high, high)[inner]
+
+
+def canny_hysteresis(candidates, strong):
+    """Global half of Canny: keeps the 8-connected candidate components that contain a strong pixel."""
+    count, labels = cv2.connectedComponents(candidates, connectivity=8, ltype=cv2.CV_32S)
+    keep = np.zeros(count, dtype=np.uint8)
+    keep[labels[strong > 0]] = 255
+    keep[0] = 0 # Background
+    return keep[labels]
+
+
+def canny_edges_tiled(gray, low, high, tile_size=CANNY_TILE_SIZE, workers=None,
+                      priority_box=None, on_priority_done=None, cancelled=None):
+    """Canny over overlapping tiles on a thread pool; bit-identical to cv2.Canny(gray, low, high).
+
+    Gradients and non-maximum suppression are local, so tiles (plus halo) are processed
+    independently; hysteresis is connectivity over the whole image and runs once on the
+    stitched candidate map. Tiles intersecting priority_box go first; on_priority_done(box, edges)
+    then gets a provisional result for their bounding box (hysteresis limited to that box).
+    Returns None if cancelled() turns true before the end.
+    """
+    from concurrent.futures import ThreadPoolExecutor # cv2 releases the GIL, so threads scale
+    low, high = min(low, high), max(low, high)
+    height, width = gray.shape
+    candidates = np.zeros((height, width), dtype=np.uint8)
+    strong = np.zeros((height, width), dtype=np.uint8)
+    tiles, n_priority = canny_tiles(width, height, tile_size, priority_box)
+
+    def process(box):
+        if cancelled and cancelled():
+            return
+        tile_candidates, tile_strong = canny_tile_candidates(gray, box, low, high)
+        candidates[box[1]:box[3], box[0]:box[2]] = tile_candidates
+        strong[box[1]:box[3], box[0]:box[2]] = tile_strong
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1, thread_name_prefix="CannyTile") as pool:
+        futures = [pool.submit(process, box) for box in tiles] # Submission order = priority order
+        for i, future in enumerate(futures):
+            future.result()
+            if cancelled and cancelled():
+                for pending in futures[i + 1:]:
+                    pending.cancel()
+                return None
+            if i + 1 == n_priority and on_priority_done:
+                done = tiles[:n_priority]
+                bx1, by1 = min(t[0] for t in done), min(t[1] for t in done)
+                bx2, by2 = max(t[2] for t in done), max(t[3] for t in done)
+                on_priority_done((bx1, by1, bx2, by2),
+                                 canny_hysteresis(candidates[by1:by2, bx1:bx2], strong[by1:by2, bx1:bx2]))
+    return canny_hysteresis(candidates, strong)
+
+
+# --- Resampling ---
+# Display presets: (backend, interpolation when shrinking, interpolation when enlarging).
+# "exact" is the original PIL LANCZOS rendering. The cv2 presets release the GIL and are
+# several times faster on large views ("cubic" through warpAffine is not, so "balanced"
+# enlarges bilinearly).
+RESAMPLING_PRESETS = {
+    "fast": ("cv2", "nearest", "nearest"),
+    "balanced": ("cv2", "area", "linear"),
+    "exact": ("pil", "lanczos", "lanczos"),
+}
+DEFAULT_RESAMPLING_PRESET = "balanced"
+
+_PIL_RESAMPLING = {
+    "nearest": Image.Resampling.NEAREST,
+    "linear": Image.Resampling.BILINEAR,
+    "cubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+    "area": Image.Resampling.BOX,
+}
+_CV2_INTERPOLATION = {"nearest": "INTER_NEAREST", "linear": "INTER_LINEAR", "cubic": "INTER_CUBIC",
+                      "lanczos": "INTER_LANCZOS4", "area": "INTER_AREA"}
+
+
+def resample_region(source, box, size, preset=DEFAULT_RESAMPLING_PRESET, method=None):
+    """Resamples box = (x0, y0, x1, y1) of `source` (float pixel coords) to size = (w, h); returns a PIL image.
+
+    `source` is a PIL image or the same pixels as a NumPy array. The cv2 backend slices arrays
+    without copying, so callers that render repeatedly should convert once and pass the array.
+    `method` overrides the preset's interpolation (e.g. "nearest" for the magnifier).
+    """
+    backend, shrink, enlarge = RESAMPLING_PRESETS[preset]
+    x0, y0, x1, y1 = box
+    scale_x = size[0] / max(x1 - x0, 1e-9)
+    scale_y = size[1] / max(y1 - y0, 1e-9)
+    if method is None:
+        method = shrink if min(scale_x, scale_y) < 1.0 else enlarge
+    if (x1 - x0, y1 - y0) == tuple(size) and float(x0).is_integer() and float(y0).is_integer():
+        # 1:1 and pixel-aligned: nothing to interpolate
+        x0, y0 = int(x0), int(y0)
+        if isinstance(source, Image.Image):
+            return source.crop((x0, y0, x0 + size[0], y0 + size[1]))
+        return Image.fromarray(source[y0:y0 + size[1], x0:x0 + size[0]])
+
+    if backend == "pil":
+        img = source if isinstance(source, Image.Image) else Image.fromarray(source)
+        return img.resize(size, _PIL_RESAMPLING[method], box=box)
+
+    # cv2: work on the whole pixels covering the box, then map the fractional remainder
+    width, height = source.size if isinstance(source, Image.Image) else (source.shape[1], source.shape[0])
+    ix0, iy0 = max(0, int(math.floor(x0))), max(0, int(math.floor(y0)))
+    ix1, iy1 = min(width, int(math.ceil(x1))), min(height, int(math.ceil(y1)))
+    if isinstance(source, Image.Image):
+        region = np.asarray(source.crop((ix0, iy0, ix1, iy1)))
+    else:
+        region = source[iy0:iy1, ix0:ix1]
+    interpolation = getattr(cv2, _CV2_INTERPOLATION[method])
+    if method == "area":
+        # INTER_AREA only exists for resize(); dropping the sub-pixel offset costs under one
+        # output pixel here, since this is only used when shrinking
+        result = cv2.resize(region, size, interpolation=interpolation)
+    else:
+        # Inverse affine map from output pixel centers to source pixel centers (exact alignment,
+        # which matters when enlarging: overlays are drawn at source coords * zoom)
+        step_x, step_y = 1.0 / scale_x, 1.0 / scale_y
+        matrix = np.array([[step_x, 0.0, x0 - ix0 + 0.5 * step_x - 0.5],
+                           [0.0, step_y, y0 - iy0 + 0.5 * step_y - 0.5]], dtype=np.float64)
+        result = cv2.warpAffine(region, matrix, size, flags=interpolation | cv2.WARP_INVERSE_MAP,
+                                borderMode=cv2.BORDER_REPLICATE)
+    return Image.fromarray(result)
+
+
+# --- Intensity Profile Helpers ---
+REMAP_MAX_SIDE = 32766 # cv2.remap asserts that source and map sides are below SHRT_MAX
+
+
+def _bilinear_gather(gray, map_x, map_y):
+    """Bilinear samples of gray at pixel-center coords (map_x, map_y), gathered straight from
+    its (uint8) pixels; borders replicate like cv2.remap with BORDER_REPLICATE."""
+    height, width = gray.shape[:2]
+    map_x = np.clip(map_x, 0, width - 1)
+    map_y = np.clip(map_y, 0, height - 1)
+    x0 = np.minimum(map_x.astype(np.intp), max(width - 2, 0))
+    y0 = np.minimum(map_y.astype(np.intp), max(height - 2, 0))
+    x1, y1 = np.minimum(x0 + 1, width - 1), np.minimum(y0 + 1, height - 1)
+    fx, fy = map_x - x0, map_y - y0
+    top_left, top_right = gray[y0, x0].astype(np.float32), gray[y0, x1].astype(np.float32)
+    bottom_left, bottom_right = gray[y1, x0].astype(np.float32), gray[y1, x1].astype(np.float32)
+    top = top_left + (top_right - top_left) * fx
+    bottom = bottom_left + (bottom_right - bottom_left) * fx
+    return (top + (bottom - top) * fy).astype(np.float32)
+
+
+def sample_line_profiles(gray, starts, ends, num_samples):
+    """Samples intensity profiles along N segments with bilinear interpolation in one pass.
+
+    gray is a 2D array, starts/ends are (N, 2) sequences of (x, y) image coords where
+    pixel i spans [i, i+1). Returns an (N, num_samples) float32 array.
+
+    cv2.remap needs a float copy of the segments' bounding box and cannot take sources or
+    maps with a side of SHRT_MAX (32767) or more. The map is remapped in chunks below that
+    limit; when the bounding box is large compared to the number of samples (long diagonals,
+    segments spread over the image) or too wide for remap, the samples are gathered directly
+    from gray instead. Both give the same values.
+    """
+    starts = np.asarray(starts, dtype=np.float32).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.float32).reshape(-1, 2)
+    t = np.linspace(0.0, 1.0, num_samples, dtype=np.float32)
+    # Sample positions in pixel-center coordinates (remap samples pixel i at coordinate i)
+    map_x = starts[:, 0:1] + (ends[:, 0:1] - starts[:, 0:1]) * t - 0.5
+    map_y = starts[:, 1:2] + (ends[:, 1:2] - starts[:, 1:2]) * t - 0.5
+
+    # Only convert the bounding box of all segments to float (keeps sub-pixel precision cheap)
+    height, width = gray.shape[:2]
+    x0 = int(max(0, math.floor(map_x.min()) - 1))
+    y0 = int(max(0, math.floor(map_y.min()) - 1))
+    x1 = int(min(width, math.ceil(map_x.max()) + 2))
+    y1 = int(min(height, math.ceil(map_y.max()) + 2))
+    if x1 <= x0 or y1 <= y0:
+        return np.zeros((len(starts), num_samples), dtype=np.float32)
+    if (x1 - x0) * (y1 - y0) > 4 * map_x.size or max(x1 - x0, y1 - y0) > REMAP_MAX_SIDE:
+        return _bilinear_gather(gray, map_x, map_y)
+    patch = gray[y0:y1, x0:x1].astype(np.float32)
+    profiles = np.empty(map_x.shape, dtype=np.float32)
+    for r in range(0, map_x.shape[0], REMAP_MAX_SIDE):
+        for c in range(0, map_x.shape[1], REMAP_MAX_SIDE):
+            block = (slice(r, r + REMAP_MAX_SIDE), slice(c, c + REMAP_MAX_SIDE))
+            profiles[block] = cv2.remap(patch, map_x[block] - x0, map_y[block] - y0, cv2.INTER_LINEAR,
+                                        borderMode=cv2.BORDER_REPLICATE)
+    return profiles
+
+
+def line_profile(gray, start, end, width=1, num_samples=None):
+    """Intensity profile from start to end, averaged over `width` parallel lines 1 px apart.
+
+    The lines are centered on the segment, so width 1 is the segment itself. All of them are
+    sampled in one sample_line_profiles call. num_samples defaults to one per pixel of length.
+    Returns (distances_px, profile) as float32 arrays.
+    """
+    (x1, y1), (x2, y2) = start, end
+    length = math.hypot(x2 - x1, y2 - y1)
+    num_samples = num_samples or max(2, int(math.ceil(length)) + 1)
+    width = max(1, int(width))
+    normal = np.array([-(y2 - y1), x2 - x1], dtype=np.float32) / length if length > 0 else np.zeros(2, np.float32)
+    offsets = (np.arange(width, dtype=np.float32) - (width - 1) / 2.0)[:, None] * normal
+    profiles = sample_line_profiles(gray, np.float32([x1, y1]) + offsets, np.float32([x2, y2]) + offsets, num_samples)
+    return np.linspace(0.0, length, num_samples, dtype=np.float32), profiles.mean(axis=0)
+
+
+def export_line_profile(path, distances, profile, calibration_factor=None, header=None):
+    """Writes a profile to .npy or CSV (by extension) with columns distance_px, [distance_mm,] intensity.
+
+    header (a dict, e.g. the measurement and segment) goes into '# key: value' lines
+    at the top of the CSV. NPY holds just the columns, as float32.
+    """
+    columns = [distances]
+    names = ["distance_px"]
+    if calibration_factor:
+        columns.append(distances / calibration_factor)
+        names.append("distance_mm")
+    columns.append(profile)
+    names.append("intensity")
+    table = np.column_stack(columns).astype(np.float32)
+    if path.lower().endswith(".npy"):
+        np.save(path, table)
+        return
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        for key, value in (header or {}).items():
+            f.write(f"# {key}: {value}\n")
+        writer = csv.writer(f)
+        writer.writerow(names)
+        writer.writerows([f"{v:.4f}" for v in row] for row in table)
+
+
+def _parabolic_peak_offset(values, i):
+    """Sub-sample offset (-0.5..0.5) of the extremum at index i from a parabola through its neighbours."""
+    if i <= 0 or i >= len(values) - 1:
+        return 0.0
+    left, center, right = values[i - 1], values[i], values[i + 1]
+    denom = left - 2 * center + right
+    if abs(denom) < 1e-12:
+        return 0.0
+    return float(max(-0.5, min(0.5, 0.5 * (left - right) / denom)))
+
+
+def locate_vessel_walls(profile, method="gradient"):
+    """Finds both vessel walls in a cross-section profile.
+
+    method "gradient" picks the strongest opposite-signed gradient pair, "fwhm" the
+    half-maximum crossings around the darkest/brightest point. Returns the walls as
+    sub-sample indices (left, right), or None if no vessel is found.
+    """
+    profile = np.asarray(profile, dtype=np.float64)
+    n = len(profile)
+    if n < 5:
+        return None
+    # Light smoothing so single noisy pixels do not win
+    profile = np.convolve(np.pad(profile, 2, mode="edge"), np.array([1, 4, 6, 4, 1]) / 16.0, mode="valid")
+
+    if method == "fwhm":
+        edge_len = max(2, n // 10)
+        baseline = float(np.median(np.concatenate((profile[:edge_len], profile[-edge_len:]))))
+        dark_depth = baseline - profile.min()
+        bright_height = profile.max() - baseline
+        if max(dark_depth, bright_height) < 1e-6:
+            return None
+        # Work on a profile where the vessel is always a positive peak
+        signal = (baseline - profile) if dark_depth >= bright_height else (profile - baseline)
+        peak = int(np.argmax(signal))
+        half = signal[peak] / 2.0
+        below = np.nonzero(signal[:peak] < half)[0]
+        above = np.nonzero(signal[peak + 1:] < half)[0]
+        if len(below) == 0 or len(above) == 0:
+            return None # Profile does not drop to half maximum on both sides
+        i_left = int(below[-1])
+        i_right = peak + 1 + int(above[0])
+        # Linear interpolation of the exact half-level crossings
+        left = i_left + (half - signal[i_left]) / (signal[i_left + 1] - signal[i_left])
+        right = (i_right - 1) + (signal[i_right - 1] - half) / (signal[i_right - 1] - signal[i_right])
+        return (float(left), float(right))
+
+    gradient = np.gradient(profile)
+    # Dark vessel: falling edge then rising edge. Bright vessel: rising then falling.
+    prefix_min = np.minimum.accumulate(gradient)[:-1]
+    prefix_max = np.maximum.accumulate(gradient)[:-1]
+    dark_score = gradient[1:] - prefix_min
+    bright_score = prefix_max - gradient[1:]
+    if dark_score.max() >= bright_score.max():
+        j = int(np.argmax(dark_score)) + 1
+        i = int(np.argmin(gradient[:j]))
+    else:
+        j = int(np.argmax(bright_score)) + 1
+        i = int(np.argmax(gradient[:j]))
+    if j <= i or abs(gradient[i]) < 1e-6 or abs(gradient[j]) < 1e-6:
+        return None
+    magnitude = np.abs(gradient)
+    return (i + _parabolic_peak_offset(magnitude, i), j + _parabolic_peak_offset(magnitude, j))
+
+
+# --- Spatial Index ---
+class PointGridIndex:
+    """Uniform grid over point positions (image coords) for constant-time hit tests.
+
+    Keys are arbitrary hashables (e.g. ("artery", 3)); moving a point only touches its two cells.
+    """
+    def __init__(self, cell_size=32.0):
+        self.cell_size = float(cell_size)
+        self.cells = {} # (cell_x, cell_y) -> set of keys
+        self.positions = {} # key -> (x, y)
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def insert(self, key, x, y):
+        self.positions[key] = (x, y)
+        self.cells.setdefault(self._cell(x, y), set()).add(key)
+
+    def remove(self, key):
+        pos = self.positions.pop(key, None)
+        if pos is None:
+            return
+        cell = self._cell(*pos)
+        bucket = self.cells.get(cell)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del self.cells[cell]
+
+    def move(self, key, x, y):
+        self.remove(key)
+        self.insert(key, x, y)
+
+    def nearest(self, x, y, radius):
+        """Returns the key closest to (x, y) within radius, or None."""
+        min_cx, min_cy = self._cell(x - radius, y - radius)
+        max_cx, max_cy = self._cell(x + radius, y + radius)
+        best_key, best_dist_sq = None, radius * radius
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                for key in self.cells.get((cx, cy), ()):
+                    px, py = self.positions[key]
+                    dist_sq = (px - x)**2 + (py - y)**2
+                    if dist_sq <= best_dist_sq:
+                        best_key, best_dist_sq = key, dist_sq
+        return best_key
+
+    def __len__(self):
+        return len(self.positions)
+
+
+# --- Tracing ---
+class TraceRecorder:
+    """Opt-in span recorder for latency investigations, written as Chrome/Perfetto trace-event JSON.
+
+    Spans are kept as plain tuples in a fixed-size ring buffer (deque appends are atomic, so no lock
+    on the hot path); the JSON is only built on dump. Nesting follows from timestamps per thread id,
+    which is how chrome://tracing and ui.perfetto.dev lay out complete ("X") events.
+    """
+    def __init__(self, capacity=200000):
+        self.enabled = False
+        self.origin = time.perf_counter()
+        self._events = deque(maxlen=capacity) # (name, category, start_s, duration_s, thread id, args)
+
+    @contextmanager
+    def span(self, name, category="ui", **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._events.append((name, category, start, time.perf_counter() - start, threading.get_ident(), args or None))
+
+    def clear(self):
+        self._events.clear()
+
+    def __len__(self):
+        return len(self._events)
+
+    def trace_events(self, last_s=None):
+        """Events ending within the last `last_s` seconds (all if None) in trace-event format, sorted by start."""
+        events = list(self._events) # Snapshot; writers may keep appending
+        if last_s is not None:
+            cutoff = time.perf_counter() - last_s
+            events = [e for e in events if e[2] + e[3] >= cutoff]
+        events.sort(key=lambda e: (e[2], -e[3])) # Parents before children that start at the same time
+        pid = os.getpid()
+        trace = []
+        for name, category, start, duration, tid, args in events:
+            event = {"name": name, "cat": category, "ph": "X", "pid": pid, "tid": tid,
+                     "ts": round((start - self.origin) * 1e6, 1), "dur": round(duration * 1e6, 1)}
+            if args:
+                event["args"] = args
+            trace.append(event)
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for tid in sorted({e[4] for e in events}):
+            trace.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                          "args": {"name": names.get(tid, f"thread {tid}")}})
+        return trace
+
+    def dump(self, path, last_s=None):
+        """Writes the buffered spans as a trace-event JSON file. Returns the number of spans written."""
+        trace = self.trace_events(last_s)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+        return sum(1 for e in trace if e["ph"] == "X")
+
+
+TRACE = TraceRecorder()
+
+
+def traced(name, category="ui"):
+    """Function/method decorator: records each call as a trace span (no-op unless TRACE.enabled)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TRACE.span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- Performance Stats ---
+class PerfStats:
+    """Rolling per-stage timings (last value and p95 over a window) plus a frame-rate meter. Thread-safe."""
+    def __init__(self, window=120):
+        self.window = window
+        self._samples = {} # stage -> deque of durations in ms
+        self._frames = deque(maxlen=240) # perf_counter() of recently presented frames
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, category="render"):
+        """Times the block; also recorded as a trace span when tracing is on."""
+        start = time.perf_counter()
+        try:
+            with TRACE.span(name, category):
+                yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000.0)
+
+    def add(self, name, ms):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.window)
+            samples.append(ms)
+
+    def frame(self):
+        """Marks a presented frame (full render or overlay redraw)."""
+        with self._lock:
+            self._frames.append(time.perf_counter())
+
+    def fps(self, period_s=1.0):
+        """Frames per second over the last period_s seconds (0 when idle)."""
+        now = time.perf_counter()
+        with self._lock:
+            recent = [t for t in self._frames if now - t <= period_s]
+        if len(recent) < 2:
+            return 0.0
+        return (len(recent) - 1) / max(recent[-1] - recent[0], 1e-6)
+
+    def summary(self):
+        """[(stage, last_ms, p95_ms, count)] in first-seen order."""
+        with self._lock:
+            items = [(name, list(samples)) for name, samples in self._samples.items()]
+        rows = []
+        for name, samples in items:
+            ordered = sorted(samples)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            rows.append((name, samples[-1], p95, len(samples)))
+        return rows
+
+
+def timed_stage(name, category="render"):
+    """Method decorator: times each call under `name` in the instance's PerfStats (self.perf)."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.perf.stage(name, category):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- Memory Accounting ---
+_MODE_BYTES_PER_PIXEL = {"1": 1, "I;16": 2, "I;16B": 2, "I;16L": 2, "I": 4, "F": 4}
+
+
+def image_nbytes(img):
+    """Bytes of pixel data held by a PIL image (0 for None)."""
+    if img is None:
+        return 0
+    per_pixel = _MODE_BYTES_PER_PIXEL.get(img.mode, len(img.getbands()))
+    return img.width * img.height * per_pixel
+
+
+def physical_memory_bytes(default=4 * 1024**3):
+    """Installed RAM where the OS reports it (POSIX sysconf), else `default`."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return default
+
+
+class MemoryBudget:
+    """Accounts bytes held by named consumers and evicts caches when the total exceeds a budget.
+
+    Each consumer registers a size function and, if it can give memory back, an evict function
+    that receives the number of bytes still to free and returns the bytes it freed. enforce()
+    asks evictable consumers in ascending priority until the total is back under budget.
+    """
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._consumers = [] # (name, size_fn, evict_fn, priority) in display order
+
+    def register(self, name, size_fn, evict_fn=None, priority=0):
+        self._consumers.append((name, size_fn, evict_fn, priority))
+
+    def breakdown(self):
+        """[(name, bytes)] in registration order."""
+        return [(name, size_fn()) for name, size_fn, _, _ in self._consumers]
+
+    def total(self):
+        return sum(size for _, size in self.breakdown())
+
+    def enforce(self, breakdown=None):
+        """Evicts until under budget (or nothing evictable is left). Returns [(name, bytes_freed)].
+
+        breakdown: a just-taken breakdown() to reuse instead of measuring every consumer again.
+        """
+        over = (sum(size for _, size in breakdown) if breakdown is not None else self.total()) - self.budget_bytes
+        evicted = []
+        if over <= 0:
+            return evicted
+        for name, _, evict_fn, _ in sorted((c for c in self._consumers if c[2]), key=lambda c: c[3]):
+            freed = evict_fn(over)
+            if freed:
+                evicted.append((name, freed))
+                over -= freed
+            if over <= 0:
+                break
+        return evicted
+
+
+# --- Measurement Geometry ---
+def artery_measurement(p1, p2, calibration_factor=None):
+    """Dots Mode pair: distance and direction (0-360°, counter-clockwise from +X), plus mm if calibrated."""
+    dx = p2[0] - p1[0]
+    dy = p2[1] - p1[1]
+    distance_px = math.sqrt(dx**2 + dy**2)
+    angle = math.degrees(math.atan2(-dy, dx)) # Use -dy because Y increases downwards
+    if angle < 0: angle += 360
+
+    meas_info = {
+        "type": "artery",
+        "points": [(p1[0], p1[1]), (p2[0], p2[1])],
+        "distance_px": distance_px,
+        "angle_deg": angle
+    }
+    if calibration_factor:
+        meas_info["distance_mm"] = distance_px / calibration_factor
+    return meas_info
+
+
+def angle_at_vertex(p1, vertex, p3):
+    """Angle p1-vertex-p3 in degrees (0-180), or None if a point coincides with the vertex."""
+    v1 = (p1[0] - vertex[0], p1[1] - vertex[1])
+    v2 = (p3[0] - vertex[0], p3[1] - vertex[1])
+    if v1[0]**2 + v1[1]**2 < 1e-9 or v2[0]**2 + v2[1]**2 < 1e-9:
+        return None
+    angle_rad = math.atan2(v2[1], v2[0]) - math.atan2(v1[1], v1[0])
+    while angle_rad > math.pi: angle_rad -= 2 * math.pi
+    while angle_rad <= -math.pi: angle_rad += 2 * math.pi
+    return abs(math.degrees(angle_rad))
+
+
+def calibration_measurement(p1, p2, real_value_mm):
+    """Calibration entry for two points a known real distance apart. Raises ValueError for a bad distance."""
+    if real_value_mm <= 0:
+        raise ValueError("Real distance must be positive.")
+    distance_px = math.dist(p1, p2)
+    if distance_px < 1e-9:
+        raise ValueError("Calibration points coincide.")
+    return {
+        "type": "calibration",
+        "points": [tuple(p1), tuple(p2)],
+        "distance_px": distance_px,
+        "real_value_mm": real_value_mm,
+        "calibration_factor": distance_px / real_value_mm
+    }
+
+
+def line_mode_measurement(line_points, calibration_factor=None, num_measures=15):
+    """Line Mode: lengths, angle between the lines and perpendicular distances at num_measures + 1 points.
+
+    Returns (measurement dict, tick segments), or (None, []) if a line has zero length.
+    """
+    if len(line_points) != 4:
+        return None, []
+    p1, p2, p3, p4 = line_points
+    v1 = (p2[0] - p1[0], p2[1] - p1[1])
+    v2 = (p4[0] - p3[0], p4[1] - p3[1])
+    len1_px = math.hypot(*v1)
+    len2_px = math.hypot(*v2)
+    if len1_px**2 < 1e-9 or len2_px**2 < 1e-9:
+        return None, []
+
+    # Clamp cos_theta to handle potential float errors slightly outside [-1, 1]
+    cos_theta = max(-1.0, min(1.0, (v1[0] * v2[0] + v1[1] * v2[1]) / (len1_px * len2_px)))
+    angle_deg = math.degrees(math.acos(cos_theta))
+    if angle_deg > 90: angle_deg = 180.0 - angle_deg
+
+    # Ticks: samples along line 1 and their feet on (infinite) line 2
+    ticks = line_tick_segments(line_points, num_measures)
+    distances_px = [math.dist(pt_on_line1, foot) for pt_on_line1, foot in ticks]
+    result = {
+        "type": "line",
+        "points": list(line_points),
+        "length1_px": len1_px,
+        "length2_px": len2_px,
+        "angle_deg": angle_deg,
+        "distances_px": distances_px,
+        "avg_dist_px": sum(distances_px) / len(distances_px),
+    }
+    if calibration_factor:
+        result["length1_mm"] = len1_px / calibration_factor
+        result["length2_mm"] = len2_px / calibration_factor
+        result["distances_mm"] = [d / calibration_factor for d in distances_px]
+        result["avg_dist_mm"] = sum(result["distances_mm"]) / len(distances_px)
+    return result, ticks
+
+
+# --- Analysis Files ---
+SOFTWARE_VERSION = "ImageAnalyzer_1.4_JsonMmAvg"
+
+
+def clean_measurement(meas):
+    """Copy of a measurement with floats rounded per unit (px 2, mm 4, deg 2 digits) for saving."""
+    clean_meas = meas.copy()
+    for key, value in clean_meas.items():
+        if isinstance(value, float):
+            round_digits = 4 # Default rounding for floats (also *_mm)
+            if key.endswith("_px"): round_digits = 2
+            elif key.endswith("_deg"): round_digits = 2
+            elif key == "calibration_factor": round_digits = 6
+            clean_meas[key] = round(value, round_digits)
+        elif isinstance(value, list): # Points or distance lists
+            if key == "points":
+                clean_meas[key] = [(round(pt[0], 1), round(pt[1], 1))
+                                   if isinstance(pt, (list, tuple)) and len(pt) == 2
+                                   else pt
+                                   for pt in value]
+            elif key == "distances_px":
+                clean_meas[key] = [round(d, 2) if isinstance(d, (int, float)) else d for d in value]
+            elif key == "distances_mm":
+                clean_meas[key] = [round(d, 4) if isinstance(d, (int, float)) else d for d in value]
+    return clean_meas
+
+
+def build_analysis_data(image_path, analysis_name, real_diameter_mm, calibration_factor, calibration_points,
+                        measurements, timestamp=None, filters=None, intensity_stats=None):
+    """The analysis JSON document (as read by load_analysis_file). calibration_factor is None if uncalibrated.
+
+    filters (optional) records how the edge map was produced: thresholds, scope and the
+    preprocessing pipeline ({"canny_low", "canny_high", "global_canny", "canny_roi", "filter_pipeline"}).
+    intensity_stats (optional) holds the Canny ROI and per-point gray level statistics; it is
+    derived data, so loading ignores it.
+    """
+    timestamp = timestamp or datetime.datetime.now()
+    data = {
+        "metadata": {
+            "source_image_path": image_path,
+            "source_image_name": os.path.basename(image_path),
+            "analysis_name": analysis_name,
+            "analysis_timestamp_iso": timestamp.isoformat(),
+            "expected_real_diameter_mm": real_diameter_mm,
+            "software_version": SOFTWARE_VERSION
+        },
+        "calibration": {
+            "calibrated": calibration_factor is not None,
+            "pixels_per_mm": round(calibration_factor, 6) if calibration_factor is not None else None,
+            "calibration_points": [(round(p[0], 1), round(p[1], 1)) for p in calibration_points]
+        },
+        "measurements": [clean_measurement(meas) for meas in measurements]
+    }
+    if filters is not None:
+        data["filters"] = filters
+    if intensity_stats is not None:
+        data["intensity_statistics"] = intensity_stats
+    return data
+
+
+def load_analysis_file(path):
+    """Parses and validates an analysis JSON written by save_measurements_to_json.
+
+    Returns the parsed dict with measurement points converted to tuples. Raises ValueError
+    with a readable message if the file is not a valid analysis.
+    """
+    with open(path, encoding="utf-8") as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ValueError(f"Not a valid JSON file: {e}")
+
+    if not isinstance(data, dict):
+        raise ValueError("Top level must be a JSON object.")
+    metadata = data.get("metadata")
+    if not isinstance(metadata, dict) or not (metadata.get("source_image_path") or metadata.get("source_image_name")):
+        raise ValueError("Missing 'metadata' with the source image path.")
+    calibration = data.get("calibration") or {}
+    if not isinstance(calibration, dict):
+        raise ValueError("'calibration' must be an object.")
+    measurements = data.get("measurements", [])
+    if not isinstance(measurements, list):
+        raise ValueError("'measurements' must be a list.")
+
+    for i, meas in enumerate(measurements):
+        if not isinstance(meas, dict) or not isinstance(meas.get("type"), str):
+            raise ValueError(f"Measurement {i + 1} has no 'type'.")
+        points = meas.get("points", [])
+        if not isinstance(points, list) or not all(
+                isinstance(p, (list, tuple)) and len(p) == 2 and all(isinstance(v, (int, float)) for v in p) for p in points):
+            raise ValueError(f"Measurement {i + 1} ({meas['type']}) has invalid points.")
+        meas["points"] = [tuple(p) for p in points]
+
+    filters = data.get("filters")
+    if filters is not None:
+        if not isinstance(filters, dict):
+            raise ValueError("'filters' must be an object.")
+        FilterPipeline.from_json(filters.get("filter_pipeline", [])) # Validates stage names and parameters
+
+    data["calibration"] = calibration
+    data["measurements"] = measurements
+    return data
+
+
+def resolve_source_image(analysis_path, metadata):
+    """Finds the analysed image: the stored absolute path first, then the same name next to the JSON."""
+    source_path = metadata.get("source_image_path")
+    if source_path and os.path.isfile(source_path):
+        return source_path
+    name = metadata.get("source_image_name") or (os.path.basename(source_path.replace("\\", "/")) if source_path else None)
+    if name:
+        candidate = os.path.join(os.path.dirname(os.path.abspath(analysis_path)), name)
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+# --- Overlay Rendering ---
+OVERLAY_STYLE = {
+    "dot_radius": 3, "line_width": 2, "tick_radius": 2, "outline": "black",
+    "calibration": "cyan", "artery": "yellow", "line": "magenta", "angle": "limegreen", "tick": "red",
+}
+
+# Encoder settings per output extension, shared by the GUI export and the batch exporter
+EXPORT_ENCODER_SETTINGS = {
+    ".png": {"compress_level": 6},
+    ".jpg": {"quality": 95, "subsampling": 0},
+    ".jpeg": {"quality": 95, "subsampling": 0},
+    ".tif": {"compression": "tiff_lzw"},
+    ".tiff": {"compression": "tiff_lzw"},
+    ".bmp": {},
+}
+
+
+def line_tick_segments(line_points, num_measures=15):
+    """Returns the (point on line 1, foot on line 2) pairs drawn as Line Mode ticks, or [] if degenerate."""
+    if len(line_points) != 4:
+        return []
+    p1, p2, p3, _ = line_points
+    v1 = (p2[0] - p1[0], p2[1] - p1[1])
+    v2 = (line_points[3][0] - p3[0], line_points[3][1] - p3[1])
+    mag2_sq = v2[0]**2 + v2[1]**2
+    if v1[0]**2 + v1[1]**2 < 1e-9 or mag2_sq < 1e-9:
+        return []
+    segments = []
+    for i in range(num_measures + 1):
+        t = i / num_measures
+        pt_on_line1 = (p1[0] + t * v1[0], p1[1] + t * v1[1])
+        t_proj = ((pt_on_line1[0] - p3[0]) * v2[0] + (pt_on_line1[1] - p3[1]) * v2[1]) / mag2_sq
+        segments.append((pt_on_line1, (p3[0] + t_proj * v2[0], p3[1] + t_proj * v2[1])))
+    return segments
+
+
+def overlay_points_from_measurements(measurements):
+    """Rebuilds the overlay point lists from saved measurements: artery pairs, the last line pair and all angles."""
+    artery_dots = [pt for m in measurements if m["type"] == "artery" and len(m.get("points", [])) == 2 for pt in m["points"]]
+    last_line = next((m for m in reversed(measurements) if m["type"] == "line" and len(m.get("points", [])) == 4), None)
+    angle_sets = [list(m["points"]) for m in measurements if m["type"] == "angle" and len(m.get("points", [])) == 3]
+    return artery_dots, list(last_line["points"]) if last_line else [], angle_sets
+
+
+def build_overlay_primitives(calibration_dots=(), artery_dots=(), line_points=(), angle_sets=(), tick_segments=(), style=OVERLAY_STYLE):
+    """Turns point lists into draw primitives in image coordinates, in the export drawing order.
+
+    Each primitive is ("ellipse", (x0, y0, x1, y1), fill, outline) or ("line", (p1, p2), fill, width).
+    """
+    r = style["dot_radius"]
+    outline = style["outline"]
+    prims = []
+
+    def dot(pt, color, radius=r, edge=outline):
+        prims.append(("ellipse", (pt[0] - radius, pt[1] - radius, pt[0] + radius, pt[1] + radius), color, edge))
+
+    def segment(p1, p2, color, width=style["line_width"]):
+        prims.append(("line", (tuple(p1), tuple(p2)), color, width))
+
+    for pt in calibration_dots:
+        dot(pt, style["calibration"])
+    for key, points in (("artery", artery_dots), ("line", line_points)):
+        for i, pt in enumerate(points):
+            dot(pt, style[key])
+            if i % 2 == 1:
+                segment(points[i - 1], pt, style[key])
+    for angle_pts in angle_sets:
+        for i, pt in enumerate(angle_pts[:3]):
+            dot(pt, style["angle"])
+            if i > 0:
+                segment(angle_pts[i - 1], pt, style["angle"])
+    for p1, p2 in tick_segments:
+        dot(p1, style["tick"], style["tick_radius"], style["tick"])
+        segment(p1, p2, style["tick"], 1)
+    return prims
+
+
+def draw_overlay_primitives(draw, primitives, offset=(0, 0)):
+    """Draws primitives with ImageDraw; offset is subtracted from every coordinate (for tiles).
+
+    Coordinates are rounded to whole pixels first so that tiled renders line up with a full render.
+    """
+    ox, oy = offset
+    for kind, geom, fill, extra in primitives:
+        if kind == "ellipse":
+            x0, y0, x1, y1 = (round(v) for v in geom)
+            draw.ellipse((x0 - ox, y0 - oy, x1 - ox, y1 - oy), fill=fill, outline=extra)
+        else:
+            (xa, ya), (xb, yb) = ((round(x), round(y)) for x, y in geom)
+            draw.line([(xa - ox, ya - oy), (xb - ox, yb - oy)], fill=fill, width=extra)
+
+
+def prepare_for_format(img, ext):
+    """Flattens RGBA onto white for formats without alpha (JPEG)."""
+    if ext in (".jpg", ".jpeg"):
+        if img.mode == 'RGBA':
+            bg = Image.new("RGB", img.size, (255, 255, 255))
+            bg.paste(img, mask=img.split()[3])
+            return bg
+        if img.mode != 'RGB':
+            return img.convert('RGB')
+    return img
+
+
+def analysis_overlay_geometry(data):
+    """Overlay geometry (build_overlay_primitives keyword arguments) for a loaded analysis file."""
+    artery_dots, line_points, angle_sets = overlay_points_from_measurements(data["measurements"])
+    return {"calibration_dots": [tuple(p) for p in data["calibration"].get("calibration_points") or []],
+            "artery_dots": artery_dots, "line_points": line_points, "angle_sets": angle_sets,
+            "tick_segments": line_tick_segments(line_points)}
+
+
+def analysis_overlay_primitives(data):
+    """Overlay primitives for a loaded analysis file (see load_analysis_file)."""
+    return build_overlay_primitives(**analysis_overlay_geometry(data))
+
+
+# --- Vector Overlay Export ---
+VECTOR_EXPORT_FORMATS = (".svg", ".json")
+
+
+def _image_link(image_path, export_path):
+    """Link to the source image: relative to the export file when possible, else a file URI."""
+    try:
+        return os.path.relpath(os.path.abspath(image_path), os.path.dirname(os.path.abspath(export_path))).replace(os.sep, "/")
+    except ValueError: # Different drive on Windows
+        return "file:///" + os.path.abspath(image_path).replace(os.sep, "/").lstrip("/")
+
+
+def overlay_svg(primitives, size, image_href=None):
+    """SVG document drawing the primitives in image coordinates, optionally over the linked image."""
+    width, height = size
+    fmt = lambda v: f"{v:.2f}".rstrip("0").rstrip(".")
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+             f'width="{width}" height="{height}" viewBox="0 0 {width} {height}">']
+    if image_href:
+        lines.append(f'  <image x="0" y="0" width="{width}" height="{height}" href="{html.escape(image_href)}" xlink:href="{html.escape(image_href)}"/>')
+    lines.append('  <g id="overlay">')
+    for kind, geom, fill, extra in primitives:
+        if kind == "ellipse":
+            x0, y0, x1, y1 = geom
+            lines.append(f'    <ellipse cx="{fmt((x0 + x1) / 2)}" cy="{fmt((y0 + y1) / 2)}" rx="{fmt((x1 - x0) / 2)}" '
+                         f'ry="{fmt((y1 - y0) / 2)}" fill="{fill}" stroke="{extra}"/>')
+        else:
+            (xa, ya), (xb, yb) = geom
+            lines.append(f'    <line x1="{fmt(xa)}" y1="{fmt(ya)}" x2="{fmt(xb)}" y2="{fmt(yb)}" stroke="{fill}" stroke-width="{extra}"/>')
+    lines.append('  </g>')
+    lines.append('</svg>')
+    return "\n".join(lines) + "\n"
+
+
+def overlay_json(geometry, size, image_link, image_path):
+    """Compact overlay JSON: the geometry point lists in image coordinates plus the style used to draw them."""
+    round_pt = lambda p: [round(p[0], 2), round(p[1], 2)]
+    return json.dumps({
+        "overlay_format": 1,
+        "source_image": image_link,
+        "source_image_path": os.path.abspath(image_path) if image_path else None,
+        "image_size": list(size),
+        "style": OVERLAY_STYLE,
+        "calibration_dots": [round_pt(p) for p in geometry["calibration_dots"]],
+        "artery_dots": [round_pt(p) for p in geometry["artery_dots"]],
+        "line_points": [round_pt(p) for p in geometry["line_points"]],
+        "angle_sets": [[round_pt(p) for p in pts] for pts in geometry["angle_sets"]],
+        "tick_segments": [[round_pt(a), round_pt(b)] for a, b in geometry["tick_segments"]],
+    }, separators=(",", ":"))
+
+
+def write_overlay_export(path, geometry, size, image_path):
+    """Writes the overlay only (SVG, or compact JSON for a .json path), linked to the untouched source image.
+
+    The file is replaced atomically so a viewer never sees a half-written overlay.
+    """
+    link = _image_link(image_path, path) if image_path else None
+    if path.lower().endswith(".json"):
+        content = overlay_json(geometry, size, link, image_path)
+    else:
+        content = overlay_svg(build_overlay_primitives(**geometry), size, link)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+# --- Streaming Tiled Export ---
+STREAMING_EXPORT_FORMATS = (".png", ".tif", ".tiff")
+STREAMING_EXPORT_MIN_PIXELS = 64_000_000 # GUI exports above this size are written tile by tile
+EXPORT_TILE_SIZE = 512
+
+
+class PILTileSource:
+    """Reads tiles from a PIL image. A lazily opened file is decoded in full on the first read."""
+    def __init__(self, img):
+        self.img = img
+        self.size = img.size
+        self.has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+
+    def read(self, box):
+        return self.img.crop(box).convert("RGBA")
+
+
+class ArrayTileSource:
+    """Reads tiles from a (memory-mapped) uint8 array of shape (H, W), (H, W, 3) or (H, W, 4)."""
+    def __init__(self, array):
+        self.array = array
+        self.size = (array.shape[1], array.shape[0])
+        self.has_alpha = array.ndim == 3 and array.shape[2] == 4
+
+    def read(self, box):
+        x0, y0, x1, y1 = box
+        tile = np.ascontiguousarray(self.array[y0:y1, x0:x1])
+        if tile.ndim == 2:
+            return Image.fromarray(tile, "L").convert("RGBA")
+        return Image.fromarray(tile[..., :4] if self.has_alpha else tile[..., :3]).convert("RGBA")
+
+
+def open_tile_source(path):
+    """Opens an image for tiled reading, memory-mapping it when the file layout allows.
+
+    Only .npy files and uncompressed TIFFs (with tifffile installed) are mapped. PNG, JPEG
+    and compressed TIFF fall back to PILTileSource, which holds the whole decoded image.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npy":
+        return ArrayTileSource(np.load(path, mmap_mode="r"))
+    if tifffile and ext in (".tif", ".tiff"):
+        try: # Only uncompressed, contiguous TIFFs can be memory-mapped
+            array = tifffile.memmap(path, mode="r")
+            if array.dtype == np.uint8 and array.ndim in (2, 3):
+                return ArrayTileSource(array)
+        except Exception:
+            pass
+    return PILTileSource(Image.open(path)) # Fully decoded on first access
+
+
+def primitive_bounds(prim):
+    """Image-space bounding box of a draw primitive, padded for line width and anti-aliasing."""
+    kind, geom, _, extra = prim
+    if kind == "ellipse":
+        return geom[0] - 1, geom[1] - 1, geom[2] + 1, geom[3] + 1
+    pad = extra / 2.0 + 1
+    (xa, ya), (xb, yb) = geom
+    return min(xa, xb) - pad, min(ya, yb) - pad, max(xa, xb) + pad, max(ya, yb) + pad
+
+
+def bucket_primitives(primitives, tile_w, tile_h, width, height):
+    """Maps (col, row) tile keys to the primitives overlapping that tile, keeping drawing order."""
+    buckets = {}
+    max_col, max_row = (width - 1) // tile_w, (height - 1) // tile_h
+    for prim in primitives:
+        x0, y0, x1, y1 = primitive_bounds(prim)
+        c0, c1 = max(0, int(x0 // tile_w)), min(max_col, int(x1 // tile_w))
+        r0, r1 = max(0, int(y0 // tile_h)), min(max_row, int(y1 // tile_h))
+        for row in range(r0, r1 + 1):
+            for col in range(c0, c1 + 1):
+                buckets.setdefault((col, row), []).append(prim)
+    return buckets
+
+
+def iter_annotated_tiles(source, primitives, tile_w, tile_h, channels):
+    """Yields annotated tiles in row-major order as uint8 arrays, one tile in memory at a time.
+
+    A 2 px line crossing a tile seam can differ by a pixel from a one-piece render,
+    since Pillow fills wide-line polygons with off-image vertices slightly differently.
+    """
+    width, height = source.size
+    buckets = bucket_primitives(primitives, tile_w, tile_h, width, height)
+    for row, y0 in enumerate(range(0, height, tile_h)):
+        for col, x0 in enumerate(range(0, width, tile_w)):
+            box = (x0, y0, min(x0 + tile_w, width), min(y0 + tile_h, height))
+            tile = source.read(box)
+            if (col, row) in buckets:
+                draw_overlay_primitives(ImageDraw.Draw(tile), buckets[(col, row)], offset=(x0, y0))
+            yield np.asarray(tile)[..., :channels]
+
+
+def _png_chunk(f, chunk_type, data):
+    f.write(len(data).to_bytes(4, "big") + chunk_type + data)
+    f.write(zlib.crc32(data, zlib.crc32(chunk_type)).to_bytes(4, "big"))
+
+
+def write_streaming_png(path, source, primitives, strip_height=EXPORT_TILE_SIZE, compress_level=6, progress=None):
+    """Writes the annotated image as PNG one full-width strip at a time ('Up' row filter)."""
+    width, height = source.size
+    channels = 4 if source.has_alpha else 3
+    compressor = zlib.compressobj(compress_level)
+    prev_row = np.zeros((1, width * channels), dtype=np.uint8)
+    pending = []
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        color_type = 6 if channels == 4 else 2
+        _png_chunk(f, b"IHDR", width.to_bytes(4, "big") + height.to_bytes(4, "big") + bytes([8, color_type, 0, 0, 0]))
+        for y0, strip in zip(range(0, height, strip_height),
+                             iter_annotated_tiles(source, primitives, width, strip_height, channels)):
+            rows = strip.reshape(strip.shape[0], -1)
+            filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+            filtered[:, 0] = 2 # 'Up' filter: difference to the row above (uint8 wrap-around is the PNG rule)
+            filtered[:, 1:] = rows - np.vstack((prev_row, rows[:-1]))
+            prev_row = rows[-1:].copy()
+            pending.append(compressor.compress(filtered.tobytes()))
+            if sum(len(b) for b in pending) >= 1 << 20:
+                _png_chunk(f, b"IDAT", b"".join(pending))
+                pending = []
+            if progress:
+                progress(min(y0 + strip_height, height) / height)
+        pending.append(compressor.flush())
+        _png_chunk(f, b"IDAT", b"".join(pending))
+        _png_chunk(f, b"IEND", b"")
+
+
+def write_tiled_tiff(path, source, primitives, tile_size=EXPORT_TILE_SIZE, compression="zlib", progress=None):
+    """Writes the annotated image as a tiled TIFF (BigTIFF above 2 GB) via tifffile."""
+    if not tifffile:
+        raise RuntimeError("Tiled TIFF export needs the 'tifffile' package (pip install tifffile). PNG export works without it.")
+    width, height = source.size
+    channels = 4 if source.has_alpha else 3
+    total = ((width + tile_size - 1) // tile_size) * ((height + tile_size - 1) // tile_size)
+
+    def tiles():
+        for i, tile in enumerate(iter_annotated_tiles(source, primitives, tile_size, tile_size, channels)):
+            if progress:
+                progress((i + 1) / total)
+            yield tile
+
+    bigtiff = width * height * channels > 2**31
+    tifffile.imwrite(path, tiles(), shape=(height, width, channels), dtype=np.uint8, tile=(tile_size, tile_size),
+                     photometric="rgb", compression=compression, bigtiff=bigtiff)
+
+
+def export_annotated_streaming(path, source, primitives, tile_size=EXPORT_TILE_SIZE, progress=None):
+    """Streams an annotated export to PNG or tiled TIFF.
+
+    The annotated output is rendered and encoded one tile at a time, so the output side is
+    bounded by the tile size. The input is only read tile by tile if the source is memory-mapped
+    (see open_tile_source); otherwise the whole source image is in memory as well.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".png":
+        write_streaming_png(path, source, primitives, tile_size, progress=progress)
+    elif ext in (".tif", ".tiff"):
+        write_tiled_tiff(path, source, primitives, tile_size, progress=progress)
+    else:
+        raise ValueError(f"Streaming export supports {', '.join(STREAMING_EXPORT_FORMATS)} only, not '{ext}'.")
+
+
+# --- Headless Batch Analysis ---
+def expand_inputs(inputs, extensions=IMAGE_EXTENSIONS):
+    """Expands folders and glob patterns into a sorted list of files with the given extensions."""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(os.path.join(item, f) for f in os.listdir(item) if f.lower().endswith(extensions))
+        else:
+            paths.extend(p for p in glob.glob(item) if p.lower().endswith(extensions))
+    return sorted(set(p for p in paths if os.path.isfile(p)))
+
+
+def unique_output_stems(paths):
+    """Output file stem per input path: the file's own stem where that is unique.
+
+    Inputs sharing a stem (same name in different folders, or different extensions) use
+    their path relative to the inputs' common folder instead, e.g. 'day1/scan.png' ->
+    'day1__scan_png', so their outputs cannot overwrite each other. Anything still
+    colliding gets a numeric suffix.
+    """
+    stems = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+    counts = {}
+    for stem in stems:
+        counts[stem] = counts.get(stem, 0) + 1
+    try:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths]) if paths else ""
+    except ValueError: # Different drives
+        root = None
+    result, used = [], set()
+    for path, stem in zip(paths, stems):
+        if counts[stem] > 1 and root is not None:
+            stem = os.path.relpath(os.path.abspath(path), root).replace(os.sep, "__").replace(".", "_")
+        unique, n = stem, 1
+        while unique in used:
+            n += 1
+            unique = f"{stem}_{n}"
+        used.add(unique)
+        result.append(unique)
+    return result
+
+
+def run_in_pool(func, tasks, workers, tasks_per_worker):
+    """Runs func over tasks in worker processes, yielding results as they complete.
+
+    Only 2 * workers tasks are in flight at once, and workers are recycled after
+    tasks_per_worker tasks so one huge image does not pin its memory for the rest of the run.
+    """
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait # Only needed by the CLI
+    try:
+        executor = ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=tasks_per_worker)
+    except TypeError: # Python < 3.11
+        executor = ProcessPoolExecutor(max_workers=workers)
+    with executor:
+        pending = set()
+        task_iter = iter(tasks)
+        while True:
+            for task in task_iter:
+                pending.add(executor.submit(func, task))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def write_batch_report(report_base, rows, summary):
+    """Writes the per-file rows as <report_base>.csv and the summary plus rows as <report_base>.json."""
+    with open(report_base + ".csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(report_base + ".json", "w", encoding="utf-8") as f:
+        json.dump(dict(summary, results=rows), f, indent=4)
+
+
+def batch_process_image(task):
+    """Worker: runs the GUI filter path on one image and writes its edge map. Returns a summary row."""
+    path = task["path"]
+    row = {"file": path, "width": None, "height": None, "canny_low": task["low"], "canny_high": task["high"],
+           "edge_pixels": None, "edge_density": None, "seconds": None, "outputs": "", "error": ""}
+    start = time.perf_counter()
+    try:
+        with Image.open(path) as img_file:
+            row["width"], row["height"] = img_file.size
+            if task["max_pixels"] and img_file.width * img_file.height > task["max_pixels"]:
+                raise ValueError(f"{img_file.width}x{img_file.height} exceeds --max-megapixels")
+            img_rgba = img_file.convert("RGBA") # Same conversion as the GUI loader
+
+        roi = clamp_roi(task["roi"], img_rgba.width, img_rgba.height) if task["roi"] else None
+        if task["roi"] and not roi:
+            raise ValueError("ROI lies outside the image")
+        gray = to_gray_array(img_rgba)
+        if task.get("pipeline"):
+            gray = run_filter_pipeline(gray, task["pipeline"])
+        if task.get("auto"):
+            row["canny_low"], row["canny_high"] = auto_canny_thresholds(threshold_histograms(gray, roi), task["auto"])
+        edges_np = canny_edges(gray, row["canny_low"], row["canny_high"], roi)
+
+        stem = task.get("stem") or os.path.splitext(os.path.basename(path))[0]
+        outputs = [os.path.join(task["out_dir"], f"{stem}_edges.png")]
+        Image.fromarray(edges_np).save(outputs[0])
+        if task["save_filtered"]:
+            outputs.append(os.path.join(task["out_dir"], f"{stem}_canny.png"))
+            render_canny_result(img_rgba, edges_np, roi).save(outputs[-1])
+
+        edge_pixels = int(np.count_nonzero(edges_np))
+        row.update(edge_pixels=edge_pixels, edge_density=round(edge_pixels / edges_np.size, 6),
+                   outputs=";".join(outputs))
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["seconds"] = round(time.perf_counter() - start, 4)
+    return row
+
+
+def run_batch(args):
+    """Runs the headless batch analysis described by the parsed CLI args. Returns a process exit code."""
+    image_paths = expand_inputs(args.batch)
+    if not image_paths:
+        print("No images matched the batch input.")
+        return 1
+    try:
+        pipeline = load_filter_pipeline(args.pipeline) if args.pipeline else []
+    except (OSError, ValueError) as e:
+        print(f"Invalid --pipeline: {e}")
+        return 2
+    os.makedirs(args.out, exist_ok=True)
+    low, high = args.canny
+    tasks = [{"path": p, "stem": stem, "out_dir": args.out, "low": low, "high": high, "roi": args.roi,
+              "save_filtered": args.save_filtered, "pipeline": pipeline, "auto": args.auto_canny,
+              "max_pixels": int(args.max_megapixels * 1e6) if args.max_megapixels else None}
+             for p, stem in zip(image_paths, unique_output_stems(image_paths))]
+
+    workers = args.workers or os.cpu_count() or 1
+    print(f"Batch: {len(tasks)} image(s), Canny {'auto (' + args.auto_canny + ')' if args.auto_canny else f'{low}/{high}'}"
+          f"{' ROI ' + str(tuple(args.roi)) if args.roi else ''}"
+          f"{' after ' + ' > '.join(stage['name'] for stage in pipeline) if pipeline else ''}, {workers} worker(s)")
+
+    rows = []
+    started = time.perf_counter()
+    for row in run_in_pool(batch_process_image, tasks, workers, args.tasks_per_worker):
+        rows.append(row)
+        name = os.path.basename(row["file"])
+        if row["error"]:
+            print(f"[{len(rows)}/{len(tasks)}] {name}: FAILED {row['error']}")
+        else:
+            print(f"[{len(rows)}/{len(tasks)}] {name}: {row['edge_density']:.2%} edge pixels ({row['seconds']:.2f}s)")
+
+    elapsed = time.perf_counter() - started
+    rows.sort(key=lambda r: r["file"])
+    failed = sum(1 for r in rows if r["error"])
+    report_base = os.path.join(args.out, "batch_summary")
+    write_batch_report(report_base, rows, {
+        "canny_low": low, "canny_high": high, "auto_canny": args.auto_canny, "roi": args.roi, "filter_pipeline": pipeline,
+        "images": len(rows), "failed": failed,
+        "elapsed_s": round(elapsed, 3), "images_per_s": round(len(rows) / elapsed, 3) if elapsed else None})
+    print(f"Done: {len(rows) - failed} ok, {failed} failed in {elapsed:.1f}s. Report: {report_base}.csv/.json")
+    return 1 if failed else 0
+
+
+def parse_encoder_options(options):
+    """Parses KEY=VALUE encoder options, converting ints, floats and booleans."""
+    parsed = {}
+    for option in options or []:
+        key, sep, value = option.partition("=")
+        if not sep or not key:
+            raise ValueError(f"Encoder option '{option}' must be KEY=VALUE")
+        if value.lower() in ("true", "false"):
+            parsed[key] = value.lower() == "true"
+        else:
+            try:
+                parsed[key] = int(value)
+            except ValueError:
+                try:
+                    parsed[key] = float(value)
+                except ValueError:
+                    parsed[key] = value
+    return parsed
+
+
+def batch_export_annotated(task):
+    """Worker: redraws one saved analysis onto its source image and encodes it. Returns a summary row."""
+    path = task["path"]
+    row = {"file": path, "source_image": "", "output": "", "primitives": None, "bytes": None, "seconds": None, "error": ""}
+    start = time.perf_counter()
+    try:
+        data = load_analysis_file(path)
+        source = resolve_source_image(path, data["metadata"])
+        if not source:
+            raise FileNotFoundError("Source image not found")
+        row["source_image"] = source
+
+        geometry = analysis_overlay_geometry(data)
+        primitives = build_overlay_primitives(**geometry)
+        ext = task["ext"]
+        stem = os.path.splitext(os.path.basename(source))[0]
+        analysis_stem = os.path.splitext(os.path.basename(path))[0]
+        suffix = "overlay" if ext in VECTOR_EXPORT_FORMATS else "annotated"
+        out_path = os.path.join(task["out_dir"], f"{stem}__{analysis_stem}_{suffix}{ext}")
+
+        tile_source = open_tile_source(source) if ext in STREAMING_EXPORT_FORMATS else None
+        if ext in VECTOR_EXPORT_FORMATS:
+            with Image.open(source) as img_file: # Reads the header only
+                size = img_file.size
+            write_overlay_export(out_path, geometry, size, source)
+        elif tile_source and (task["tile_size"] or tile_source.size[0] * tile_source.size[1] >= STREAMING_EXPORT_MIN_PIXELS):
+            export_annotated_streaming(out_path, tile_source, primitives, task["tile_size"] or EXPORT_TILE_SIZE)
+        else:
+            with Image.open(source) as img_file:
+                img = img_file.convert("RGBA")
+            draw_overlay_primitives(ImageDraw.Draw(img), primitives)
+            prepare_for_format(img, ext).save(out_path, **task["encoder"])
+        row.update(output=out_path, primitives=len(primitives), bytes=os.path.getsize(out_path))
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    row["seconds"] = round(time.perf_counter() - start, 4)
+    return row
+
+
+def run_export_batch(args):
+    """Re-renders annotated images for a set of analysis JSON files. Returns a process exit code."""
+    analysis_paths = expand_inputs(args.export_annotated, (".json",))
+    if not analysis_paths:
+        print("No analysis JSON files matched the input.")
+        return 1
+    ext = "." + args.format.lower().lstrip(".")
+    if ext not in EXPORT_ENCODER_SETTINGS and ext not in VECTOR_EXPORT_FORMATS:
+        print(f"Unsupported export format '{args.format}'.")
+        return 1
+    try:
+        encoder = dict(EXPORT_ENCODER_SETTINGS.get(ext, {}), **parse_encoder_options(args.encoder))
+    except ValueError as e:
+        print(e)
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+    tasks = [{"path": p, "out_dir": args.out, "ext": ext, "encoder": encoder, "tile_size": args.tile_size} for p in analysis_paths]
+
+    workers = args.workers or os.cpu_count() or 1
+    print(f"Export: {len(tasks)} analysis file(s) -> {ext} {encoder}, {workers} worker(s)")
+    rows = []
+    total_bytes = 0
+    started = time.perf_counter()
+    for row in run_in_pool(batch_export_annotated, tasks, workers, args.tasks_per_worker):
+        rows.append(row)
+        elapsed = time.perf_counter() - started
+        name = os.path.basename(row["file"])
+        if row["error"]:
+            print(f"[{len(rows)}/{len(tasks)}] {name}: FAILED {row['error']}")
+        else:
+            total_bytes += row["bytes"]
+            print(f"[{len(rows)}/{len(tasks)}] {name}: {row['bytes'] / 1e6:.1f} MB in {row['seconds']:.2f}s"
+                  f" | {len(rows) / elapsed:.1f} img/s, {total_bytes / 1e6 / elapsed:.1f} MB/s")
+
+    elapsed = time.perf_counter() - started
+    rows.sort(key=lambda r: r["file"])
+    failed = sum(1 for r in rows if r["error"])
+    report_base = os.path.join(args.out, "export_summary")
+    write_batch_report(report_base, rows, {
+        "format": ext, "encoder": encoder, "files": len(rows), "failed": failed, "elapsed_s": round(elapsed, 3),
+        "images_per_s": round(len(rows) / elapsed, 3) if elapsed else None, "bytes_written": total_bytes})
+    print(f"Done: {len(rows) - failed} ok, {failed} failed in {elapsed:.1f}s. Report: {report_base}.csv/.json")
+    return 1 if failed else 0
+
+
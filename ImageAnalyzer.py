@@ -12,6 +12,8 @@
 # This project was developed under the supervision of Chen Giladi as part of
 # thesis work at [Sami-Shamoon college of Engineering (SCE),Isreal].
 # -----------------------------------------------------------------------------
+import time
+_PROCESS_START = time.perf_counter() # Reference point for --profile-startup
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog, Toplevel
 from tkinter.ttk import Scrollbar, Treeview
@@ -20,12 +22,408 @@ import os
 import math
 import json
 import datetime
-import cv2 
-import numpy as np 
 import traceback 
+import threading
+import queue
+import re
+import sys
+import argparse
+import zlib
+import shutil
+import tempfile
+import signal
+from collections import deque, OrderedDict
+from AnalysisCore import (
+    STARTUP_PROFILE, LazyModule, preload_heavy_modules, PerfStats, timed_stage, TRACE, traced, MemoryBudget, image_nbytes, physical_memory_bytes, IMAGE_EXTENSIONS,
+    RESAMPLING_PRESETS, DEFAULT_RESAMPLING_PRESET, resample_region,
+    FilterPipeline, FILTER_STAGES, AUTO_CANNY_METHODS, threshold_histograms, auto_canny_thresholds,
+    sweep_source, canny_sweep, render_contact_sheet, sweep_label,
+    IntensityIntegrals, region_extrema, measurement_intensity_stats, POINT_STATS_RADIUS,
+    line_profile, export_line_profile, clean_measurement,
+    to_gray_array, canny_edges, canny_edges_tiled, TILED_CANNY_MIN_PIXELS, render_canny_result, clamp_roi,
+    sample_line_profiles, locate_vessel_walls, PointGridIndex,
+    artery_measurement, angle_at_vertex, calibration_measurement, line_mode_measurement,
+    build_analysis_data, load_analysis_file, resolve_source_image,
+    overlay_points_from_measurements, build_overlay_primitives, draw_overlay_primitives,
+    prepare_for_format, EXPORT_ENCODER_SETTINGS, write_overlay_export,
+    STREAMING_EXPORT_FORMATS, STREAMING_EXPORT_MIN_PIXELS, PILTileSource, export_annotated_streaming,
+    run_batch, run_export_batch,
+)
+
+cv2 = LazyModule("cv2", "cv2", globals())
+np = LazyModule("numpy", "np", globals())
+tifffile = LazyModule("tifffile", "tifffile", globals(), optional=True)
+
+
+# --- Session Journal ---
+JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".image_analyzer", "journal")
+
+
+# --- Trace Dumps ---
+TRACE_DIR = os.path.join(os.path.expanduser("~"), ".image_analyzer", "traces")
+TRACE_DUMP_SECONDS = 30 # Default window written by "Dump Trace..." and SIGUSR1
+
+
+def _json_default(value):
+    """json.dump fallback for NumPy scalars/arrays that end up in measurement dicts."""
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+class SessionJournal:
+    """Append-only JSONL journal of measurement and calibration events.
+
+    record() only queues a dict, so the UI thread never touches the disk. A background
+    thread encodes queued records in batches, then flushes and fsyncs once per batch.
+    close() writes a 'session_end' record and renames the file to *.jsonl.closed.
+    """
+    FLUSH_INTERVAL = 0.5 # Seconds to collect records into one batch
+    MAX_BATCH = 512
+    RATE_WINDOW = 10.0 # Seconds of history used for the write rate
+    KEEP_CLOSED = 20 # Closed journals kept for manual recovery
+
+    def __init__(self, directory=JOURNAL_DIR):
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        self.directory = directory
+        self.path = os.path.join(directory, f"session_{stamp}_{os.getpid()}.jsonl")
+        self.records_written = 0
+        self.bytes_written = 0
+        self.last_error = None
+        self._queue = queue.Queue()
+        self._closing = threading.Event()
+        self._recent = deque() # (timestamp, record_count) per written batch
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._writer_loop, name="SessionJournal", daemon=True)
+        self._thread.start()
+        self.record("session_start", pid=os.getpid())
+
+    def record(self, event, **data):
+        """Queues one event record. Cheap enough to call on every click."""
+        data["event"] = event
+        data["t"] = time.time()
+        self._queue.put(data)
+
+    def _writer_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            # Give the UI a moment to produce more records so they share one fsync
+            if batch[0] is not None:
+                self._closing.wait(self.FLUSH_INTERVAL)
+            try:
+                while len(batch) < self.MAX_BATCH:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            records = [r for r in batch if r is not None]
+            if records:
+                try:
+                    chunk = "".join(json.dumps(r, default=_json_default) + "\n" for r in records)
+                    self._file.write(chunk)
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self.records_written += len(records)
+                    self.bytes_written += len(chunk)
+                    self._recent.append((time.monotonic(), len(records)))
+                except Exception as e:
+                    self.last_error = str(e)
+                    print(f"Journal write error: {e}")
+            if len(records) != len(batch): # None sentinel -> shut down
+                return
+
+    def stats(self):
+        """Returns write counters, the recent write rate (records/s) and the queued backlog."""
+        now = time.monotonic()
+        while self._recent and now - self._recent[0][0] > self.RATE_WINDOW:
+            self._recent.popleft()
+        recent = list(self._recent)
+        return {
+            "records_written": self.records_written,
+            "bytes_written": self.bytes_written,
+            "rate_per_sec": sum(count for _, count in recent) / self.RATE_WINDOW,
+            "backlog": self._queue.qsize(),
+            "last_error": self.last_error,
+        }
+
+    def close(self):
+        """Writes the remaining backlog and a session_end record, then marks the journal closed."""
+        self.record("session_end")
+        self._queue.put(None)
+        self._closing.set()
+        self._thread.join(timeout=5.0)
+        try:
+            self._file.close()
+            os.replace(self.path, self.path + ".closed")
+        except OSError as e:
+            print(f"Could not close journal: {e}")
+        self._prune_closed()
+
+    def _prune_closed(self):
+        try:
+            closed = sorted(f for f in os.listdir(self.directory) if f.endswith(".jsonl.closed"))
+            for name in closed[:-self.KEEP_CLOSED]:
+                os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+
+def scan_journal(path):
+    """Replays a journal file into per-image state.
+
+    Returns a dict with 'states' (image path -> {"measurements": [...], "calibration": {...} or None}),
+    'last_image', 'unsaved' (work recorded after the last save) and 'clean_end'.
+    A torn last line from a crash mid-write is skipped.
+    """
+    states = {}
+    current = None
+    unsaved = False
+    clean_end = False
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            event = rec.get("event")
+            if event == "session_end":
+                clean_end = True
+            elif event == "image":
+                current = rec.get("path")
+                states[current] = {"measurements": [], "calibration": None}
+            elif event == "saved":
+                unsaved = False
+            elif current is None:
+                continue
+            elif event == "measurement":
+                states[current]["measurements"].append(rec.get("measurement"))
+                unsaved = True
+            elif event == "measurements":
+                states[current]["measurements"] = list(rec.get("measurements") or [])
+                unsaved = unsaved or bool(states[current]["measurements"])
+            elif event == "calibration":
+                states[current]["calibration"] = {k: rec.get(k) for k in ("done", "factor", "dots")}
+                unsaved = unsaved or bool(rec.get("done"))
+    return {"states": states, "last_image": current, "unsaved": unsaved, "clean_end": clean_end}
+
+
+def find_recoverable_journals(directory=JOURNAL_DIR, exclude=None):
+    """Lists journals left open by a crashed session that contain unsaved work (newest first)."""
+    found = []
+    try:
+        names = sorted((f for f in os.listdir(directory) if f.startswith("session_") and f.endswith(".jsonl")), reverse=True)
+    except OSError:
+        return found
+    for name in names:
+        path = os.path.join(directory, name)
+        if exclude and os.path.abspath(path) == os.path.abspath(exclude):
+            continue
+        # Skip journals of other instances that are still running (POSIX only, os.kill(pid, 0) is a kill on Windows)
+        if os.name == "posix":
+            try:
+                os.kill(int(name.rsplit("_", 1)[1].split(".")[0]), 0)
+                continue
+            except (ValueError, IndexError, ProcessLookupError):
+                pass
+            except OSError:
+                continue # Process exists but belongs to someone else
+        try:
+            summary = scan_journal(path)
+        except OSError:
+            continue
+        if summary["unsaved"] and not summary["clean_end"]:
+            found.append((path, summary))
+    return found
+
+
+# --- Per-Image Sessions ---
+def image_series_key(file_path):
+    """Groups images of one acquisition series: 'vessel_012.tif' and 'vessel_013.tif' -> ('vessel', '.tif')."""
+    stem, ext = os.path.splitext(os.path.basename(file_path))
+    return (re.sub(r"[\d_\-. ]+$", "", stem).lower(), ext.lower())
+
+
+class ImageSessionStore:
+    """Maps image path -> analysis state, kept as zlib-compressed JSON.
+
+    Once the compressed states exceed memory_budget bytes, the least recently used
+    ones are spilled to a temp directory and read back transparently by get().
+    """
+    def __init__(self, memory_budget=8 * 1024 * 1024):
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict() # path -> bytes (in memory) or str (spill file path)
+        self._memory_bytes = 0
+        self._spill_dir = None
+
+    def put(self, image_path, state):
+        self.discard(image_path)
+        blob = zlib.compress(json.dumps(state, default=_json_default).encode("utf-8"), 6)
+        self._entries[image_path] = blob
+        self._memory_bytes += len(blob)
+        self._spill_over_budget()
+
+    def get(self, image_path):
+        """Returns the stored state for image_path (or None) and marks it most recently used."""
+        entry = self._entries.get(image_path)
+        if entry is None:
+            return None
+        self._entries.move_to_end(image_path)
+        if isinstance(entry, str): # Spilled to disk
+            try:
+                with open(entry, "rb") as f:
+                    entry = f.read()
+            except OSError as e:
+                print(f"Could not read spilled session for {image_path}: {e}")
+                return None
+        return json.loads(zlib.decompress(entry).decode("utf-8"))
+
+    def discard(self, image_path):
+        entry = self._entries.pop(image_path, None)
+        if isinstance(entry, bytes):
+            self._memory_bytes -= len(entry)
+        elif isinstance(entry, str):
+            try: os.remove(entry)
+            except OSError: pass
+
+    def memory_bytes(self):
+        return self._memory_bytes
+
+    def spill(self, target_bytes=0):
+        """Moves least recently used in-memory states to disk until at most target_bytes stay in memory."""
+        for image_path, entry in list(self._entries.items()):
+            if self._memory_bytes <= target_bytes:
+                break
+            if not isinstance(entry, bytes):
+                continue
+            try:
+                if self._spill_dir is None:
+                    self._spill_dir = tempfile.mkdtemp(prefix="image_analyzer_sessions_")
+                spill_path = os.path.join(self._spill_dir, f"{len(os.listdir(self._spill_dir))}_{zlib.crc32(image_path.encode('utf-8')):08x}.bin")
+                with open(spill_path, "wb") as f:
+                    f.write(entry)
+            except OSError as e:
+                print(f"Could not spill session state to disk: {e}")
+                return
+            self._entries[image_path] = spill_path
+            self._memory_bytes -= len(entry)
+
+    def _spill_over_budget(self):
+        if self._memory_bytes > self.memory_budget:
+            self.spill(self.memory_budget // 2) # Spill in chunks, not on every put
+
+    def __contains__(self, image_path):
+        return image_path in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        if self._spill_dir:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+        self._entries.clear()
+        self._memory_bytes = 0
+
+
+# --- Stall Watchdog ---
+STALL_LOG = os.path.join(os.path.expanduser("~"), ".image_analyzer", "stalls.log")
+
+
+class StallWatchdog:
+    """Detects a blocked Tk event loop and logs where the main thread is stuck.
+
+    The GUI calls beat() from an `after` callback every HEARTBEAT_MS. A daemon thread checks
+    the age of the last beat; once it exceeds `threshold_s`, the main thread's stack is taken
+    from sys._current_frames() together with context() (mode flags, zoom, image size) and logged.
+    A long stall is sampled again every threshold_s (up to MAX_SAMPLES), and its total duration
+    is logged when the loop comes back.
+    """
+    HEARTBEAT_MS = 100
+    MAX_SAMPLES = 5
+
+    def __init__(self, threshold_s=2.0, context=None, log_path=STALL_LOG):
+        self.threshold_s = threshold_s
+        self.context = context or (lambda: {})
+        self.log_path = log_path
+        self.stall_count = 0
+        self._main_ident = threading.main_thread().ident
+        self._last_beat = time.monotonic()
+        self._stall_samples = 0 # Samples taken during the current stall
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch_loop, name="StallWatchdog", daemon=True)
+        self._thread.start()
+
+    def beat(self):
+        """Called on the Tk main loop; ends (and reports the length of) a stall in progress."""
+        now = time.monotonic()
+        if self._stall_samples:
+            self._log(f"Stall ended after {now - self._last_beat:.2f} s")
+            self._stall_samples = 0
+        self._last_beat = now
+
+    def _watch_loop(self):
+        interval = min(0.25, self.threshold_s / 4)
+        while not self._stop.wait(interval):
+            blocked_s = time.monotonic() - self._last_beat
+            if blocked_s < self.threshold_s * (self._stall_samples + 1) or self._stall_samples >= self.MAX_SAMPLES:
+                continue
+            if not self._stall_samples:
+                self.stall_count += 1
+            self._stall_samples += 1
+            self._report(blocked_s)
+
+    def _report(self, blocked_s):
+        frame = sys._current_frames().get(self._main_ident)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "  <main thread stack unavailable>\n"
+        try:
+            context = self.context()
+        except Exception as e: # Best effort: the main thread may be mid-update
+            context = {"context_error": str(e)}
+        details = ", ".join(f"{key}={value}" for key, value in context.items())
+        self._log(f"Main thread blocked for {blocked_s:.2f} s (stall #{self.stall_count}, sample {self._stall_samples})\n"
+                  f"  {details}\n{stack}")
+
+    def _log(self, message):
+        line = f"[{datetime.datetime.now().isoformat(timespec='milliseconds')}] {message}"
+        print(line.rstrip())
+        try:
+            os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line if line.endswith("\n") else line + "\n")
+        except OSError:
+            pass
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Image Analyzer. Without --batch the GUI is started.")
+    parser.add_argument("--profile-startup", action="store_true", help="Print a per-phase startup timing breakdown.")
+    parser.add_argument("--memory-budget", type=float, metavar="MB", help="Byte budget for images, caches and undo history (default: 1/4 of RAM).")
+    parser.add_argument("--trace", action="store_true", help="Record trace spans from the start (dump with 'Dump Trace...' or SIGUSR1).")
+    batch = parser.add_argument_group("headless batch analysis")
+    batch.add_argument("--batch", nargs="+", metavar="INPUT", help="Image folder(s) or glob pattern(s) to process without the GUI.")
+    batch.add_argument("--export-annotated", nargs="+", metavar="ANALYSIS", help="Analysis JSON file(s), folder(s) or glob(s) to re-render as annotated images.")
+    batch.add_argument("--out", default="batch_output", help="Output folder for results and the summary report.")
+    batch.add_argument("--canny", nargs=2, type=int, default=[100, 200], metavar=("LOW", "HIGH"), help="Canny thresholds (default 100 200).")
+    batch.add_argument("--roi", nargs=4, type=int, metavar=("X1", "Y1", "X2", "Y2"), help="Apply Canny only inside this ROI (image coords).")
+    batch.add_argument("--auto-canny", choices=AUTO_CANNY_METHODS, help="Pick Canny thresholds per image (median or otsu) instead of --canny.")
+    batch.add_argument("--pipeline", metavar="JSON", help="Preprocess with the filter pipeline saved in this analysis JSON (or a JSON list of stages).")
+    batch.add_argument("--save-filtered", action="store_true", help="Also write the filtered image as shown in the GUI.")
+    batch.add_argument("--workers", type=int, help="Worker processes (default: CPU count).")
+    batch.add_argument("--tasks-per-worker", type=int, default=20, help="Restart a worker after this many images to bound its memory.")
+    batch.add_argument("--max-megapixels", type=float, help="Skip images larger than this.")
+    batch.add_argument("--format", default="png", help="Annotated export format: png, jpg, tif or bmp (default png); svg or json write the overlay only.")
+    batch.add_argument("--encoder", nargs="+", metavar="KEY=VALUE", help="Encoder settings for --format, e.g. quality=90 or compress_level=1.")
+    batch.add_argument("--tile-size", type=int, help="Stream png/tif exports tile by tile with this tile size (automatic above 64 MP). Bounds the output side only; inputs other than .npy and uncompressed TIFF are still decoded in full.")
+    return parser
+
 
 class ImageAnalyzer:
-    def __init__(self, root):
+    def __init__(self, root, memory_budget_mb=None):
         self.root = root
         self.root.title("Image Analyzer")
         self.root.geometry("1400x900") # Increased default height slightly
@@ -33,6 +431,18 @@ class ImageAnalyzer:
         self.ZOOM_BOX_SIZE = 180
         self.ZOOM_BOX_FACTOR = 4
         # Position is now relative to image_frame, set in toggle_zoom_box
+        self.EDGE_SNAP_RADIUS = 15 # Max snap distance in screen pixels
+        self.AUTO_DIAMETER_SAMPLES_PER_PX = 4 # Profile sampling density for Auto Ø
+        self.POINT_HIT_RADIUS = 8 # Grab distance for Edit Points mode in screen pixels
+        self.STALL_THRESHOLD_S = 2.0 # Event loop blocked this long -> log the main thread stack
+        self.MIN_UNDO_STATES = 5 # Undo steps kept even when over the memory budget
+        # Point lists that can be edited, by key prefix used in the spatial index
+        self.POINT_SOURCES = {
+            "calibration": "calibration_dots",
+            "artery": "artery_dots",
+            "line": "line_points",
+            "angle": "angle_points",
+        }
 
         self.file_path = None
         self.image_files = []
@@ -40,8 +450,38 @@ class ImageAnalyzer:
         self.zoom_factor = 1.0 # Start at 1.0 zoom
         self.img_original = None
         self.img_filtered = None # Will hold filtered image if any filter is applied
-        self.photo = None # Reference to PhotoImage for main canvas
-        self.zoom_box_photo = None # Reference to PhotoImage for zoom box
+        self.photo = None # Viewport-sized PhotoImage for the main canvas, reused across renders
+        self.zoom_box_photo = None # Reference to PhotoImage for zoom box (fixed size, reused)
+        self.resampling_preset = tk.StringVar(value=DEFAULT_RESAMPLING_PRESET) # Display quality/speed, see RESAMPLING_PRESETS
+        self.resampling_preset.trace_add("write", lambda *args: self.display_image())
+        self._display_array = None # Array of _display_array_src for the cv2 resampling backend
+        self._display_array_src = None
+        self.img_gray_np = None # Cached grayscale array of img_original (built on demand)
+        self.intensity_integrals = None # Summed-area tables of img_gray_np for O(1) ROI stats (built in the background)
+        self._integrals_generation = 0 # Bumped per image; a build for an older image is dropped
+        self._integrals_building = False
+        self._roi_stats_key = None # (ROI, with extrema) the stats panel currently shows
+
+        # --- Edge Map / Snap Cache ---
+        self.edge_map = None # Last Canny result as uint8 array (image coords, ROI-sized for ROI Canny)
+        self.edge_map_origin = (0, 0) # Top-left of edge_map in original image coords
+        self.edge_map_key = None # (scope, low, high, roi) the edge map was computed for
+        self.edge_snap_index = None # (distances, labels, edge_xs, edge_ys) nearest-edge lookup
+        self.edge_snap_key = None # edge_map_key the snap index was built from
+        self._canny_generation = 0 # Bumped by every filter pass; tiled Canny results of older passes are dropped
+        self._canny_results = queue.Queue() # (generation, kind, payload) from the tiled Canny thread
+        self.filter_pipeline = FilterPipeline() # Preprocessing stages run on the gray array before Canny
+        self.pipeline_window = None
+        self.sweep_window = None
+        self.profile_window = None
+        self.profile_segment = tk.StringVar(value="")
+        self.profile_width = tk.IntVar(value=1) # Parallel lines averaged across the segment
+        for var in (self.profile_segment, self.profile_width):
+            var.trace_add("write", lambda *args: self._refresh_line_profile())
+        self._sweep_generation = 0 # Bumped by every sweep run; results of older runs are dropped
+        self.auto_canny_method = tk.StringVar(value=AUTO_CANNY_METHODS[0])
+        self.auto_canny_on_load = tk.BooleanVar(value=False) # Suggest thresholds for every newly opened image
+        self._histogram_cache = OrderedDict() # (image path, ROI, pipeline) -> threshold_histograms(), LRU
 
         self.calibration_dots = []
         self.artery_dots = []
@@ -52,6 +492,21 @@ class ImageAnalyzer:
         self.calibration_factor = 1.0
         self.calibration_done = False
         self.angle_points = []
+        self.auto_diameter_points = [] # Pending clicks for Auto Ø cross-line / centerline
+        self.auto_centerline_count = 10 # Last used number of cross-sections
+        self.auto_centerline_half_length = 30.0 # Last used cross-line half-length (px)
+        self.point_index = None # PointGridIndex over all editable points (built on demand)
+        self.point_index_signature = None # (id, len) of each point list when the index was built
+        self.selected_point = None # (source, index) key of the point selected in Edit Points mode
+        self.dragging_point = False
+        self.drag_dependents = None # Measurement affected by the point being dragged
+        self.drag_moved = False # Undo state is saved on the first real movement, not on selection
+        self.overlay_export_path = None # Last SVG/JSON overlay export of the current image (for quick re-export)
+        self.perf = PerfStats() # Per-stage render timings shown by the performance HUD
+        self.perf_hud_active = False
+        self._perf_hud_job = None
+        if hasattr(signal, "SIGUSR1"): # POSIX: `kill -USR1 <pid>` dumps the trace without touching the UI
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.root.after_idle(self.dump_trace_to_default))
 
         # --- Mode Flags ---
         self.edge_detection_active = False # Legacy FIND_EDGES filter flag
@@ -63,6 +518,10 @@ class ImageAnalyzer:
         self.artery_mode = False
         self.angle_mode = False
         self.line_mode = False  # New Line Mode
+        self.auto_diameter_mode = False # Auto Ø from a single cross-line
+        self.auto_centerline_mode = False # Auto Ø at N cross-sections along a centerline
+        self.edit_points_mode = False # Select, drag and delete existing points
+        self.edge_snap_active = False # Snap Dots/Line/Angle clicks to nearest Canny edge
 
         # --- Selection Rectangles ---
         self.selection_rect = None # For FIND_EDGES ROI
@@ -82,6 +541,7 @@ class ImageAnalyzer:
         self.measurement = tk.StringVar(value="Distance: ")
         self.name_var = tk.StringVar(value="")
         self.diameter_var = tk.StringVar(value="")
+        self.auto_diameter_method = tk.StringVar(value="gradient") # Wall detection: "gradient" or "fwhm"
         # --- IntVars for Canny Thresholds ---
         self.canny_low = tk.IntVar(value=100)
         self.canny_high = tk.IntVar(value=200)
@@ -93,8 +553,66 @@ class ImageAnalyzer:
         self.measurement_table = None
         self.image_frame = None # Initialize image_frame attribute
 
-        self.create_gui()
+        # --- Per-Image Sessions ---
+        self.image_sessions = ImageSessionStore() # Survives folder navigation
+        self.carry_calibration = tk.BooleanVar(value=False) # Carry calibration to the next image of a series
+        self._suppress_filter_trace = False # Set while restoring thresholds to avoid one filter pass per slider
+
+        # --- Session Journal (autosave) ---
+        self.journal_info = tk.StringVar(value="Journal: OFF")
+        self.journal = None # Started once the window is up, see _start_optional_subsystems
+        self.watchdog = None
+
+        # --- Memory Budget ---
+        # Default: a quarter of the installed RAM. Evicted first: session states (spilled to disk),
+        # then the oldest undo steps and redo steps (each holds a full image copy), then the
+        # recomputable gray/edge caches one at a time, and last the ROI statistics tables
+        # (rebuilding those in the background is what we want to avoid).
+        budget_bytes = int(memory_budget_mb * 1024**2) if memory_budget_mb else physical_memory_bytes() // 4
+        self.memory = MemoryBudget(budget_bytes)
+        self.memory.register("image", lambda: image_nbytes(self.img_original) + image_nbytes(self.img_filtered))
+        self.memory.register("display", self._display_nbytes)
+        self.memory.register("cache", self._cache_nbytes, self._evict_caches, priority=2)
+        self.memory.register("sessions", self.image_sessions.memory_bytes, self._evict_sessions, priority=0)
+        self.memory.register("undo", self._history_nbytes, self._evict_history, priority=1)
+        self._pinned_caches = () # Cache names _evict_caches must keep (the one whose build triggered enforcement)
+        self.memory.register("stats", lambda: self.intensity_integrals.nbytes if self.intensity_integrals else 0,
+                             self._evict_integrals, priority=3)
+        self.memory_info = tk.StringVar(value="Mem: -")
+
+        with STARTUP_PROFILE.phase("create_gui"):
+            self.create_gui()
         self.bind_events()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after_idle(self._start_optional_subsystems)
+
+    def _start_optional_subsystems(self):
+        """Starts what the window does not need to be usable: the session journal and cv2/numpy preloading."""
+        self.root.update_idletasks()
+        STARTUP_PROFILE.mark("window mapped, interactive")
+        with STARTUP_PROFILE.phase("session journal"):
+            try:
+                self.journal = SessionJournal()
+            except OSError as e:
+                print(f"Session journal disabled: {e}")
+                self.journal = None
+        self.watchdog = StallWatchdog(self.STALL_THRESHOLD_S, context=self._stall_context)
+        self._update_memory_status()
+        self._watchdog_heartbeat()
+        if self.journal:
+            if self.measurements or self.calibration_done:
+                self._journal_snapshot() # Anything done before the journal started
+            self.root.after(2000, self._update_journal_status)
+            self.root.after(500, self._offer_journal_recovery)
+        preload = preload_heavy_modules()
+        if STARTUP_PROFILE.enabled:
+            def report_when_loaded():
+                if preload.is_alive():
+                    self.root.after(50, report_when_loaded)
+                else:
+                    STARTUP_PROFILE.mark("optional subsystems loaded")
+                    STARTUP_PROFILE.report()
+            report_when_loaded()
 
 
     def create_gui(self):
@@ -192,9 +710,14 @@ class ImageAnalyzer:
         self.pixel_label.pack(side=tk.LEFT, padx=10)
         self.measurement_label = tk.Label(self.status_frame, textvariable=self.measurement, bg="black", fg="white", anchor=tk.W)
         self.measurement_label.pack(side=tk.LEFT, padx=10)
+        self.journal_label = tk.Label(self.status_frame, textvariable=self.journal_info, bg="black", fg="gray70", anchor=tk.E)
+        self.journal_label.pack(side=tk.RIGHT, padx=5)
+        self.memory_label = tk.Label(self.status_frame, textvariable=self.memory_info, bg="black", fg="gray70", anchor=tk.E)
+        self.memory_label.pack(side=tk.RIGHT, padx=5)
         # --- End Status Bar ---
 
-        self.create_buttons() # Buttons are now created *after* button_frame exists
+        with STARTUP_PROFILE.phase("create_buttons"):
+            self.create_buttons() # Buttons are now created *after* button_frame exists
 
         # Bind mousewheel scrolling to the button canvas/frame
         # Bind directly to the canvas and frame where scrolling should happen
@@ -257,6 +780,14 @@ class ImageAnalyzer:
         self.buttons["Load Image"].pack(**pad_options)
         self.buttons["Export Image"] = tk.Button(file_frame, text="Export Image", command=self.export_annotated_image)
         self.buttons["Export Image"].pack(**pad_options)
+        self.buttons["Export Overlay"] = tk.Button(file_frame, text="Export Overlay (SVG/JSON)", command=self.export_overlay)
+        self.buttons["Export Overlay"].pack(**pad_options)
+        self.buttons["Re-export Overlay"] = tk.Button(file_frame, text="Re-export Overlay", command=lambda: self.export_overlay(reuse_path=True))
+        self.buttons["Re-export Overlay"].pack(**pad_options)
+        self.buttons["Open Analysis"] = tk.Button(file_frame, text="Open Analysis", command=self.open_analysis)
+        self.buttons["Open Analysis"].pack(**pad_options)
+        self.buttons["Recover Session"] = tk.Button(file_frame, text="Recover Session...", command=self.recover_session)
+        self.buttons["Recover Session"].pack(**pad_options)
 
         # --- Dots Mode ---
         artery_frame = tk.LabelFrame(self.button_frame, text="Dots Mode (Distance/Angle)", bd=2, relief=tk.GROOVE)
@@ -267,6 +798,14 @@ class ImageAnalyzer:
         self.buttons["Reset Artery"].pack(**pad_options)
         self.buttons["Delete Last Pair"] = tk.Button(artery_frame, text="Delete Last Pair", command=self.delete_last_pair)
         self.buttons["Delete Last Pair"].pack(**pad_options)
+        self.buttons["Auto Diameter"] = tk.Button(artery_frame, text="Auto Ø (Cross-Line)", command=self.toggle_auto_diameter_mode)
+        self.buttons["Auto Diameter"].pack(**pad_options)
+        self.buttons["Auto Centerline"] = tk.Button(artery_frame, text="Auto Ø (Centerline)", command=self.toggle_auto_centerline_mode)
+        self.buttons["Auto Centerline"].pack(**pad_options)
+        auto_method_frame = tk.Frame(artery_frame)
+        auto_method_frame.pack(fill=tk.X, padx=3, pady=1)
+        tk.Label(auto_method_frame, text="Walls:").pack(side=tk.LEFT, padx=(0,3))
+        tk.OptionMenu(auto_method_frame, self.auto_diameter_method, "gradient", "fwhm").pack(side=tk.LEFT, fill=tk.X, expand=True)
 
         # --- Calibration ---
         calib_frame = tk.LabelFrame(self.button_frame, text="Calibration", bd=2, relief=tk.GROOVE)
@@ -275,6 +814,8 @@ class ImageAnalyzer:
         self.buttons["Calibrate"].pack(**pad_options)
         self.buttons["Reset Calibration"] = tk.Button(calib_frame, text="Reset Calibration", command=self.reset_calibration)
         self.buttons["Reset Calibration"].pack(**pad_options)
+        tk.Checkbutton(calib_frame, text="Carry to next in series", variable=self.carry_calibration,
+                       anchor=tk.W).pack(**pad_options)
 
         # --- Angle Measurement ---
         angle_frame = tk.LabelFrame(self.button_frame, text="Angle Measurement", bd=2, relief=tk.GROOVE)
@@ -287,11 +828,21 @@ class ImageAnalyzer:
         line_frame.pack(fill=tk.X, padx=3, pady=3)
         self.buttons["Line Mode"] = tk.Button(line_frame, text="Line Mode", command=self.toggle_line_mode)
         self.buttons["Line Mode"].pack(**pad_options)
+        self.buttons["Line Profile"] = tk.Button(line_frame, text="Intensity Profile...", command=self.open_line_profile)
+        self.buttons["Line Profile"].pack(**pad_options)
         self.buttons["Reset Lines"] = tk.Button(line_frame, text="Reset Lines", command=self.reset_lines)
         self.buttons["Reset Lines"].pack(**pad_options)
         self.buttons["Show Line Measurements"] = tk.Button(line_frame, text="Show Line Measurements", command=self.show_line_measurements)
         self.buttons["Show Line Measurements"].pack(**pad_options)
 
+        # --- Edit Points ---
+        edit_frame = tk.LabelFrame(self.button_frame, text="Edit Points", bd=2, relief=tk.GROOVE)
+        edit_frame.pack(fill=tk.X, padx=3, pady=3)
+        self.buttons["Edit Points"] = tk.Button(edit_frame, text="Edit Points Mode", command=self.toggle_edit_points_mode)
+        self.buttons["Edit Points"].pack(**pad_options)
+        self.buttons["Delete Selected Point"] = tk.Button(edit_frame, text="Delete Selected (Del)", command=self.delete_selected_point)
+        self.buttons["Delete Selected Point"].pack(**pad_options)
+
         # --- Filters ---
         filter_frame = tk.LabelFrame(self.button_frame, text="Filters", bd=2, relief=tk.GROOVE)
         filter_frame.pack(fill=tk.X, padx=3, pady=3)
@@ -322,15 +873,53 @@ class ImageAnalyzer:
                                           variable=self.canny_high, length=140, showvalue=True)
         self.canny_high_slider.pack(side=tk.LEFT, fill=tk.X, expand=True)
 
+        auto_frame = tk.Frame(filter_frame)
+        auto_frame.pack(fill=tk.X, padx=3, pady=1)
+        self.buttons["Auto Thresholds"] = tk.Button(auto_frame, text="Auto Thresholds", command=self.apply_auto_thresholds)
+        self.buttons["Auto Thresholds"].pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.OptionMenu(auto_frame, self.auto_canny_method, *AUTO_CANNY_METHODS).pack(side=tk.LEFT)
+        tk.Checkbutton(filter_frame, text="Auto thresholds on open", variable=self.auto_canny_on_load).pack(anchor=tk.W, padx=3)
+
+        self.buttons["Threshold Sweep"] = tk.Button(filter_frame, text="Threshold Sweep...", command=self.open_canny_sweep)
+        self.buttons["Threshold Sweep"].pack(**pad_options)
+
+        self.buttons["Filter Pipeline"] = tk.Button(filter_frame, text="Filter Pipeline...", command=self.open_filter_pipeline)
+        self.buttons["Filter Pipeline"].pack(**pad_options)
+
         self.buttons["Reset Filters"] = tk.Button(filter_frame, text="Reset Filters", command=self.reset_filters)
         self.buttons["Reset Filters"].pack(**pad_options)
 
+        # --- Edge Snap ---
+        self.buttons["Snap to Edges"] = tk.Button(filter_frame, text="Snap Clicks to Edges", command=self.toggle_edge_snap)
+        self.buttons["Snap to Edges"].pack(**pad_options)
+
+        # --- ROI Statistics ---
+        stats_frame = tk.LabelFrame(self.button_frame, text="ROI Statistics", bd=2, relief=tk.GROOVE)
+        stats_frame.pack(fill=tk.X, padx=3, pady=3)
+        self.roi_stats_text = tk.StringVar(value="ROI: none selected")
+        self.cursor_stats_text = tk.StringVar(value="Cursor: -")
+        for var in (self.roi_stats_text, self.cursor_stats_text):
+            tk.Label(stats_frame, textvariable=var, anchor=tk.W, justify=tk.LEFT, wraplength=200).pack(fill=tk.X, padx=3)
+
 
         # --- Zoom ---
         zoom_frame = tk.LabelFrame(self.button_frame, text="Zoom", bd=2, relief=tk.GROOVE)
         zoom_frame.pack(fill=tk.X, padx=3, pady=3)
         self.buttons["Zoom In Box"] = tk.Button(zoom_frame, text="Zoom In Box", command=self.toggle_zoom_box)
         self.buttons["Zoom In Box"].pack(**pad_options)
+        resampling_frame = tk.Frame(zoom_frame)
+        resampling_frame.pack(fill=tk.X, padx=3, pady=1)
+        tk.Label(resampling_frame, text="Resampling:").pack(side=tk.LEFT, padx=(0,3))
+        tk.OptionMenu(resampling_frame, self.resampling_preset, *RESAMPLING_PRESETS).pack(side=tk.LEFT, fill=tk.X, expand=True)
+
+        # --- Diagnostics ---
+        diag_frame = tk.LabelFrame(self.button_frame, text="Diagnostics", bd=2, relief=tk.GROOVE)
+        diag_frame.pack(fill=tk.X, padx=3, pady=3)
+        self.buttons["Record Trace"] = tk.Button(diag_frame, text="Record Trace", command=self.toggle_trace,
+                                                 relief=tk.SUNKEN if TRACE.enabled else tk.RAISED)
+        self.buttons["Record Trace"].pack(**pad_options)
+        self.buttons["Dump Trace"] = tk.Button(diag_frame, text="Dump Trace...", command=self.dump_trace)
+        self.buttons["Dump Trace"].pack(**pad_options)
 
         # --- History ---
         history_frame = tk.LabelFrame(self.button_frame, text="History", bd=2, relief=tk.GROOVE)
@@ -387,6 +976,8 @@ class ImageAnalyzer:
         self.root.bind("<KeyPress-Left>", self.prev_image)
         self.root.bind("<Control-z>", self.undo)
         self.root.bind("<Control-y>", self.redo)
+        self.root.bind("<Delete>", self.delete_selected_point)
+        self.root.bind("<F3>", self.toggle_perf_hud)
         self.image_canvas.bind("<Motion>", self.update_zoom_box_and_pixel) # Combined update
 
         # Bind canvas resizing to update scroll region (Keep this)
@@ -427,16 +1018,12 @@ class ImageAnalyzer:
                 if i + 1 < len(self.artery_dots):
                     x1, y1 = self.artery_dots[i]
                     x2, y2 = self.artery_dots[i+1]
-                    dx = x2 - x1
-                    dy = y2 - y1
-                    dist_px = math.sqrt(dx**2 + dy**2)
-                    # Calculate angle relative to positive X-axis
-                    angle = math.degrees(math.atan2(-dy, dx)) # Use -dy because Y increases downwards
-                    if angle < 0: angle += 360 # Normalize to 0-360
+                    pair_meas = self._artery_measurement(self.artery_dots[i], self.artery_dots[i+1])
+                    dist_px, angle = pair_meas["distance_px"], pair_meas["angle_deg"]
 
                     text += f"  Pair {pair_count}: ({x1:.1f},{y1:.1f}) -> ({x2:.1f},{y2:.1f})\n"
                     if self.calibration_done:
-                        dist_mm = dist_px / self.calibration_factor
+                        dist_mm = pair_meas["distance_mm"]
                         text += f"    Dist: {dist_px:.2f}px = {dist_mm:.3f}mm | Angle: {angle:.1f}°\n"
                     else:
                         text += f"    Dist: {dist_px:.2f}px | Angle: {angle:.1f}° (Uncalibrated)\n"
@@ -473,6 +1060,18 @@ class ImageAnalyzer:
             self.zoom_factor = 1.0 # Reset zoom to 100%
         self._reset_all_modes()
         self.img_filtered = None
+        self.img_gray_np = None # New image -> rebuild gray cache on demand
+        self.intensity_integrals = None
+        self._integrals_generation += 1
+        self._integrals_building = False
+        self._roi_stats_key = None
+        self.filter_pipeline.clear_cache()
+        self._display_array = None
+        self._display_array_src = None
+        self.edge_map = None
+        self.edge_map_key = None
+        self.edge_snap_index = None
+        self.edge_snap_key = None
         self.calibration_dots = []
         self.artery_dots = []
         self.line_points = []
@@ -490,8 +1089,18 @@ class ImageAnalyzer:
         self.canny_start = None
         self.canny_end = None
         self.angle_points = []
+        self.auto_diameter_points = []
+        self.point_index = None
+        self.selected_point = None
+        self.dragging_point = False
+        self.drag_dependents = None
+        self.drag_moved = False
+        self.overlay_export_path = None
         self.photo = None # Clear image references
         self.zoom_box_photo = None
+        # Undo history belongs to the previous image (its own state lives in image_sessions)
+        self.undo_stack.clear()
+        self.redo_stack.clear()
 
         # Reset button states that might be sunken
         if "Zoom In Box" in self.buttons: self.buttons["Zoom In Box"].config(relief=tk.RAISED)
@@ -517,19 +1126,24 @@ class ImageAnalyzer:
         )
         if not file_path:
             return # User cancelled
+        self.open_image_path(file_path)
 
+    @traced("load image", "io")
+    def open_image_path(self, file_path):
+        """Opens the image at file_path and resets the state. Returns True on success."""
         try:
             # Check if it's a valid image file before proceeding
             img_test = Image.open(file_path)
             img_test.verify() # Verify checks integrity without loading full data
             img_test.close() # Close the test image
 
+            previous_session = self._stash_image_session()
             self.file_path = file_path
             folder = os.path.dirname(file_path)
             try:
                 self.image_files = sorted([
                     f for f in os.listdir(folder)
-                    if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff'))
+                    if f.lower().endswith(IMAGE_EXTENSIONS)
                        and os.path.isfile(os.path.join(folder, f)) # Ensure it's a file
                 ])
                 self.current_index = self.image_files.index(os.path.basename(file_path))
@@ -543,9 +1157,11 @@ class ImageAnalyzer:
 
 
             self.path_text.set(f"Path: {os.path.basename(file_path)}") # Show only filename
-            self.img_original = Image.open(file_path).convert("RGBA") # Convert to RGBA for consistency
+            with TRACE.span("decode", "io", path=os.path.basename(file_path)):
+                self.img_original = Image.open(file_path).convert("RGBA") # Convert to RGBA for consistency
+            self._journal_record("image", path=file_path)
             self.reset_image_state(reset_zoom=True) # Full reset for new image
-            self.display_image()
+            self._show_new_image(previous_session)
 
             # Keep zoom box state as it was (on or off)
             if self.zoom_box_mode and self.zoom_box:
@@ -556,7 +1172,7 @@ class ImageAnalyzer:
                       print(f"Error re-placing zoom box: {e}")
                       self.zoom_box_mode = False # Turn off if error
                       self.buttons["Zoom In Box"].config(relief=tk.RAISED)
-
+            return True
 
         except FileNotFoundError:
             messagebox.showerror("Error", f"File not found:\n{file_path}")
@@ -571,6 +1187,7 @@ class ImageAnalyzer:
             self.img_original = None
             self.reset_image_state(reset_zoom=True)
             self.display_image() # Display empty canvas
+        return False
 
 
     def change_image(self, direction):
@@ -605,13 +1222,15 @@ class ImageAnalyzer:
                 img_test.close()
 
                 # Successfully verified, load it
+                previous_session = self._stash_image_session()
                 self.current_index = next_idx # Update index only on success
                 self.file_path = new_file_path
                 self.path_text.set(f"Path: {new_file_name}")
                 self.img_original = Image.open(self.file_path).convert("RGBA") # Load and convert
-                # Reset state but keep zoom level
+                self._journal_record("image", path=self.file_path)
+                # Reset state but keep zoom level, then bring back this image's own state if we have it
                 self.reset_image_state(reset_zoom=False)
-                self.display_image()
+                self._show_new_image(previous_session)
                 # Update zoom box content if active
                 if self.zoom_box_mode and self.zoom_box:
                      self.update_zoom_box_content(None)
@@ -639,28 +1258,36 @@ class ImageAnalyzer:
         """Event handler for previous image."""
         self.change_image("previous")
 
+    @timed_stage("apply_filters_and_display", "filter")
     def apply_filters_and_display(self, *args):
         """Applies selected filters (Global Canny OR ROI Canny) and then calls display_image."""
         if not self.img_original:
             return
+        if args and self._suppress_filter_trace:
+            return # Slider set programmatically, caller applies once at the end
+
+        self._update_roi_stats(extrema=not self.canny_selection_mode)
 
-        # Start with the original image
-        img_to_process = self.img_original.copy()
+        # Start with the original image (filters copy it only when they draw onto it)
+        img_to_process = self.img_original
         filter_applied = False
         processed_image = None # Will hold the result of filtering
+        self._canny_generation += 1 # Supersedes a tiled Canny job that may still be running
 
         # --- Apply Global Canny FIRST ---
         if self.global_canny_active:
             try:
-                # Convert to grayscale numpy array
-                img_np_rgb = np.array(img_to_process.convert("RGB"))
-                img_np_gray = cv2.cvtColor(img_np_rgb, cv2.COLOR_RGB2GRAY)
+                key = self._edge_map_key()
+                cached = self.edge_map is not None and self.edge_map_key == key
+                if not cached and self.img_original.width * self.img_original.height >= TILED_CANNY_MIN_PIXELS:
+                    self._start_tiled_canny(key)
+                    return # Shown as results arrive, see _poll_tiled_canny
 
-                # Apply Canny
-                edges_np = cv2.Canny(img_np_gray, self.canny_low.get(), self.canny_high.get())
+                # Apply Canny on the cached grayscale array
+                edges_np = self._update_edge_map()
 
                 # Convert grayscale edges back to RGBA PIL Image
-                processed_image = Image.fromarray(edges_np).convert("RGBA")
+                processed_image = render_canny_result(img_to_process, edges_np)
                 filter_applied = True
                 # Update status only if slider change isn't causing it
                 if not args: # args is empty if called directly, not by slider trace
@@ -675,43 +1302,18 @@ class ImageAnalyzer:
 
         # --- Apply ROI Canny ONLY if Global is OFF and ROI is defined ---
         elif self.canny_start and self.canny_end:
-            # Make a copy to paste onto if applying ROI filter
-            processed_image = img_to_process.copy() # Start with original for ROI paste
-
-            # Convert canvas coords to original image coords
-            x1_orig = int(min(self.canny_start[0], self.canny_end[0]) / self.zoom_factor)
-            y1_orig = int(min(self.canny_start[1], self.canny_end[1]) / self.zoom_factor)
-            x2_orig = int(max(self.canny_start[0], self.canny_end[0]) / self.zoom_factor)
-            y2_orig = int(max(self.canny_start[1], self.canny_end[1]) / self.zoom_factor)
-
-            # Clamp coordinates to image bounds
-            x1_orig = max(0, x1_orig)
-            y1_orig = max(0, y1_orig)
-            x2_orig = min(img_to_process.width, x2_orig)
-            y2_orig = min(img_to_process.height, y2_orig)
-
-            if x2_orig > x1_orig and y2_orig > y1_orig: # Check for valid region
-                try:
-                    # Crop the region from the original image for processing
-                    cropped_pil = img_to_process.crop((x1_orig, y1_orig, x2_orig, y2_orig))
+            processed_image = img_to_process
 
-                    # Convert cropped PIL image to NumPy array -> Grayscale
-                    cropped_np_rgb = np.array(cropped_pil.convert("RGB"))
-                    cropped_np_gray = cv2.cvtColor(cropped_np_rgb, cv2.COLOR_RGB2GRAY)
+            # Convert canvas coords to clamped original image coords
+            roi = self._canny_roi_image_coords()
 
-                    # Apply Canny edge detection
-                    edges_np = cv2.Canny(cropped_np_gray, self.canny_low.get(), self.canny_high.get())
-
-                    # Create a mask from edges (white edges, black background)
-                    mask = Image.fromarray(edges_np).convert("L")
-
-                    # Create colored overlay (green edges)
-                    colored_edges = Image.new("RGBA", mask.size, (0, 255, 0, 255)) # Green edges
+            if roi: # Check for valid region
+                try:
+                    # Apply Canny edge detection to the ROI of the cached grayscale array
+                    edges_np = self._update_edge_map(roi)
 
-                    # Paste the colored edges onto the processed_image copy using the mask
-                    if processed_image.mode != 'RGBA':
-                         processed_image = processed_image.convert('RGBA')
-                    processed_image.paste(colored_edges, (x1_orig, y1_orig), mask=mask)
+                    # Paste green edges into the ROI of the original image
+                    processed_image = render_canny_result(img_to_process, edges_np, roi)
 
                     filter_applied = True
                     # Update status only if ROI selection isn't actively happening
@@ -721,7 +1323,7 @@ class ImageAnalyzer:
                 except Exception as e:
                     print(f"Error applying ROI Canny: {e}")
                     print(traceback.format_exc())
-                    # Keep processed_image as the original copy
+                    # Keep processed_image as the original
                     filter_applied = False
                     self.measurement.set("Status: Error applying ROI Canny.")
             else:
@@ -729,9 +1331,26 @@ class ImageAnalyzer:
                  processed_image = img_to_process
                  filter_applied = False
 
+        # --- Without Canny, show the preprocessing pipeline output ---
+        elif self.filter_pipeline:
+            try:
+                processed_image = Image.fromarray(self._get_filter_input()).convert("RGBA")
+                filter_applied = True
+                if not args:
+                    self.measurement.set(f"Status: Filter pipeline ({len(self.filter_pipeline.signature())} stage(s), "
+                                         f"{self.filter_pipeline.last_recomputed} recomputed).")
+            except Exception as e:
+                print(f"Error applying filter pipeline: {e}")
+                print(traceback.format_exc())
+                filter_applied = False
+                self.measurement.set(f"Status: Error in filter pipeline: {e}")
+
         # --- Update the filtered image attribute ---
         # If a filter was applied, store the result, otherwise clear img_filtered
         self.img_filtered = processed_image if filter_applied else None
+        if not filter_applied:
+            self.edge_map = None # No Canny result -> nothing to snap to
+            self.edge_map_key = None
 
         # --- Display Result ---
         self.display_image()
@@ -740,6 +1359,264 @@ class ImageAnalyzer:
             self.update_zoom_box_content(None)
 
 
+    def _visible_image_box(self):
+        """The part of the image visible on the canvas, as (x1, y1, x2, y2) image coords."""
+        return (self.image_canvas.canvasx(0) / self.zoom_factor,
+                self.image_canvas.canvasy(0) / self.zoom_factor,
+                self.image_canvas.canvasx(self.image_canvas.winfo_width()) / self.zoom_factor,
+                self.image_canvas.canvasy(self.image_canvas.winfo_height()) / self.zoom_factor)
+
+    def _start_tiled_canny(self, key):
+        """Runs global Canny for a large image on a background thread with the tiled engine.
+
+        Tiles in view are computed first and shown provisionally; the exact result replaces
+        them once all tiles are done. A newer filter pass bumps _canny_generation, which
+        cancels the job and makes the poller drop anything it still delivers.
+        """
+        generation = self._canny_generation
+        gray = self._get_filter_input()
+        view = self._visible_image_box() # Read here: Tk must only be used from this thread
+        low, high = key[1], key[2]
+        results = self._canny_results
+
+        def run():
+            try:
+                edges = canny_edges_tiled(
+                    gray, low, high, priority_box=view,
+                    on_priority_done=lambda box, block: results.put((generation, "partial", (box, block))),
+                    cancelled=lambda: generation != self._canny_generation)
+                if edges is not None:
+                    results.put((generation, "done", (key, edges)))
+            except Exception as e:
+                print(traceback.format_exc())
+                results.put((generation, "error", e))
+
+        self.measurement.set(f"Status: Global Canny: computing edges ({low}/{high})...")
+        threading.Thread(target=run, name="TiledCanny", daemon=True).start()
+        self.root.after(30, self._poll_tiled_canny, generation)
+
+    def _poll_tiled_canny(self, generation):
+        """Shows tiled Canny results of the current filter pass as they arrive."""
+        if generation != self._canny_generation or not self.root.winfo_exists():
+            return # Superseded; a newer pass has its own poller
+        try:
+            while True:
+                job_generation, kind, payload = self._canny_results.get_nowait()
+                if job_generation != generation:
+                    continue # Left over from a superseded job
+                if kind == "partial":
+                    (x1, y1, x2, y2), block = payload
+                    edges = np.zeros((self.img_original.height, self.img_original.width), dtype=np.uint8)
+                    edges[y1:y2, x1:x2] = block
+                    self.img_filtered = render_canny_result(self.img_original, edges)
+                    self.display_image()
+                    self.measurement.set("Status: Global Canny: visible area done, finishing off-screen tiles...")
+                elif kind == "done":
+                    key, edges = payload
+                    self.edge_map = edges
+                    self.edge_map_origin = (0, 0)
+                    self.edge_map_key = key
+                    self.apply_filters_and_display() # Cache hit now: renders, displays and sets the status
+                    return
+                else:
+                    self.measurement.set(f"Status: Error applying Global Canny: {payload}")
+                    return
+        except queue.Empty:
+            pass
+        self.root.after(30, self._poll_tiled_canny, generation)
+
+    def _get_gray_array(self):
+        """Returns the grayscale NumPy array of img_original, converting it only once per image."""
+        if self.img_gray_np is None and self.img_original:
+            self.img_gray_np = to_gray_array(self.img_original)
+        return self.img_gray_np
+
+    def _start_integrals_build(self):
+        """Builds the ROI statistics tables of the current image on a worker thread (about 80 ms for 16 MP)."""
+        if self.intensity_integrals is not None or self._integrals_building or not self.img_original:
+            return
+        self._integrals_building = True
+        generation = self._integrals_generation
+        img, gray = self.img_original, self.img_gray_np
+        result = []
+
+        def build():
+            try:
+                result.append(IntensityIntegrals(gray if gray is not None else to_gray_array(img)))
+            except Exception:
+                print(traceback.format_exc())
+                result.append(None)
+
+        threading.Thread(target=build, name="IntensityIntegrals", daemon=True).start()
+        self.root.after(30, self._poll_integrals_build, generation, result)
+
+    def _poll_integrals_build(self, generation, result):
+        if generation != self._integrals_generation or not self.root.winfo_exists():
+            return # Image changed meanwhile
+        if not result:
+            self.root.after(30, self._poll_integrals_build, generation, result)
+            return
+        self._integrals_building = False
+        self.intensity_integrals = result[0]
+        self._roi_stats_key = None # Show the stats that were waiting for the tables
+        self._update_roi_stats(extrema=not self.canny_selection_mode)
+
+    def _get_intensity_integrals(self):
+        """The ROI statistics tables, built right here if missing (for one-off uses such as saving)."""
+        if self.intensity_integrals is None and self.img_original:
+            self.intensity_integrals = IntensityIntegrals(self._get_gray_array())
+        return self.intensity_integrals
+
+    def _update_roi_stats(self, extrema=True):
+        """Shows mean/std of the Canny ROI in constant time; min/max (a scan of the ROI) only if extrema."""
+        roi = self._canny_roi_image_coords()
+        key = (roi, extrema)
+        if key == self._roi_stats_key:
+            return
+        self._roi_stats_key = key
+        if not roi:
+            self.roi_stats_text.set("ROI: none selected")
+            return
+        if self.intensity_integrals is None:
+            self._start_integrals_build() # Updates the panel when done
+            self._roi_stats_key = None
+            self.roi_stats_text.set(f"ROI {roi[2] - roi[0]}x{roi[3] - roi[1]} px\nComputing statistics...")
+            return
+        stats = self.intensity_integrals.stats(roi)
+        text = (f"ROI {roi[2] - roi[0]}x{roi[3] - roi[1]} px\n"
+                f"Mean: {stats['mean']:.2f}  Std: {stats['std']:.2f}")
+        if extrema:
+            low, high = region_extrema(self._get_gray_array(), roi)
+            text += f"\nMin: {low}  Max: {high}"
+        self.roi_stats_text.set(text)
+
+    def _roi_statistics(self):
+        """Intensity stats of the Canny ROI and around every measured point, as saved in the analysis JSON."""
+        integrals = self._get_intensity_integrals()
+        if integrals is None:
+            return None
+        data = measurement_intensity_stats(integrals, self.measurements)
+        roi = self._canny_roi_image_coords()
+        data["canny_roi"] = None
+        if roi:
+            data["canny_roi"] = integrals.stats(roi)
+            data["canny_roi"]["min"], data["canny_roi"]["max"] = region_extrema(self._get_gray_array(), roi)
+        return data
+
+    def _canny_roi_image_coords(self):
+        """Returns the Canny ROI as clamped (x1, y1, x2, y2) original image coords, or None."""
+        if not self.img_original or not self.canny_start or not self.canny_end:
+            return None
+        return clamp_roi((self.canny_start[0] / self.zoom_factor, self.canny_start[1] / self.zoom_factor,
+                          self.canny_end[0] / self.zoom_factor, self.canny_end[1] / self.zoom_factor),
+                         self.img_original.width, self.img_original.height)
+
+    def apply_auto_thresholds(self):
+        """Sets both Canny sliders from the image statistics (of the ROI if one is selected) and filters once."""
+        if not self.img_original:
+            return
+        roi = None if self.global_canny_active else self._canny_roi_image_coords()
+        key = (self.file_path, roi, self.filter_pipeline.signature())
+        histograms = self._histogram_cache.get(key)
+        if histograms is None:
+            try:
+                histograms = threshold_histograms(self._get_filter_input(), roi)
+            except Exception as e:
+                messagebox.showerror("Auto Thresholds", f"Could not compute image statistics:\n{e}", parent=self.root)
+                print(traceback.format_exc())
+                return
+            self._histogram_cache[key] = histograms
+            if len(self._histogram_cache) > 64:
+                self._histogram_cache.popitem(last=False)
+        else:
+            self._histogram_cache.move_to_end(key)
+
+        method = self.auto_canny_method.get()
+        low, high = auto_canny_thresholds(histograms, method)
+        self._suppress_filter_trace = True # One filter pass for both sliders
+        try:
+            self.canny_low.set(low)
+            self.canny_high.set(high)
+        finally:
+            self._suppress_filter_trace = False
+        self.apply_filters_and_display()
+        self.measurement.set(f"Status: Auto thresholds ({method}{', ROI' if roi else ''}): {low}/{high}.")
+
+    def _get_filter_input(self):
+        """Gray array after the preprocessing pipeline; unchanged stages come from the pipeline's cache."""
+        gray = self._get_gray_array()
+        return self.filter_pipeline.run(gray, (self.file_path, gray.shape))
+
+    def _edge_map_key(self, roi=None):
+        """What an edge map depends on: scope, thresholds, ROI and the preprocessing pipeline."""
+        return ("roi" if roi else "global", self.canny_low.get(), self.canny_high.get(), roi,
+                self.filter_pipeline.signature())
+
+    def _update_edge_map(self, roi=None):
+        """Runs Canny for the current thresholds (whole image or ROI) unless the cached edge map already matches."""
+        key = self._edge_map_key(roi)
+        if self.edge_map is not None and self.edge_map_key == key:
+            return self.edge_map
+
+        low, high = key[1], key[2]
+        self.edge_map = canny_edges(self._get_filter_input(), low, high, roi)
+        self.edge_map_origin = (roi[0], roi[1]) if roi else (0, 0)
+        self.edge_map_key = key
+        return self.edge_map
+
+    def _get_edge_snap_index(self):
+        """Returns the nearest-edge lookup for the active Canny result, rebuilding it only when thresholds or ROI changed."""
+        if not self.img_original:
+            return None
+        try:
+            if self.global_canny_active:
+                edges_np = self._update_edge_map()
+            else:
+                roi = self._canny_roi_image_coords()
+                if not roi:
+                    return None # No Canny result to snap to
+                edges_np = self._update_edge_map(roi)
+        except Exception as e:
+            print(f"Error computing edge map for snapping: {e}")
+            return None
+
+        if self.edge_snap_index is not None and self.edge_snap_key == self.edge_map_key:
+            return self.edge_snap_index
+
+        edge_pixels = edges_np > 0
+        if not edge_pixels.any():
+            self.edge_snap_index = None
+        else:
+            # distanceTransform measures distance to the nearest ZERO pixel, so edges become 0
+            src = np.where(edge_pixels, 0, 255).astype(np.uint8)
+            distances, labels = cv2.distanceTransformWithLabels(src, cv2.DIST_L2, cv2.DIST_MASK_5,
+                                                                labelType=cv2.DIST_LABEL_PIXEL)
+            # DIST_LABEL_PIXEL numbers zero pixels 1..N in row-major order, same as np.nonzero
+            edge_ys, edge_xs = np.nonzero(edge_pixels)
+            self.edge_snap_index = (distances, labels, edge_xs, edge_ys)
+        self.edge_snap_key = self.edge_map_key
+        self._enforce_memory_budget(pinned=("edges", "snap")) # The next snap click needs both
+        return self.edge_snap_index
+
+    def _snap_to_edge(self, x, y):
+        """Moves an image-coord click to the nearest edge pixel center if within EDGE_SNAP_RADIUS."""
+        index = self._get_edge_snap_index()
+        if index is None:
+            return x, y, False
+
+        distances, labels, edge_xs, edge_ys = index
+        origin_x, origin_y = self.edge_map_origin
+        local_x, local_y = int(x) - origin_x, int(y) - origin_y
+        if not (0 <= local_y < labels.shape[0] and 0 <= local_x < labels.shape[1]):
+            return x, y, False # Click outside the ROI edge map
+        if distances[local_y, local_x] > self.EDGE_SNAP_RADIUS / self.zoom_factor:
+            return x, y, False # Nearest edge too far away
+
+        label = labels[local_y, local_x] - 1
+        return float(edge_xs[label] + origin_x + 0.5), float(edge_ys[label] + origin_y + 0.5), True
+
+
+    @traced("display_image", "render")
     def display_image(self):
         """Displays the current image (original or filtered) on the canvas with overlays."""
         # --- Safeguard ---
@@ -774,44 +1651,95 @@ class ImageAnalyzer:
         if new_width <= 0 or new_height <= 0:
             return
 
+        # Only the visible part of the zoomed image is rendered. The scroll region still spans the
+        # whole zoomed image so canvas coords (overlays, clicks) stay image coords * zoom_factor.
+        # Set it first: Tk clamps the view to it, and the view decides what gets rendered.
+        self.image_canvas.config(scrollregion=(0, 0, new_width, new_height))
+        canvas_width = max(1, self.image_canvas.winfo_width())
+        canvas_height = max(1, self.image_canvas.winfo_height())
+        view_x = min(max(0, int(self.image_canvas.canvasx(0))), new_width - 1)
+        view_y = min(max(0, int(self.image_canvas.canvasy(0))), new_height - 1)
+        view_w = min(canvas_width, new_width - view_x)
+        view_h = min(canvas_height, new_height - view_y)
+        source_box = (view_x / self.zoom_factor, view_y / self.zoom_factor,
+                      min(width, (view_x + view_w) / self.zoom_factor), min(height, (view_y + view_h) / self.zoom_factor))
+
         try:
-            resized_img = img_display_base.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            if self.root and self.root.winfo_exists():
-                self.photo = ImageTk.PhotoImage(resized_img) # Store reference
-            else:
-                # print("Debug: Root window not ready for PhotoImage creation.")
-                return # Cannot proceed
-        except tk.TclError as e:
-             # print(f"Tkinter Error resizing/creating PhotoImage: {e}")
-             return # Stop if image cannot be created
+            with self.perf.stage("display_image resize"):
+                view_img = resample_region(self._display_source(img_display_base), source_box, (view_w, view_h),
+                                           self.resampling_preset.get())
         except Exception as e:
              print(f"Error resizing image: {e}")
              try:
-                 resized_img = img_display_base.resize((new_width, new_height), Image.Resampling.NEAREST)
-                 if self.root and self.root.winfo_exists():
-                     self.photo = ImageTk.PhotoImage(resized_img)
-                 else:
-                      # print("Debug: Root window not ready for PhotoImage creation (Nearest).")
-                      return
-             except tk.TclError as e_near:
-                 # print(f"Tkinter Error resizing/creating PhotoImage (Nearest): {e_near}")
-                 return
+                 view_img = img_display_base.resize((view_w, view_h), Image.Resampling.NEAREST, box=source_box)
              except Exception as e_near_gen:
                  print(f"Failed to resize even with NEAREST: {e_near_gen}")
                  return # Cannot display
 
+        try:
+            with self.perf.stage("PhotoImage"):
+                self._update_viewport_photo(view_img, canvas_width, canvas_height)
+        except tk.TclError:
+            return # Stop if image cannot be created (window going away)
+
         # Clear previous drawings
         self.image_canvas.delete("all")
 
-        # Draw the image
-        if self.photo:
-            self.image_canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
-            self.image_canvas.config(scrollregion=(0, 0, new_width, new_height))
-        else:
-             # print("Error: self.photo is None, cannot draw image.")
-             return # Skip drawing overlays if image failed
+        # Draw the image where the view currently is
+        self.image_canvas.create_image(view_x, view_y, anchor=tk.NW, image=self.photo)
 
         # --- Draw Overlays ---
+        with self.perf.stage("overlay items"):
+            self._draw_overlays()
+
+        # --- Draw Selection Rectangles ---
+        # Draw completed Canny rectangle if selection is done
+        if self.canny_start and self.canny_end and not self.canny_selection_mode:
+            self.image_canvas.delete("canny_rect") # Delete potential old one during drag
+            self.image_canvas.create_rectangle(
+                self.canny_start[0], self.canny_start[1],
+                self.canny_end[0], self.canny_end[1],
+                outline="blue", dash=(4, 4), width=1, tags="canny_rect"
+            )
+        elif not self.canny_selection_mode:
+             self.image_canvas.delete("canny_rect")
+
+        # Draw completed FIND_EDGES rectangle (legacy)
+        if self.selection_start and self.selection_end and not self.edge_selection_mode:
+             self.image_canvas.delete("selection_rect")
+             self.image_canvas.create_rectangle(
+                 self.selection_start[0], self.selection_start[1],
+                 self.selection_end[0], self.selection_end[1],
+                 outline="red", dash=(4, 4), width=1, tags="selection_rect"
+             )
+        elif not self.edge_selection_mode:
+             self.image_canvas.delete("selection_rect")
+
+        self.perf.frame()
+        self._draw_perf_hud()
+
+    def _display_source(self, img):
+        """What the resampler reads: the PIL image itself, or a cached array of it for the cv2 backend."""
+        if RESAMPLING_PRESETS[self.resampling_preset.get()][0] != "cv2":
+            return img
+        if self._display_array is None or self._display_array_src is not img:
+            self._display_array = np.asarray(img)
+            self._display_array_src = img
+        return self._display_array
+
+    def _update_viewport_photo(self, view_img, canvas_width, canvas_height):
+        """Copies the rendered view into the long-lived PhotoImage, allocating a new one only when the canvas size changed."""
+        if view_img.size != (canvas_width, canvas_height):
+            # Image smaller than the canvas: transparent padding shows the canvas background
+            padded = Image.new("RGBA", (canvas_width, canvas_height), (0, 0, 0, 0))
+            padded.paste(view_img, (0, 0))
+            view_img = padded
+        if self.photo is None or (self.photo.width(), self.photo.height()) != (canvas_width, canvas_height):
+            self.photo = ImageTk.PhotoImage("RGBA", (canvas_width, canvas_height))
+        self.photo.paste(view_img)
+
+    def _draw_overlays(self):
+        """Draws all measurement points, lines and ticks on the main canvas (tagged 'overlay')."""
         def scale_pt(pt):
             return (pt[0] * self.zoom_factor, pt[1] * self.zoom_factor)
 
@@ -821,70 +1749,67 @@ class ImageAnalyzer:
         # Draw calibration dots
         for dot in self.calibration_dots:
             sx, sy = scale_pt(dot)
-            self.image_canvas.create_oval(sx - dot_radius, sy - dot_radius, sx + dot_radius, sy + dot_radius, fill="cyan", outline="black")
+            self.image_canvas.create_oval(sx - dot_radius, sy - dot_radius, sx + dot_radius, sy + dot_radius, fill="cyan", outline="black", tags="overlay")
 
         # Draw artery lines and dots
         for i in range(0, len(self.artery_dots)):
             sx, sy = scale_pt(self.artery_dots[i])
-            self.image_canvas.create_oval(sx - dot_radius, sy - dot_radius, sx + dot_radius, sy + dot_radius, fill="yellow", outline="black")
+            self.image_canvas.create_oval(sx - dot_radius, sy - dot_radius, sx + dot_radius, sy + dot_radius, fill="yellow", outline="black", tags="overlay")
             if i % 2 == 1:
                 sx_prev, sy_prev = scale_pt(self.artery_dots[i-1])
-                self.image_canvas.create_line(sx_prev, sy_prev, sx, sy, fill="yellow", width=line_width)
+                self.image_canvas.create_line(sx_prev, sy_prev, sx, sy, fill="yellow", width=line_width, tags="overlay")
 
         # Draw line mode lines and points (PERSISTENT)
         for i in range(0, len(self.line_points)):
             sx, sy = scale_pt(self.line_points[i])
-            self.image_canvas.create_oval(sx - dot_radius, sy - dot_radius, sx + dot_radius, sy + dot_radius, fill="magenta", outline="black")
+            self.image_canvas.create_oval(sx - dot_radius, sy - dot_radius, sx + dot_radius, sy + dot_radius, fill="magenta", outline="black", tags="overlay")
             if i % 2 == 1: # Draw line for pairs
                 sx_prev, sy_prev = scale_pt(self.line_points[i-1])
-                self.image_canvas.create_line(sx_prev, sy_prev, sx, sy, fill="magenta", width=line_width)
+                self.image_canvas.create_line(sx_prev, sy_prev, sx, sy, fill="magenta", width=line_width, tags="overlay")
+
+        # Draw completed angles (editable in Edit Points mode)
+        for meas_idx in self._angle_measurement_indices():
+            sp1_m, sp2_m, sp3_m = (scale_pt(p) for p in self.measurements[meas_idx]["points"])
+            self.image_canvas.create_line(*sp1_m, *sp2_m, *sp3_m, fill="lime green", width=line_width, tags="overlay")
+            for sx, sy in (sp1_m, sp2_m, sp3_m):
+                self.image_canvas.create_oval(sx - dot_radius, sy - dot_radius, sx + dot_radius, sy + dot_radius, fill="lime green", outline="black", tags="overlay")
 
         # Draw angle points and lines
         if self.angle_points:
              sp1_a, sp2_a, sp3_a = None, None, None # Use temp vars
              if len(self.angle_points) >= 1:
                  sp1_a = scale_pt(self.angle_points[0])
-                 self.image_canvas.create_oval(sp1_a[0]-dot_radius, sp1_a[1]-dot_radius, sp1_a[0]+dot_radius, sp1_a[1]+dot_radius, fill="lime green", outline="black")
+                 self.image_canvas.create_oval(sp1_a[0]-dot_radius, sp1_a[1]-dot_radius, sp1_a[0]+dot_radius, sp1_a[1]+dot_radius, fill="lime green", outline="black", tags="overlay")
              if len(self.angle_points) >= 2:
                  sp2_a = scale_pt(self.angle_points[1])
-                 self.image_canvas.create_oval(sp2_a[0]-dot_radius, sp2_a[1]-dot_radius, sp2_a[0]+dot_radius, sp2_a[1]+dot_radius, fill="lime green", outline="black")
-                 if sp1_a: self.image_canvas.create_line(sp1_a[0], sp1_a[1], sp2_a[0], sp2_a[1], fill="lime green", width=line_width, dash=(4, 2))
+                 self.image_canvas.create_oval(sp2_a[0]-dot_radius, sp2_a[1]-dot_radius, sp2_a[0]+dot_radius, sp2_a[1]+dot_radius, fill="lime green", outline="black", tags="overlay")
+                 if sp1_a: self.image_canvas.create_line(sp1_a[0], sp1_a[1], sp2_a[0], sp2_a[1], fill="lime green", width=line_width, dash=(4, 2), tags="overlay")
              if len(self.angle_points) == 3:
                  sp3_a = scale_pt(self.angle_points[2])
-                 self.image_canvas.create_oval(sp3_a[0]-dot_radius, sp3_a[1]-dot_radius, sp3_a[0]+dot_radius, sp3_a[1]+dot_radius, fill="lime green", outline="black")
-                 if sp2_a: self.image_canvas.create_line(sp2_a[0], sp2_a[1], sp3_a[0], sp3_a[1], fill="lime green", width=line_width, dash=(4, 2))
+                 self.image_canvas.create_oval(sp3_a[0]-dot_radius, sp3_a[1]-dot_radius, sp3_a[0]+dot_radius, sp3_a[1]+dot_radius, fill="lime green", outline="black", tags="overlay")
+                 if sp2_a: self.image_canvas.create_line(sp2_a[0], sp2_a[1], sp3_a[0], sp3_a[1], fill="lime green", width=line_width, dash=(4, 2), tags="overlay")
 
 
+        # Draw pending Auto Ø click
+        for pt in self.auto_diameter_points:
+            sx, sy = scale_pt(pt)
+            self.image_canvas.create_oval(sx - dot_radius, sy - dot_radius, sx + dot_radius, sy + dot_radius, fill="orange", outline="black", tags="overlay")
+
         # Draw the tick markers for Line Mode measurements if available
         tick_radius = 2
         for pt1, pt2 in self.line_measurement_points:
             sx1, sy1 = scale_pt(pt1)
             sx2, sy2 = scale_pt(pt2)
-            self.image_canvas.create_oval(sx1 - tick_radius, sy1 - tick_radius, sx1 + tick_radius, sy1 + tick_radius, fill="red", outline="red")
-            self.image_canvas.create_line(sx1, sy1, sx2, sy2, fill="red", dash=(2, 2))
+            self.image_canvas.create_oval(sx1 - tick_radius, sy1 - tick_radius, sx1 + tick_radius, sy1 + tick_radius, fill="red", outline="red", tags="overlay")
+            self.image_canvas.create_line(sx1, sy1, sx2, sy2, fill="red", dash=(2, 2), tags="overlay")
 
-        # --- Draw Selection Rectangles ---
-        # Draw completed Canny rectangle if selection is done
-        if self.canny_start and self.canny_end and not self.canny_selection_mode:
-            self.image_canvas.delete("canny_rect") # Delete potential old one during drag
-            self.image_canvas.create_rectangle(
-                self.canny_start[0], self.canny_start[1],
-                self.canny_end[0], self.canny_end[1],
-                outline="blue", dash=(4, 4), width=1, tags="canny_rect"
-            )
-        elif not self.canny_selection_mode:
-             self.image_canvas.delete("canny_rect")
-
-        # Draw completed FIND_EDGES rectangle (legacy)
-        if self.selection_start and self.selection_end and not self.edge_selection_mode:
-             self.image_canvas.delete("selection_rect")
-             self.image_canvas.create_rectangle(
-                 self.selection_start[0], self.selection_start[1],
-                 self.selection_end[0], self.selection_end[1],
-                 outline="red", dash=(4, 4), width=1, tags="selection_rect"
-             )
-        elif not self.edge_selection_mode:
-             self.image_canvas.delete("selection_rect")
+        # Highlight the point selected in Edit Points mode
+        selected_pt = self._get_point(self.selected_point)
+        if selected_pt:
+            sx, sy = scale_pt(selected_pt)
+            highlight_radius = dot_radius + 4
+            self.image_canvas.create_oval(sx - highlight_radius, sy - highlight_radius, sx + highlight_radius, sy + highlight_radius,
+                                          outline="white", width=2, tags="overlay")
 
 
     def update_zoom_box_and_pixel(self, event=None):
@@ -914,6 +1839,15 @@ class ImageAnalyzer:
              else:
                  pixel_str_part = "Pixel: Outside Image"
 
+             window = 2 * POINT_STATS_RADIUS + 1
+             if not 0 <= orig_x < self.img_original.width or not 0 <= orig_y < self.img_original.height:
+                 self.cursor_stats_text.set("Cursor: outside image")
+             elif self.intensity_integrals is not None: # Never built here: motion events must stay O(1)
+                 cursor_stats = self.intensity_integrals.point_stats((orig_x, orig_y))
+                 self.cursor_stats_text.set(f"Cursor {window}x{window}: mean {cursor_stats['mean']:.1f}, std {cursor_stats['std']:.1f}")
+             else:
+                 self.cursor_stats_text.set("Cursor: statistics not ready")
+
              # Combine with current mode info safely
              try:
                  current_info = self.pixel_info.get()
@@ -925,6 +1859,11 @@ class ImageAnalyzer:
                  self.pixel_info.set(f"Mode: Unknown | {pixel_str_part} | Zoom: {'ON' if self.zoom_box_mode else 'OFF'}")
 
 
+             # Show a grab cursor when hovering an editable point
+             if self.edit_points_mode and not self.dragging_point:
+                 hovered = self._hit_test_point(canvas_x / self.zoom_factor, canvas_y / self.zoom_factor)
+                 self.image_canvas.config(cursor="fleur" if hovered else "")
+
              # Update Zoom Box if active
              if self.zoom_box_mode and self.zoom_box and self.zoom_box.winfo_exists():
                  self.update_zoom_box_content(event)
@@ -933,6 +1872,7 @@ class ImageAnalyzer:
              pass # Handle potential errors if canvas is destroyed during motion event
 
 
+    @timed_stage("update_zoom_box_content", "zoom-box")
     def update_zoom_box_content(self, event=None):
         """Updates the content of the zoom box canvas."""
         # --- Safeguard ---
@@ -985,14 +1925,15 @@ class ImageAnalyzer:
             # Use filtered image if available, else original
             img_source = self.img_filtered if self.img_filtered is not None else self.img_original
 
-            # Crop the calculated region
-            cropped_image = img_source.crop((left, top, right, bottom))
-
-            # Resize the cropped region to fit the zoom box
-            zoomed = cropped_image.resize((self.ZOOM_BOX_SIZE, self.ZOOM_BOX_SIZE), Image.Resampling.NEAREST) # Use NEAREST for sharp pixels
+            # Scale the calculated region to fit the zoom box
+            zoomed = resample_region(self._display_source(img_source), (left, top, right, bottom),
+                                     (self.ZOOM_BOX_SIZE, self.ZOOM_BOX_SIZE), self.resampling_preset.get(),
+                                     method="nearest") # Use NEAREST for sharp pixels
             # Check Tkinter is ready before creating PhotoImage
             if self.root and self.root.winfo_exists():
-                 self.zoom_box_photo = ImageTk.PhotoImage(zoomed) # Store reference
+                 if self.zoom_box_photo is None or self.zoom_box_photo.width() != self.ZOOM_BOX_SIZE:
+                     self.zoom_box_photo = ImageTk.PhotoImage("RGBA", (self.ZOOM_BOX_SIZE, self.ZOOM_BOX_SIZE))
+                 self.zoom_box_photo.paste(zoomed) # Same size every time -> update in place
             else:
                 # print("Debug: Root window not ready for zoom_box_photo creation.")
                 return # Cannot proceed
@@ -1079,6 +2020,7 @@ class ImageAnalyzer:
              except tk.TclError: pass
 
 
+    @traced("zoom", "render")
     def zoom(self, factor, event=None):
         """Zooms the image view by a given factor, optionally centering on the event coordinates."""
         if not self.img_original:
@@ -1123,12 +2065,10 @@ class ImageAnalyzer:
         # Apply the new zoom factor
         self.zoom_factor = new_zoom
 
-        # Update the image display (this also updates scrollregion)
-        self.display_image()
-
         # --- Recenter View ---
-        if not self.image_canvas or not self.image_canvas.winfo_exists():
-             return # Check if canvas still exists
+        # The view has to be in place before rendering, since only the visible part is rendered
+        img_width_new = max(1, int(self.img_original.width * new_zoom))
+        img_height_new = max(1, int(self.img_original.height * new_zoom))
 
         # Calculate where the same image coordinate should be *after* zooming
         new_mouse_x = img_coord_x * new_zoom
@@ -1138,25 +2078,16 @@ class ImageAnalyzer:
         scroll_x = new_mouse_x - target_canvas_x
         scroll_y = new_mouse_y - target_canvas_y
 
-        # Convert scroll position to fraction for xview_moveto/yview_moveto
-        current_scroll_region = self.image_canvas.cget('scrollregion')
-        img_width_new, img_height_new = 1, 1 # Fallbacks
-        if current_scroll_region:
-            try:
-                sr_parts = current_scroll_region.split()
-                img_width_new = float(sr_parts[2])
-                img_height_new = float(sr_parts[3])
-            except (IndexError, ValueError, tk.TclError): pass
-
-        scroll_x_frac = scroll_x / img_width_new if img_width_new > 0 else 0
-        scroll_y_frac = scroll_y / img_height_new if img_height_new > 0 else 0
-
-        # Apply the scroll, clamping to valid range [0, 1]
+        # Apply the scroll as fractions, clamping to valid range [0, 1]
         try:
-            self.image_canvas.xview_moveto(max(0.0, min(scroll_x_frac, 1.0)))
-            self.image_canvas.yview_moveto(max(0.0, min(scroll_y_frac, 1.0)))
+            self.image_canvas.config(scrollregion=(0, 0, img_width_new, img_height_new))
+            self.image_canvas.xview_moveto(max(0.0, min(scroll_x / img_width_new, 1.0)))
+            self.image_canvas.yview_moveto(max(0.0, min(scroll_y / img_height_new, 1.0)))
         except tk.TclError:
-             pass # Ignore errors if canvas is destroyed during zoom
+             return # Canvas destroyed during zoom
+
+        # Update the image display for the new view
+        self.display_image()
 
         # Update zoom box content after zooming
         if self.zoom_box_mode and self.zoom_box:
@@ -1213,7 +2144,6 @@ class ImageAnalyzer:
         if not self.img_original or not self.image_canvas or not self.image_canvas.winfo_exists():
             return
 
-        self.save_state() # Save state before modification
         canvas_x = self.image_canvas.canvasx(event.x)
         canvas_y = self.image_canvas.canvasy(event.y)
         orig_x = canvas_x / self.zoom_factor
@@ -1223,6 +2153,16 @@ class ImageAnalyzer:
              self.measurement.set("Status: Click outside image bounds.")
              return
 
+        if self.edit_points_mode:
+            self._begin_point_drag(orig_x, orig_y) # Undo state is saved once the point actually moves
+            return # Overlays already redrawn, no full image render needed
+
+        self.save_state() # Save state before modification
+
+        # Snap point-placing clicks to the nearest Canny edge if enabled
+        if self.edge_snap_active and (self.artery_mode or self.angle_mode or self.line_mode):
+            orig_x, orig_y, _ = self._snap_to_edge(orig_x, orig_y)
+
         current_mode_action = False
 
         if self.edge_selection_mode: # Legacy FIND_EDGES ROI start
@@ -1264,29 +2204,17 @@ class ImageAnalyzer:
             self.artery_dots.append((orig_x, orig_y))
             self.update_dot_coords_display()
             if len(self.artery_dots) % 2 == 0:
-                dot1_x, dot1_y = self.artery_dots[-2]
-                dot2_x, dot2_y = self.artery_dots[-1]
-                dx = dot2_x - dot1_x
-                dy = dot2_y - dot1_y
-                distance_px = math.sqrt(dx**2 + dy**2)
-                angle = math.degrees(math.atan2(-dy, dx))
-                if angle < 0: angle += 360
-
-                meas_info = {
-                    "type": "artery",
-                    "points": [(dot1_x, dot1_y), (dot2_x, dot2_y)],
-                    "distance_px": distance_px,
-                    "angle_deg": angle
-                }
+                meas_info = self._artery_measurement(self.artery_dots[-2], self.artery_dots[-1])
+                distance_px = meas_info["distance_px"]
+                angle = meas_info["angle_deg"]
                 status_text = f"Pair {len(self.artery_dots)//2}: {distance_px:.2f}px, {angle:.1f}°"
                 if self.calibration_done:
-                    real_distance = distance_px / self.calibration_factor
-                    meas_info["distance_mm"] = real_distance
-                    status_text += f" = {real_distance:.3f}mm"
+                    status_text += f" = {meas_info['distance_mm']:.3f}mm"
                 else:
                      status_text += " (Uncalibrated)"
 
                 self.measurements.append(meas_info)
+                self._journal_added(meas_info)
                 self.measurement.set(status_text)
                 self.update_tables()
             else:
@@ -1302,30 +2230,17 @@ class ImageAnalyzer:
                 elif len(self.angle_points) == 2:
                      self.measurement.set("Angle: Click final point (3rd).")
                 elif len(self.angle_points) == 3:
-                    p1, p2, p3 = self.angle_points
-                    v1 = (p1[0] - p2[0], p1[1] - p2[1])
-                    v2 = (p3[0] - p2[0], p3[1] - p2[1])
-                    mag1_sq = v1[0]**2 + v1[1]**2
-                    mag2_sq = v2[0]**2 + v2[1]**2
-
-                    if mag1_sq < 1e-9 or mag2_sq < 1e-9:
-                        angle_deg = 0.0
+                    angle_deg = angle_at_vertex(*self.angle_points)
+                    if angle_deg is None:
                         self.measurement.set("Angle Error: Points coincide.")
                     else:
-                        angle1 = math.atan2(v1[1], v1[0])
-                        angle2 = math.atan2(v2[1], v2[0])
-                        angle_rad = angle2 - angle1
-                        while angle_rad > math.pi: angle_rad -= 2 * math.pi
-                        while angle_rad <= -math.pi: angle_rad += 2 * math.pi
-                        angle_deg = abs(math.degrees(angle_rad))
-                        if angle_deg > 180: angle_deg = 360 - angle_deg
-
                         self.measurement.set(f"Angle Measured: {angle_deg:.2f}°")
                         self.measurements.append({
                             "type": "angle",
                             "points": self.angle_points.copy(),
                             "angle_deg": angle_deg
                         })
+                        self._journal_added(self.measurements[-1])
                         self.update_tables()
                         self.angle_points = []
                         self.measurement.set("Angle: Click first point for new angle.")
@@ -1335,6 +2250,24 @@ class ImageAnalyzer:
                 self.update_dot_coords_display()
             current_mode_action = True
 
+        elif self.auto_diameter_mode or self.auto_centerline_mode:
+            if len(self.artery_dots) % 2 == 1:
+                self.measurement.set("Auto Ø: Finish or delete the pending Dots pair first.")
+            else:
+                self.auto_diameter_points.append((orig_x, orig_y))
+                if len(self.auto_diameter_points) == 1:
+                    self.measurement.set("Auto Ø: Click the second point.")
+                else:
+                    start, end = self.auto_diameter_points
+                    self.auto_diameter_points = []
+                    if self.auto_diameter_mode:
+                        self._measure_auto_diameter(start, end)
+                    else:
+                        self._measure_auto_centerline(start, end)
+                    self.update_dot_coords_display()
+                    self.update_tables()
+            current_mode_action = True
+
         elif self.line_mode:
             if len(self.line_points) < 4:
                 self.line_points.append((orig_x, orig_y))
@@ -1346,6 +2279,7 @@ class ImageAnalyzer:
                     meas = self.calculate_line_measurements()
                     if meas:
                         self.measurements.append(meas)
+                        self._journal_added(meas)
                         self.update_tables()
                         avg_dist_px = sum(meas["distances_px"]) / len(meas["distances_px"]) if meas["distances_px"] else 0
                         status = f"Lines: L1={meas['length1_px']:.1f}px, L2={meas['length2_px']:.1f}px, Angle={meas['angle_deg']:.1f}°, AvgDist={avg_dist_px:.2f}px"
@@ -1372,6 +2306,7 @@ class ImageAnalyzer:
                  self.line_measurement_points = []
                  # Remove the previous line measurement result if it exists
                  self.measurements = [m for m in self.measurements if m.get("type") != "line" or m.get("points") != self.line_points[:-1]] # Rough check
+                 self._journal_snapshot()
                  self.measurement.set("Line Mode: Reset. Click 3 more points for new line.")
                  self.update_dot_coords_display()
                  self.update_tables() # Update table after removing old line measurement
@@ -1392,6 +2327,12 @@ class ImageAnalyzer:
             canvas_x = self.image_canvas.canvasx(event.x)
             canvas_y = self.image_canvas.canvasy(event.y)
 
+            # --- Handle Point Dragging (Edit Points mode) ---
+            if self.edit_points_mode and self.dragging_point:
+                self._drag_point_to(canvas_x / self.zoom_factor, canvas_y / self.zoom_factor)
+                self.update_zoom_box_and_pixel(event)
+                return
+
             # --- Handle ROI Dragging ---
             if self.edge_selection_mode and self.selection_start:
                 self.selection_end = (canvas_x, canvas_y)
@@ -1408,6 +2349,7 @@ class ImageAnalyzer:
                     self.image_canvas.coords(self.canny_rect,
                                              self.canny_start[0], self.canny_start[1],
                                              canvas_x, canvas_y)
+                self._update_roi_stats(extrema=False) # Constant time however large the ROI
                 # Apply filter live during drag and update display
                 self.apply_filters_and_display()
                 # No need to call update_zoom_box_and_pixel here, it's handled by apply_filters_and_display
@@ -1429,6 +2371,10 @@ class ImageAnalyzer:
             canvas_x = self.image_canvas.canvasx(event.x)
             canvas_y = self.image_canvas.canvasy(event.y)
 
+            # --- Finalize Point Drag ---
+            if self.edit_points_mode and self.dragging_point:
+                self._end_point_drag()
+
             # --- Finalize ROI Selection ---
             if self.edge_selection_mode and self.selection_start:
                 self.selection_end = (canvas_x, canvas_y)
@@ -1476,6 +2422,7 @@ class ImageAnalyzer:
 
                 self.canny_selection_mode = False
                 if "Canny Selection" in self.buttons: self.buttons["Canny Selection"].config(relief=tk.RAISED)
+                self._update_roi_stats() # Final selection: add min/max
 
             # Update zoom box regardless
             if self.zoom_box_mode:
@@ -1493,8 +2440,18 @@ class ImageAnalyzer:
             "edge_selection_mode": ("ROI Selection", "ROI Selection (Edges): Drag area for FIND_EDGES."),
             "canny_selection_mode": ("Canny Selection", "Canny ROI Selection: Drag area for Canny filter."),
             "angle_mode": ("Angle Mode", "Angle Mode: Click 3 points (point, vertex, point)."),
-            "line_mode": ("Line Mode", "Line Mode: Click 4 points for parallel lines.")
+            "line_mode": ("Line Mode", "Line Mode: Click 4 points for parallel lines."),
+            "auto_diameter_mode": ("Auto Diameter", "Auto Ø: Click two points across the vessel."),
+            "auto_centerline_mode": ("Auto Centerline", "Auto Ø Centerline: Click two points along the vessel center."),
+            "edit_points_mode": ("Edit Points", "Edit Points: Drag a point to move it, Del removes the selected point.")
         }
+        self.auto_diameter_points = [] # Pending Auto Ø clicks never survive a mode change
+        if active_mode_attr != "edit_points_mode":
+            self.selected_point = None
+            self.dragging_point = False
+            if hasattr(self, 'image_canvas') and self.image_canvas:
+                try: self.image_canvas.config(cursor="")
+                except tk.TclError: pass
 
         status_message = "Status: Ready"
         active_mode_display = "None"
@@ -1542,11 +2499,100 @@ class ImageAnalyzer:
             self._reset_all_modes()
         self.artery_dots = []
         self.measurements = [m for m in self.measurements if m.get("type") != "artery"]
+        self._journal_snapshot()
         self.measurement.set("Status: Dots Mode reset.")
         self.update_dot_coords_display()
         self.update_tables()
         self.display_image()
 
+    def toggle_auto_diameter_mode(self):
+        self.save_state()
+        new_state = not self.auto_diameter_mode
+        self._reset_all_modes("auto_diameter_mode" if new_state else None)
+
+    def toggle_auto_centerline_mode(self):
+        self.save_state()
+        new_state = not self.auto_centerline_mode
+        self._reset_all_modes("auto_centerline_mode" if new_state else None)
+
+    def _artery_measurement(self, p1, p2):
+        """Builds the 'artery' measurement (distance, angle and mm if calibrated) for a dot pair."""
+        return artery_measurement(p1, p2, self.calibration_factor if self.calibration_done else None)
+
+    def _record_auto_diameters(self, starts, ends):
+        """Samples all cross-lines in one pass, locates both walls and stores them as Dots pairs.
+
+        Returns the number of cross-sections where both walls were found.
+        """
+        gray = self._get_gray_array()
+        if gray is None or not starts:
+            return 0
+        longest = max(math.hypot(e[0] - s[0], e[1] - s[1]) for s, e in zip(starts, ends))
+        num_samples = max(32, int(math.ceil(longest * self.AUTO_DIAMETER_SAMPLES_PER_PX)))
+        profiles = sample_line_profiles(gray, starts, ends, num_samples)
+        method = self.auto_diameter_method.get()
+
+        found = 0
+        for (sx, sy), (ex, ey), profile in zip(starts, ends, profiles):
+            walls = locate_vessel_walls(profile, method)
+            if walls is None:
+                continue
+            wall_pts = [(float(sx + (ex - sx) * w / (num_samples - 1)), float(sy + (ey - sy) * w / (num_samples - 1)))
+                        for w in walls]
+            meas_info = self._artery_measurement(wall_pts[0], wall_pts[1])
+            meas_info["method"] = f"auto_{method}"
+            meas_info["cross_line"] = [(float(sx), float(sy)), (float(ex), float(ey))]
+            self.artery_dots.extend(wall_pts)
+            self.measurements.append(meas_info)
+            self._journal_added(meas_info)
+            found += 1
+        return found
+
+    def _measure_auto_diameter(self, start, end):
+        """Measures the vessel diameter along a single user-drawn cross-line."""
+        if self._record_auto_diameters([start], [end]) == 0:
+            self.measurement.set("Auto Ø: No vessel walls found along the cross-line.")
+            return
+        meas = self.measurements[-1]
+        status_text = f"Auto Ø Pair {len(self.artery_dots)//2}: {meas['distance_px']:.2f}px"
+        if self.calibration_done:
+            status_text += f" = {meas['distance_mm']:.3f}mm"
+        self.measurement.set(status_text)
+
+    def _measure_auto_centerline(self, start, end):
+        """Measures the vessel diameter at N evenly spaced cross-sections along a centerline."""
+        length = math.hypot(end[0] - start[0], end[1] - start[1])
+        if length < 1e-6:
+            self.measurement.set("Auto Ø Centerline: Points coincide.")
+            return
+
+        count = simpledialog.askinteger("Auto Ø Centerline", "Number of cross-sections:",
+                                        initialvalue=self.auto_centerline_count, minvalue=1, maxvalue=1000, parent=self.root)
+        if not count:
+            self.measurement.set("Auto Ø Centerline: Cancelled.")
+            return
+        half_length = simpledialog.askfloat("Auto Ø Centerline", "Cross-line half-length (pixels):",
+                                            initialvalue=self.auto_centerline_half_length, minvalue=1.0, parent=self.root)
+        if not half_length:
+            self.measurement.set("Auto Ø Centerline: Cancelled.")
+            return
+        self.auto_centerline_count = count
+        self.auto_centerline_half_length = half_length
+
+        # Unit normal to the centerline
+        nx = -(end[1] - start[1]) / length
+        ny = (end[0] - start[0]) / length
+        starts, ends = [], []
+        for i in range(count):
+            t = (i + 0.5) / count
+            cx = start[0] + (end[0] - start[0]) * t
+            cy = start[1] + (end[1] - start[1]) * t
+            starts.append((cx - nx * half_length, cy - ny * half_length))
+            ends.append((cx + nx * half_length, cy + ny * half_length))
+
+        found = self._record_auto_diameters(starts, ends)
+        self.measurement.set(f"Auto Ø Centerline: Walls found at {found}/{count} cross-sections.")
+
     def toggle_calibration_mode(self):
         self.save_state()
         new_state = not self.calibration_mode
@@ -1577,17 +2623,13 @@ class ImageAnalyzer:
             try:
                 real_value = float(real_value_str)
                 if real_value > 0:
-                    self.calibration_factor = distance_px / real_value
+                    calib = calibration_measurement(self.calibration_dots[0], self.calibration_dots[1], real_value)
+                    self.calibration_factor = calib["calibration_factor"]
                     self.calibration_done = True
                     # Remove any previous calibration measurements before adding new one
                     self.measurements = [m for m in self.measurements if m.get("type") != "calibration"]
-                    self.measurements.append({
-                        "type": "calibration",
-                        "points": self.calibration_dots.copy(),
-                        "distance_px": distance_px,
-                        "real_value_mm": real_value,
-                        "calibration_factor": self.calibration_factor
-                    })
+                    self.measurements.append(calib)
+                    self._journal_snapshot()
                     self.update_tables()
                     self.update_dot_coords_display()
                     self._reset_all_modes()
@@ -1601,8 +2643,8 @@ class ImageAnalyzer:
                     self.measurement.set("Calibration Error: Enter positive distance.")
                     self.display_image()
                     self.update_dot_coords_display()
-            except ValueError:
-                messagebox.showerror("Calibration Error", "Invalid number entered.", parent=self.root)
+            except ValueError as e: # Not a number, or the two points coincide
+                messagebox.showerror("Calibration Error", f"Invalid calibration input:\n{e}", parent=self.root)
                 if self.calibration_dots: self.calibration_dots.pop()
                 self.measurement.set("Calibration Error: Invalid input.")
                 self.display_image()
@@ -1631,6 +2673,7 @@ class ImageAnalyzer:
                            break
             if last_artery_meas_index != -1:
                 del self.measurements[last_artery_meas_index]
+                self._journal_snapshot()
                 self.measurement.set("Status: Last dot pair and measurement deleted.")
             else:
                  self.measurement.set("Status: Last dot pair deleted (no matching measurement).")
@@ -1661,6 +2704,7 @@ class ImageAnalyzer:
         self.calibration_done = False
         self.calibration_dots = []
         self.measurements = [m for m in self.measurements if m.get("type") != "calibration"]
+        self._journal_snapshot()
 
         if self.calibration_mode:
             self._reset_all_modes()
@@ -1722,6 +2766,22 @@ class ImageAnalyzer:
         # Update status and apply/remove filter
         self.apply_filters_and_display() # This also sets the status message
 
+    # --- Edge Snap ---
+    def toggle_edge_snap(self):
+        """Toggles snapping of Dots/Line/Angle clicks to the nearest Canny edge pixel."""
+        self.edge_snap_active = not self.edge_snap_active
+        if "Snap to Edges" in self.buttons:
+            try:
+                self.buttons["Snap to Edges"].config(relief=tk.SUNKEN if self.edge_snap_active else tk.RAISED)
+            except tk.TclError: pass
+
+        if not self.edge_snap_active:
+            self.measurement.set("Status: Edge Snap OFF.")
+        elif self.global_canny_active or self._canny_roi_image_coords():
+            self.measurement.set("Status: Edge Snap ON. Clicks snap to the nearest Canny edge.")
+        else:
+            self.measurement.set("Status: Edge Snap ON (apply Global or ROI Canny to snap).")
+
     def toggle_zoom_box(self):
         """Toggles the visibility and functionality of the zoom box."""
         if not self.root or not self.root.winfo_exists() or not self.image_frame or not self.image_frame.winfo_exists():
@@ -1790,6 +2850,271 @@ class ImageAnalyzer:
         self._reset_all_modes("line_mode" if new_state else None)
 
 
+    # --- Edit Points ---
+    def toggle_edit_points_mode(self):
+        self.save_state()
+        new_state = not self.edit_points_mode
+        self._reset_all_modes("edit_points_mode" if new_state else None)
+        self.point_index = None # Force a fresh index for the new editing session
+        self.display_image()
+
+    def _get_point(self, key):
+        """Returns the (x, y) of a (source, index) point key, or None if it no longer exists."""
+        if not key:
+            return None
+        source, idx = key
+        if source == "angle_measurement":
+            angles = self._angle_measurement_indices()
+            meas_pos, vertex = divmod(idx, 3)
+            if meas_pos >= len(angles):
+                return None
+            return tuple(self.measurements[angles[meas_pos]]["points"][vertex])
+        points = getattr(self, self.POINT_SOURCES.get(source, ""), None)
+        if points is None or not (0 <= idx < len(points)):
+            return None
+        return points[idx]
+
+    def _angle_measurement_indices(self):
+        """Indices in self.measurements of the completed angles; their points are keyed 3 * position + vertex."""
+        return [i for i, m in enumerate(self.measurements) if m.get("type") == "angle" and len(m.get("points", [])) == 3]
+
+    def _get_point_index(self):
+        """Returns the spatial index over all editable points, rebuilding it if a point list changed."""
+        signature = tuple((id(getattr(self, attr)), len(getattr(self, attr))) for attr in self.POINT_SOURCES.values())
+        signature += ((id(self.measurements), len(self.measurements)),) # Completed angles live in measurements
+        if self.point_index is None or self.point_index_signature != signature:
+            index = PointGridIndex()
+            for source, attr in self.POINT_SOURCES.items():
+                for idx, (x, y) in enumerate(getattr(self, attr)):
+                    index.insert((source, idx), x, y)
+            for pos, meas_idx in enumerate(self._angle_measurement_indices()):
+                for vertex, (x, y) in enumerate(self.measurements[meas_idx]["points"]):
+                    index.insert(("angle_measurement", 3 * pos + vertex), x, y)
+            self.point_index = index
+            self.point_index_signature = signature
+        return self.point_index
+
+    def _hit_test_point(self, x, y):
+        """Returns the key of the point under image coords (x, y) within POINT_HIT_RADIUS screen pixels."""
+        return self._get_point_index().nearest(x, y, self.POINT_HIT_RADIUS / self.zoom_factor)
+
+    def _find_measurement(self, m_type, points):
+        """Returns the index of the measurement of m_type whose points match, or None."""
+        points = [tuple(p) for p in points]
+        for i in range(len(self.measurements) - 1, -1, -1):
+            meas = self.measurements[i]
+            if meas.get("type") == m_type and [tuple(p) for p in meas.get("points", [])] == points:
+                return i
+        return None
+
+    def _begin_point_drag(self, x, y):
+        """Selects the point under (x, y) and remembers which measurement depends on it."""
+        key = self._hit_test_point(x, y)
+        self.selected_point = key
+        self.dragging_point = key is not None
+        self.drag_dependents = None
+        self.drag_moved = False
+        if key is None:
+            self.measurement.set("Edit Points: No point here. Click on a point to select it.")
+        else:
+            source, idx = key
+            # Resolve the dependent measurement once so each drag step is O(1)
+            if source == "artery" and idx - idx % 2 + 1 < len(self.artery_dots):
+                first = idx - idx % 2
+                self.drag_dependents = self._find_measurement("artery", self.artery_dots[first:first + 2])
+            elif source == "line" and len(self.line_points) == 4:
+                self.drag_dependents = self._find_measurement("line", self.line_points)
+            elif source == "calibration":
+                self.drag_dependents = next((i for i, m in enumerate(self.measurements) if m.get("type") == "calibration"), None)
+            elif source == "angle_measurement":
+                self.drag_dependents = self._angle_measurement_indices()[idx // 3]
+            label = "angle" if source == "angle_measurement" else source
+            self.measurement.set(f"Edit Points: Selected {label} point {idx % 3 + 1 if label == 'angle' else idx + 1}. Drag to move, Del to delete.")
+        self._redraw_overlays()
+
+    def _drag_point_to(self, x, y):
+        """Moves the dragged point and incrementally recomputes the measurement that depends on it."""
+        if not self.selected_point or not self.img_original:
+            return
+        x = max(0.0, min(x, self.img_original.width - 1e-3))
+        y = max(0.0, min(y, self.img_original.height - 1e-3))
+        source, idx = self.selected_point
+        if not self.drag_moved:
+            # Only now: selecting a point (or pressing Del) must not push a snapshot or clear redo
+            self.save_state()
+            self.drag_moved = True
+        meas_idx = self.drag_dependents
+        if source == "angle_measurement":
+            meas = self.measurements[meas_idx]
+            points = list(meas["points"]) # New list: undo snapshots share the old one
+            points[idx % 3] = (x, y)
+            meas["points"] = points
+        else:
+            getattr(self, self.POINT_SOURCES[source])[idx] = (x, y)
+        self._get_point_index().move(self.selected_point, x, y)
+
+        if source == "angle_measurement":
+            angle_deg = angle_at_vertex(*meas["points"])
+            if angle_deg is not None: # Coinciding points: keep the last valid angle
+                meas["angle_deg"] = angle_deg
+                meas["edited"] = True
+                self.measurement.set(f"Edit Points: Angle {angle_deg:.2f}°")
+        elif source == "artery" and meas_idx is not None:
+            first = idx - idx % 2
+            meas = self.measurements[meas_idx]
+            meas.update(self._artery_measurement(self.artery_dots[first], self.artery_dots[first + 1]))
+            meas["edited"] = True
+            self.measurement.set(f"Edit Points: {meas['distance_px']:.2f}px, {meas['angle_deg']:.1f}°")
+        elif source == "line" and meas_idx is not None:
+            new_meas = self.calculate_line_measurements()
+            if new_meas:
+                self.measurements[meas_idx] = new_meas
+                self.measurement.set(f"Edit Points: Lines angle {new_meas['angle_deg']:.1f}°, AvgDist {new_meas['avg_dist_px']:.2f}px")
+        elif source == "calibration" and meas_idx is not None and len(self.calibration_dots) == 2:
+            calib = self.measurements[meas_idx]
+            try:
+                updated = calibration_measurement(self.calibration_dots[0], self.calibration_dots[1], calib.get("real_value_mm") or 0)
+            except ValueError:
+                updated = None # Points on top of each other: keep the last valid factor
+            if updated:
+                self.calibration_factor = updated["calibration_factor"]
+                calib.update(updated)
+                self.measurement.set(f"Edit Points: Calibration {self.calibration_factor:.4f} px/mm")
+        self._redraw_overlays()
+        if source in ("artery", "line"):
+            self._refresh_line_profile()
+
+    def _end_point_drag(self):
+        """Finishes a drag: refreshes mm values, text panel and table once."""
+        self.dragging_point = False
+        if not self.drag_moved: # Just a selection click
+            return
+        self.drag_moved = False
+        if self.selected_point and self.selected_point[0] == "calibration" and self.calibration_done:
+            self._refresh_calibrated_values()
+        if self.drag_dependents is not None: # Edited in place while dragging
+            self._journal_snapshot()
+        self.update_dot_coords_display()
+        self.update_tables()
+
+    def _refresh_calibrated_values(self):
+        """Recomputes the stored mm values of all measurements after the calibration factor changed."""
+        for i, meas in enumerate(self.measurements):
+            if meas.get("type") == "artery" and meas.get("distance_px") is not None:
+                meas["distance_mm"] = meas["distance_px"] / self.calibration_factor
+            elif meas.get("type") == "line" and [tuple(p) for p in meas.get("points", [])] == [tuple(p) for p in self.line_points]:
+                refreshed = self.calculate_line_measurements()
+                if refreshed: self.measurements[i] = refreshed
+
+    @traced("redraw overlays", "render")
+    def _redraw_overlays(self):
+        """Redraws only the overlay items, skipping the (expensive) image resize."""
+        if not self.image_canvas or not self.image_canvas.winfo_exists():
+            return
+        self.image_canvas.delete("overlay")
+        with self.perf.stage("overlay items"):
+            self._draw_overlays()
+        if self.zoom_box_mode:
+            self.update_zoom_box_content(None)
+        self.perf.frame()
+        self._draw_perf_hud()
+
+    # --- Performance HUD ---
+    def toggle_perf_hud(self, event=None):
+        """Shows/hides the on-canvas performance HUD (F3)."""
+        self.perf_hud_active = not self.perf_hud_active
+        if self._perf_hud_job:
+            self.root.after_cancel(self._perf_hud_job)
+            self._perf_hud_job = None
+        if self.perf_hud_active:
+            self._refresh_perf_hud()
+        else:
+            self.image_canvas.delete("perf_hud")
+
+    def _refresh_perf_hud(self):
+        """Redraws the HUD twice a second so it follows scrolling and shows the frame rate decaying."""
+        self._perf_hud_job = None
+        if not self.perf_hud_active or not self.root.winfo_exists():
+            return
+        self._draw_perf_hud()
+        self._perf_hud_job = self.root.after(500, self._refresh_perf_hud)
+
+    def _draw_perf_hud(self):
+        """Draws last/p95 timings per stage, frame rate and memory in the top-left corner of the view."""
+        if not self.image_canvas or not self.image_canvas.winfo_exists():
+            return
+        self.image_canvas.delete("perf_hud")
+        if not self.perf_hud_active:
+            return
+        lines = [f"{'stage':<26}{'last':>8}{'p95':>8}  ms"]
+        for name, last_ms, p95_ms, _ in self.perf.summary():
+            lines.append(f"{name:<26}{last_ms:8.1f}{p95_ms:8.1f}")
+        lines.append(f"fps {self.perf.fps():5.1f}   zoom {self.zoom_factor:.2f}x   undo {len(self.undo_stack)}")
+        lines.append("mem " + ", ".join(f"{name} {size / 1024**2:.1f}" for name, size in self.memory.breakdown())
+                     + f" MB (budget {self.memory.budget_bytes / 1024**2:.0f})")
+
+        x = self.image_canvas.canvasx(8)
+        y = self.image_canvas.canvasy(8)
+        text_id = self.image_canvas.create_text(x + 6, y + 4, anchor=tk.NW, text="\n".join(lines), fill="#7CFC00",
+                                                font=("Courier", 9), tags="perf_hud")
+        bbox = self.image_canvas.bbox(text_id)
+        if bbox:
+            bg_id = self.image_canvas.create_rectangle(bbox[0] - 6, bbox[1] - 4, bbox[2] + 6, bbox[3] + 4,
+                                                       fill="black", outline="gray40", stipple="gray75", tags="perf_hud")
+            self.image_canvas.tag_lower(bg_id, text_id)
+
+    def delete_selected_point(self, event=None):
+        """Deletes the point selected in Edit Points mode together with the measurement it belongs to."""
+        if not self.edit_points_mode or not self._get_point(self.selected_point):
+            if self.edit_points_mode:
+                self.measurement.set("Edit Points: No point selected.")
+            return
+        # Don't steal the Delete key from text entries
+        if event is not None and isinstance(event.widget, (tk.Entry, tk.Text)):
+            return
+
+        self.save_state()
+        source, idx = self.selected_point
+        if source == "artery":
+            first = idx - idx % 2
+            if first + 1 < len(self.artery_dots): # Complete pair -> remove both dots and the measurement
+                meas_idx = self._find_measurement("artery", self.artery_dots[first:first + 2])
+                if meas_idx is not None: del self.measurements[meas_idx]
+                del self.artery_dots[first:first + 2]
+            else: # Pending single dot
+                del self.artery_dots[idx]
+            status = "Edit Points: Dots pair deleted."
+        elif source == "line":
+            meas_idx = self._find_measurement("line", self.line_points) if len(self.line_points) == 4 else None
+            if meas_idx is not None: del self.measurements[meas_idx]
+            del self.line_points[idx]
+            self.line_measurements = []
+            self.line_measurement_points = []
+            status = "Edit Points: Line point deleted."
+        elif source == "calibration":
+            del self.calibration_dots[idx]
+            if self.calibration_done:
+                self.calibration_factor = 1.0
+                self.calibration_done = False
+                self.measurements = [m for m in self.measurements if m.get("type") != "calibration"]
+                status = "Edit Points: Calibration point deleted, calibration reset."
+            else:
+                status = "Edit Points: Calibration point deleted."
+        elif source == "angle_measurement":
+            del self.measurements[self._angle_measurement_indices()[idx // 3]]
+            status = "Edit Points: Angle measurement deleted."
+        else:
+            del self.angle_points[idx]
+            status = "Edit Points: Angle point deleted."
+
+        self.selected_point = None
+        self.point_index = None
+        self._journal_snapshot()
+        self.measurement.set(status)
+        self.update_dot_coords_display()
+        self.update_tables()
+        self.display_image()
+
     def reset_lines(self):
         """Resets the points and measurements for Line Mode."""
         self.save_state()
@@ -1800,6 +3125,7 @@ class ImageAnalyzer:
         self.line_measurement_points = [] # Points for drawing ticks
         # Remove line measurements from the main list
         self.measurements = [m for m in self.measurements if m.get("type") != "line"]
+        self._journal_snapshot()
         self.measurement.set("Status: Line Mode reset.")
         self.update_dot_coords_display()
         self.update_tables()
@@ -1808,86 +3134,13 @@ class ImageAnalyzer:
 
     def calculate_line_measurements(self):
         """Calculates distances between two parallel lines defined by 4 points."""
-        if len(self.line_points) != 4:
-             return None
-
-        p1, p2 = self.line_points[0], self.line_points[1] # First line segment
-        p3, p4 = self.line_points[2], self.line_points[3] # Second line segment
-
-        # --- Calculate Line Lengths ---
-        len1_px = math.sqrt((p2[0] - p1[0])**2 + (p2[1] - p1[1])**2)
-        len2_px = math.sqrt((p4[0] - p3[0])**2 + (p4[1] - p3[1])**2)
-
-        # --- Calculate Angle Between Lines ---
-        v1 = (p2[0] - p1[0], p2[1] - p1[1])
-        v2 = (p4[0] - p3[0], p4[1] - p3[1])
-        mag1_sq = v1[0]**2 + v1[1]**2
-        mag2_sq = v2[0]**2 + v2[1]**2
-        angle_deg = 0.0
-
-        if mag1_sq > 1e-9 and mag2_sq > 1e-9: # Avoid division by zero / zero length vectors
-            mag1 = math.sqrt(mag1_sq)
-            mag2 = math.sqrt(mag2_sq)
-            dot_product = v1[0] * v2[0] + v1[1] * v2[1]
-            # Clamp cos_theta to handle potential float errors slightly outside [-1, 1]
-            cos_theta = max(-1.0, min(1.0, dot_product / (mag1 * mag2)))
-            angle_deg = math.degrees(math.acos(cos_theta))
-            if angle_deg > 90: angle_deg = 180.0 - angle_deg
-        else:
-             print("Warning: Line Mode - One or both line segments have zero length.")
-             return None
-
-
-        # --- Calculate Perpendicular Distances ---
-        distances_px = []
-        self.line_measurement_points = [] # Reset points for drawing ticks
-        num_measures = 15
-
-        line2_vec = v2
-
-        if mag2_sq < 1e-9:
-             print("Error: Line 2 magnitude squared is zero in distance calculation loop.")
-             return None
-
-        for i in range(num_measures + 1):
-            t = i / num_measures
-            pt_on_line1 = (p1[0] + t * v1[0], p1[1] + t * v1[1])
-            p3_to_pt = (pt_on_line1[0] - p3[0], pt_on_line1[1] - p3[1])
-            t_proj = (p3_to_pt[0] * line2_vec[0] + p3_to_pt[1] * line2_vec[1]) / mag2_sq
-            closest_pt_on_inf_line2 = (p3[0] + t_proj * line2_vec[0], p3[1] + t_proj * line2_vec[1])
-            dist = math.sqrt((pt_on_line1[0] - closest_pt_on_inf_line2[0])**2 +
-                             (pt_on_line1[1] - closest_pt_on_inf_line2[1])**2)
-            distances_px.append(dist)
-            self.line_measurement_points.append((pt_on_line1, closest_pt_on_inf_line2))
-
-        # --- Calculate Averages --- <<< ADDED
-        avg_dist_px = sum(distances_px) / len(distances_px) if distances_px else 0
-        avg_dist_mm = None # Initialize
-
-        # --- Store results ---
-        result = {
-            "type": "line",
-            "points": self.line_points.copy(),
-            "length1_px": len1_px,
-            "length2_px": len2_px,
-            "angle_deg": angle_deg,
-            "distances_px": distances_px,
-            "avg_dist_px": avg_dist_px, # <<< ADDED AVG PX
-        }
-
-        # Add real distances AND averages if calibrated
-        if self.calibration_done:
-             result["length1_mm"] = len1_px / self.calibration_factor
-             result["length2_mm"] = len2_px / self.calibration_factor
-             distances_mm = [d / self.calibration_factor for d in distances_px]
-             result["distances_mm"] = distances_mm
-             # Calculate mm average only if mm distances were calculated
-             if distances_mm:
-                 avg_dist_mm = sum(distances_mm) / len(distances_mm)
-                 result["avg_dist_mm"] = avg_dist_mm # <<< ADDED AVG MM
-
-        self.line_measurements = distances_px # Legacy storage
-
+        result, ticks = line_mode_measurement(self.line_points, self.calibration_factor if self.calibration_done else None)
+        if result is None:
+            if len(self.line_points) == 4:
+                print("Warning: Line Mode - One or both line segments have zero length.")
+            return None
+        self.line_measurement_points = ticks # Tick markers drawn between the lines
+        self.line_measurements = result["distances_px"] # Legacy storage
         return result
 
     def show_line_measurements(self):
@@ -1987,6 +3240,367 @@ class ImageAnalyzer:
         window.wait_window()
 
 
+    # --- Line Profile ---
+    def _profile_segments(self):
+        """Segments a profile can be taken along: every complete Dots Mode pair and both Line Mode lines."""
+        segments = {}
+        for i in range(0, len(self.artery_dots) - 1, 2):
+            segments[f"Pair {i // 2 + 1}"] = ("artery", self.artery_dots[i], self.artery_dots[i + 1])
+        for i in range(0, len(self.line_points) - 1, 2):
+            segments[f"Line {i // 2 + 1}"] = ("line", self.line_points[i], self.line_points[i + 1])
+        return segments
+
+    def open_line_profile(self):
+        """Non-modal plot of the intensity along a pair or line; follows edits and drags live."""
+        if not self.img_original:
+            messagebox.showwarning("Intensity Profile", "Please load an image first.", parent=self.root)
+            return
+        if self.profile_window and self.profile_window.winfo_exists():
+            self.profile_window.lift()
+            return
+        window = Toplevel(self.root)
+        window.title("Intensity Profile")
+        window.geometry("560x340")
+        window.transient(self.root)
+        self.profile_window = window
+
+        controls = tk.Frame(window)
+        controls.pack(fill=tk.X, padx=10, pady=(10, 2))
+        tk.Label(controls, text="Segment:").pack(side=tk.LEFT)
+        self.profile_menu = tk.OptionMenu(controls, self.profile_segment, "")
+        self.profile_menu.pack(side=tk.LEFT, padx=(2, 10))
+        tk.Label(controls, text="Width (px):").pack(side=tk.LEFT)
+        tk.Spinbox(controls, from_=1, to=51, width=4, textvariable=self.profile_width).pack(side=tk.LEFT, padx=2)
+        tk.Button(controls, text="Export CSV/NPY...", command=self.export_line_profile).pack(side=tk.RIGHT)
+
+        self.profile_canvas = tk.Canvas(window, bg="white", highlightthickness=0)
+        self.profile_canvas.pack(fill=tk.BOTH, expand=True, padx=10, pady=(2, 10))
+        self.profile_canvas.bind("<Configure>", lambda e: self._refresh_line_profile())
+        self._profile_data = None
+        self._refresh_line_profile()
+
+    def _current_profile(self):
+        """(label, source, start, end, width, distances, profile) of the selected segment, or None."""
+        segments = self._profile_segments()
+        label = self.profile_segment.get()
+        if label not in segments:
+            return None
+        try:
+            width = max(1, min(51, int(self.profile_width.get())))
+        except (tk.TclError, ValueError):
+            width = 1 # Entry being typed into
+        source, start, end = segments[label]
+        distances, profile = line_profile(self._get_gray_array(), start, end, width)
+        return label, source, start, end, width, distances, profile
+
+    def _refresh_line_profile(self):
+        """Redraws the profile window if open. Called from update_tables and every drag step, so it never raises."""
+        if not self.profile_window or not self.profile_window.winfo_exists() or not self.img_original:
+            return
+        try:
+            self._update_line_profile()
+        except Exception as e:
+            print(traceback.format_exc())
+            self._profile_data = None
+            self.profile_canvas.delete("all")
+            self.profile_canvas.create_text(10, 10, anchor=tk.NW, text=f"Could not sample the profile: {e}")
+
+    def _update_line_profile(self):
+        # Keep the segment menu in sync with the points (pairs come and go while measuring)
+        labels = list(self._profile_segments())
+        menu = self.profile_menu["menu"]
+        last = menu.index(tk.END) # None when the menu is empty
+        if [menu.entrycget(i, "label") for i in range(0 if last is None else last + 1)] != labels:
+            menu.delete(0, tk.END)
+            for label in labels:
+                menu.add_command(label=label, command=lambda v=label: self.profile_segment.set(v))
+        current = self.profile_segment.get()
+        target = current if current in labels else (labels[-1] if labels else "")
+        if target != current:
+            self.profile_segment.set(target) # Re-enters via the trace
+            return
+        self._profile_data = self._current_profile()
+        self._draw_line_profile()
+
+    def _draw_line_profile(self):
+        canvas = self.profile_canvas
+        canvas.delete("all")
+        if not self._profile_data:
+            canvas.create_text(10, 10, anchor=tk.NW, text="Place a Dots Mode pair or a Line Mode line to see its profile.")
+            return
+        label, _, _, _, width, distances, profile = self._profile_data
+        left, top, right, bottom = 50, 10, canvas.winfo_width() - 10, canvas.winfo_height() - 30
+        if right - left < 20 or bottom - top < 20:
+            return
+        low, high = float(profile.min()), float(profile.max())
+        span_y = max(high - low, 1e-6)
+        span_x = max(float(distances[-1]), 1e-6)
+        xs = left + distances / span_x * (right - left)
+        ys = bottom - (profile - low) / span_y * (bottom - top)
+        canvas.create_rectangle(left, top, right, bottom, outline="gray70")
+        canvas.create_line(*np.column_stack((xs, ys)).ravel().tolist(), fill="blue")
+
+        unit, length = "px", span_x
+        if self.calibration_done and self.calibration_factor:
+            unit, length = "mm", span_x / self.calibration_factor
+        canvas.create_text(left - 4, top, anchor=tk.NE, text=f"{high:.0f}")
+        canvas.create_text(left - 4, bottom, anchor=tk.SE, text=f"{low:.0f}")
+        canvas.create_text(left, bottom + 4, anchor=tk.NW, text="0")
+        canvas.create_text(right, bottom + 4, anchor=tk.NE, text=f"{length:.2f} {unit}")
+        canvas.create_text((left + right) / 2, bottom + 4, anchor=tk.N,
+                           text=f"{label}, width {width} px, {len(profile)} samples")
+
+    def export_line_profile(self):
+        """Writes the shown profile with its measurement as CSV (with a header) or NPY."""
+        data = self._profile_data
+        if not data:
+            messagebox.showwarning("Export Profile", "No profile to export.", parent=self.profile_window)
+            return
+        label, source, start, end, width, distances, profile = data
+        base = os.path.splitext(os.path.basename(self.file_path))[0]
+        filename = filedialog.asksaveasfilename(
+            title="Export Intensity Profile",
+            initialfile=f"{base}_profile_{label.replace(' ', '').lower()}.csv",
+            defaultextension=".csv",
+            filetypes=[("CSV Files", "*.csv"), ("NumPy Array", "*.npy"), ("All Files", "*.*")],
+            parent=self.profile_window
+        )
+        if not filename:
+            return
+        header = {"image": self.file_path, "segment": label,
+                  "start": f"({start[0]:.2f}, {start[1]:.2f})", "end": f"({end[0]:.2f}, {end[1]:.2f})",
+                  "width_px": width}
+        points = [start, end] if source == "artery" else self.line_points
+        meas_idx = self._find_measurement(source, points)
+        if meas_idx is not None:
+            meas = clean_measurement(self.measurements[meas_idx])
+            header["measurement"] = json.dumps({k: v for k, v in meas.items() if k != "points"}, default=float)
+        calibration = self.calibration_factor if self.calibration_done else None
+        try:
+            export_line_profile(filename, distances, profile, calibration, header)
+        except Exception as e:
+            messagebox.showerror("Export Profile", f"Failed to write profile:\n{e}", parent=self.profile_window)
+            print(traceback.format_exc())
+            return
+        self.measurement.set(f"Status: Profile of {label} ({len(profile)} samples) saved to {os.path.basename(filename)}.")
+
+    # --- Threshold Sweep ---
+    def open_canny_sweep(self):
+        """Non-modal contact sheet of Canny results over a grid of thresholds; clicking a tile applies it."""
+        if not self.img_original:
+            messagebox.showwarning("Threshold Sweep", "Please load an image first.", parent=self.root)
+            return
+        if self.sweep_window and self.sweep_window.winfo_exists():
+            self.sweep_window.lift()
+            return
+        window = Toplevel(self.root)
+        window.title("Canny Threshold Sweep")
+        window.geometry("900x700")
+        window.transient(self.root)
+        window.protocol("WM_DELETE_WINDOW", self._close_canny_sweep)
+        self.sweep_window = window
+
+        grid = tk.Frame(window)
+        grid.pack(fill=tk.X, padx=10, pady=(10, 2))
+        self.sweep_values = {}
+        for row, (key, label, default) in enumerate((("low", "Low values:", "20, 40, 60, 80"),
+                                                     ("high", "High values:", "80, 120, 160, 200"),
+                                                     ("blur", "Blur sigmas:", "0"))):
+            tk.Label(grid, text=label, anchor=tk.W).grid(row=row, column=0, sticky=tk.W)
+            self.sweep_values[key] = tk.StringVar(value=default)
+            tk.Entry(grid, textvariable=self.sweep_values[key]).grid(row=row, column=1, sticky=tk.EW, padx=5)
+        grid.columnconfigure(1, weight=1)
+        tk.Button(grid, text="Run Sweep", command=self.run_canny_sweep).grid(row=0, column=2, rowspan=3, sticky=tk.NS, padx=5)
+
+        self.sweep_status = tk.StringVar(value="Sweeps the Canny ROI if one is selected, else the whole image (downsampled).")
+        tk.Label(window, textvariable=self.sweep_status, anchor=tk.W).pack(fill=tk.X, padx=10)
+
+        sheet_frame = tk.Frame(window)
+        sheet_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(2, 10))
+        self.sweep_canvas = tk.Canvas(sheet_frame, bg="gray20", highlightthickness=0)
+        sheet_scrollbar = Scrollbar(sheet_frame, orient=tk.VERTICAL, command=self.sweep_canvas.yview)
+        self.sweep_canvas.configure(yscrollcommand=sheet_scrollbar.set)
+        sheet_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.sweep_canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.sweep_canvas.bind("<Button-1>", self._on_sweep_click)
+        self.sweep_photo = None
+        self.sweep_results = []
+        self.sweep_boxes = []
+        self.run_canny_sweep()
+
+    def _close_canny_sweep(self):
+        self._sweep_generation += 1 # Cancels a running sweep
+        self.sweep_results = [] # Edge maps of every tile; not worth keeping once closed
+        self.sweep_photo = None
+        self.sweep_window.destroy()
+
+    def run_canny_sweep(self):
+        """Computes the sweep on a background thread (threads in canny_sweep share the gradients)."""
+        try:
+            values = {key: sorted({float(v) if key == "blur" else int(v)
+                                   for v in var.get().replace(",", " ").split()})
+                      for key, var in self.sweep_values.items()}
+        except ValueError:
+            messagebox.showerror("Threshold Sweep", "Values must be numbers separated by commas or spaces.", parent=self.sweep_window)
+            return
+        if not values["low"] or not values["high"]:
+            messagebox.showerror("Threshold Sweep", "Enter at least one low and one high threshold.", parent=self.sweep_window)
+            return
+        values["blur"] = values["blur"] or [0.0]
+
+        self._sweep_generation += 1
+        generation = self._sweep_generation
+        roi = None if self.global_canny_active else self._canny_roi_image_coords()
+        gray = self._get_filter_input()
+        results_queue = queue.Queue()
+
+        def run():
+            try:
+                region, scale = sweep_source(gray, roi)
+                results = canny_sweep(region, values["low"], values["high"], values["blur"],
+                                      cancelled=lambda: generation != self._sweep_generation)
+                if results is not None:
+                    sheet, boxes = render_contact_sheet(results)
+                    results_queue.put(("done", (results, sheet, boxes, region.shape, scale)))
+            except Exception as e:
+                print(traceback.format_exc())
+                results_queue.put(("error", e))
+
+        self.sweep_status.set(f"Computing {'ROI' if roi else 'full image'} sweep...")
+        self._sweep_started = time.perf_counter()
+        threading.Thread(target=run, name="CannySweep", daemon=True).start()
+        self.root.after(30, self._poll_canny_sweep, generation, results_queue)
+
+    def _poll_canny_sweep(self, generation, results_queue):
+        if generation != self._sweep_generation or not self.sweep_window or not self.sweep_window.winfo_exists():
+            return # Superseded or closed
+        try:
+            kind, payload = results_queue.get_nowait()
+        except queue.Empty:
+            self.root.after(30, self._poll_canny_sweep, generation, results_queue)
+            return
+        if kind == "error":
+            self.sweep_status.set(f"Sweep failed: {payload}")
+            return
+        self.sweep_results, sheet, self.sweep_boxes, shape, scale = payload
+        self.sweep_photo = ImageTk.PhotoImage(sheet)
+        self.sweep_canvas.delete("all")
+        self.sweep_canvas.create_image(0, 0, anchor=tk.NW, image=self.sweep_photo)
+        self.sweep_canvas.configure(scrollregion=(0, 0, sheet.width, sheet.height))
+        scaled = f", downsampled to {scale:.0%}" if scale < 1 else ""
+        self.sweep_status.set(f"{len(self.sweep_results)} results on {shape[1]}x{shape[0]} px{scaled} in "
+                              f"{time.perf_counter() - self._sweep_started:.2f}s. Click a tile to apply its thresholds.")
+
+    def _on_sweep_click(self, event):
+        x, y = self.sweep_canvas.canvasx(event.x), self.sweep_canvas.canvasy(event.y)
+        for result, (x1, y1, x2, y2) in zip(self.sweep_results, self.sweep_boxes):
+            if x1 <= x < x2 and y1 <= y < y2:
+                break
+        else:
+            return
+        self.sweep_canvas.delete("sweep_selection")
+        self.sweep_canvas.create_rectangle(x1 - 1, y1 - 1, x2 + 1, y2 + 1, outline="cyan", width=2, tags="sweep_selection")
+        self._suppress_filter_trace = True # One filter pass for both sliders
+        try:
+            self.canny_low.set(result["low"])
+            self.canny_high.set(result["high"])
+        finally:
+            self._suppress_filter_trace = False
+        if not self.global_canny_active and not self._canny_roi_image_coords():
+            self.toggle_global_canny() # Show the chosen result right away (also filters)
+        else:
+            self.apply_filters_and_display()
+        note = " (blur not applied; add a Gaussian stage to the pipeline)" if result["blur"] else ""
+        self.measurement.set(f"Status: Applied sweep thresholds {sweep_label(result)}{note}.")
+
+    # --- Filter Pipeline ---
+    def open_filter_pipeline(self):
+        """Non-modal editor for the preprocessing stages; every change re-filters (only changed stages recompute)."""
+        if self.pipeline_window and self.pipeline_window.winfo_exists():
+            self.pipeline_window.lift()
+            return
+        window = Toplevel(self.root)
+        window.title("Filter Pipeline")
+        window.geometry("440x400")
+        window.transient(self.root)
+        self.pipeline_window = window
+
+        tk.Label(window, text="Stages run in order on the grayscale image, before Canny:", anchor=tk.W).pack(fill=tk.X, padx=10, pady=(10, 2))
+        self.pipeline_list = tk.Listbox(window, height=8, exportselection=False)
+        self.pipeline_list.pack(fill=tk.X, padx=10)
+        self.pipeline_list.bind("<<ListboxSelect>>", lambda e: self._show_stage_params())
+
+        controls = tk.Frame(window)
+        controls.pack(fill=tk.X, padx=10, pady=5)
+        stage_type = tk.StringVar(value=next(iter(FILTER_STAGES)))
+        tk.OptionMenu(controls, stage_type, *FILTER_STAGES).pack(side=tk.LEFT)
+        tk.Button(controls, text="Add", command=lambda: self._edit_pipeline("add", stage_type.get())).pack(side=tk.LEFT, padx=2)
+        for label, action in (("Remove", "remove"), ("Up", "up"), ("Down", "down"), ("On/Off", "toggle")):
+            tk.Button(controls, text=label, command=lambda a=action: self._edit_pipeline(a)).pack(side=tk.LEFT, padx=2)
+
+        self.pipeline_params_frame = tk.LabelFrame(window, text="Parameters", bd=2, relief=tk.GROOVE)
+        self.pipeline_params_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        self._refresh_pipeline_list()
+
+    def _selected_stage_index(self):
+        selection = self.pipeline_list.curselection() if self.pipeline_window and self.pipeline_window.winfo_exists() else ()
+        return selection[0] if selection else None
+
+    def _refresh_pipeline_list(self, select=None):
+        if not self.pipeline_window or not self.pipeline_window.winfo_exists():
+            return
+        self.pipeline_list.delete(0, tk.END)
+        for stage in self.filter_pipeline.stages:
+            self.pipeline_list.insert(tk.END, FilterPipeline.describe(stage))
+        if select is not None and self.filter_pipeline.stages:
+            self.pipeline_list.selection_set(min(select, len(self.filter_pipeline.stages) - 1))
+        self._show_stage_params()
+
+    def _edit_pipeline(self, action, stage_name=None):
+        index = self._selected_stage_index()
+        if action == "add":
+            index = len(self.filter_pipeline.stages) if index is None else index + 1
+            self.filter_pipeline.add(stage_name, index=index)
+        elif index is None:
+            return
+        elif action == "remove":
+            self.filter_pipeline.remove(index)
+        elif action in ("up", "down"):
+            index = self.filter_pipeline.move(index, -1 if action == "up" else 1)
+        elif action == "toggle":
+            self.filter_pipeline.update(index, enabled=not self.filter_pipeline.stages[index]["enabled"])
+        self._refresh_pipeline_list(select=index)
+        self.apply_filters_and_display()
+
+    def _show_stage_params(self):
+        """Fills the parameter panel with one entry per parameter of the selected stage."""
+        for child in self.pipeline_params_frame.winfo_children():
+            child.destroy()
+        index = self._selected_stage_index()
+        if index is None:
+            tk.Label(self.pipeline_params_frame, text="Select a stage to edit its parameters.").pack(padx=5, pady=5)
+            return
+        stage = self.filter_pipeline.stages[index]
+        entries = {}
+        for key, value in stage["params"].items():
+            row = tk.Frame(self.pipeline_params_frame)
+            row.pack(fill=tk.X, padx=5, pady=1)
+            tk.Label(row, text=f"{key}:", width=12, anchor=tk.W).pack(side=tk.LEFT)
+            entries[key] = tk.StringVar(value=str(value))
+            entry = tk.Entry(row, textvariable=entries[key])
+            entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+            entry.bind("<Return>", lambda e: apply_params())
+
+        def apply_params():
+            try:
+                self.filter_pipeline.update(index, {key: var.get() for key, var in entries.items()})
+            except ValueError as e:
+                messagebox.showerror("Filter Pipeline", str(e), parent=self.pipeline_window)
+                return
+            self._refresh_pipeline_list(select=index)
+            self.apply_filters_and_display()
+        tk.Button(self.pipeline_params_frame, text="Apply", command=apply_params).pack(pady=5)
+
     def reset_filters(self):
         """Resets all filter effects and selections."""
         self.save_state()
@@ -2004,6 +3618,9 @@ class ImageAnalyzer:
             try: self.buttons["Global Canny"].config(relief=tk.RAISED)
             except tk.TclError: pass
 
+        self.filter_pipeline = FilterPipeline()
+        self._refresh_pipeline_list()
+
         self.edge_detection_active = False
         self.selection_start = None
         self.selection_end = None
@@ -2048,6 +3665,7 @@ class ImageAnalyzer:
         max_undo = 50
         if len(self.undo_stack) > max_undo:
             self.undo_stack.pop(0)
+        # Budget not enforced here (every click): the 2 s poll catches undo growth
 
 
     def _restore_state(self, state):
@@ -2070,6 +3688,9 @@ class ImageAnalyzer:
          self.selection_end = state.get("selection_end")
          self.edge_detection_active = state.get("edge_detection_active", False)
          self.global_canny_active = state.get("global_canny_active", False) # Added
+         self.point_index = None # Point lists replaced -> rebuild spatial index on demand
+         self._journal_snapshot() # Undo/redo
+         self.selected_point = None
 
          # Update Global Canny button state
          if "Global Canny" in self.buttons:
@@ -2168,58 +3789,8 @@ class ImageAnalyzer:
             return
 
         # Start with the currently displayed image (could be filtered or original)
-        img_to_export = (self.img_filtered if self.img_filtered is not None else self.img_original).copy()
-        # Ensure it's suitable for color drawing
-        if img_to_export.mode not in ('RGB', 'RGBA'):
-             img_to_export = img_to_export.convert('RGBA')
-        elif img_to_export.mode == 'RGB':
-             img_to_export = img_to_export.convert('RGBA') # Ensure alpha for drawing
-
-        draw = ImageDraw.Draw(img_to_export)
-
-        dot_radius = 3
-        line_width = 2
-
-        # Calibration dots
-        for x, y in self.calibration_dots:
-            draw.ellipse((x - dot_radius, y - dot_radius, x + dot_radius, y + dot_radius), fill="cyan", outline="black")
-
-        # Artery dots and lines
-        for i in range(0, len(self.artery_dots)):
-            x, y = self.artery_dots[i]
-            draw.ellipse((x - dot_radius, y - dot_radius, x + dot_radius, y + dot_radius), fill="yellow", outline="black")
-            if i % 2 == 1:
-                x_prev, y_prev = self.artery_dots[i-1]
-                draw.line([(x_prev, y_prev), (x, y)], fill="yellow", width=line_width)
-
-        # Line mode points and lines
-        for i in range(0, len(self.line_points)):
-            x, y = self.line_points[i]
-            draw.ellipse((x - dot_radius, y - dot_radius, x + dot_radius, y + dot_radius), fill="magenta", outline="black")
-            if i % 2 == 1:
-                x_prev, y_prev = self.line_points[i-1]
-                draw.line([(x_prev, y_prev), (x, y)], fill="magenta", width=line_width)
-
-        # Angle points and lines
-        if self.angle_points:
-             p1_a, p2_a, p3_a = None, None, None
-             if len(self.angle_points) >= 1: p1_a = self.angle_points[0]
-             if len(self.angle_points) >= 2: p2_a = self.angle_points[1]
-             if len(self.angle_points) >= 3: p3_a = self.angle_points[2]
-
-             if p1_a: draw.ellipse((p1_a[0]-dot_radius, p1_a[1]-dot_radius, p1_a[0]+dot_radius, p1_a[1]+dot_radius), fill="lime green", outline="black")
-             if p2_a:
-                 draw.ellipse((p2_a[0]-dot_radius, p2_a[1]-dot_radius, p2_a[0]+dot_radius, p2_a[1]+dot_radius), fill="lime green", outline="black")
-                 if p1_a: draw.line([p1_a, p2_a], fill="lime green", width=line_width, joint="curve")
-             if p3_a:
-                 draw.ellipse((p3_a[0]-dot_radius, p3_a[1]-dot_radius, p3_a[0]+dot_radius, p3_a[1]+dot_radius), fill="lime green", outline="black")
-                 if p2_a: draw.line([p2_a, p3_a], fill="lime green", width=line_width, joint="curve")
-
-        # Line mode measurement ticks
-        tick_radius = 2
-        for p1, p2 in self.line_measurement_points:
-             draw.ellipse((p1[0]-tick_radius, p1[1]-tick_radius, p1[0]+tick_radius, p1[1]+tick_radius), fill="red", outline="red")
-             draw.line([p1, p2], fill="red", width=1)
+        source_img = self.img_filtered if self.img_filtered is not None else self.img_original
+        primitives = build_overlay_primitives(**self._overlay_geometry())
 
         # Ask for save file path
         base_name = os.path.splitext(os.path.basename(self.file_path))[0] if self.file_path else "image"
@@ -2234,22 +3805,61 @@ class ImageAnalyzer:
         if save_path:
             try:
                 save_format = os.path.splitext(save_path)[1].lower()
-                final_image_to_save = img_to_export
-                if save_format == ".jpg" or save_format == ".jpeg":
-                     if final_image_to_save.mode == 'RGBA':
-                          bg = Image.new("RGB", final_image_to_save.size, (255, 255, 255))
-                          bg.paste(final_image_to_save, mask=final_image_to_save.split()[3])
-                          final_image_to_save = bg
-                     elif final_image_to_save.mode != 'RGB':
-                          final_image_to_save = final_image_to_save.convert('RGB')
-
-                final_image_to_save.save(save_path)
+                streamable = save_format == ".png" or (save_format in STREAMING_EXPORT_FORMATS and tifffile)
+                if streamable and source_img.width * source_img.height >= STREAMING_EXPORT_MIN_PIXELS:
+                    # Large image: render and write tile by tile instead of copying the whole image
+                    def report_progress(fraction):
+                        self.measurement.set(f"Status: Exporting tiles... {fraction:.0%}")
+                        self.root.update_idletasks()
+                    export_annotated_streaming(save_path, PILTileSource(source_img), primitives, progress=report_progress)
+                    self.measurement.set("Status: Export finished.")
+                else:
+                    img_to_export = source_img.convert('RGBA') # Copy with alpha for drawing
+                    draw_overlay_primitives(ImageDraw.Draw(img_to_export), primitives)
+                    final_image_to_save = prepare_for_format(img_to_export, save_format)
+                    final_image_to_save.save(save_path, **EXPORT_ENCODER_SETTINGS.get(save_format, {}))
                 messagebox.showinfo("Export Successful", f"Annotated image saved to:\n{save_path}", parent=self.root)
             except Exception as e:
                 messagebox.showerror("Export Error", f"Failed to save image:\n{e}", parent=self.root)
                 print(traceback.format_exc())
 
 
+    def _overlay_geometry(self):
+        """Current overlay point lists as build_overlay_primitives keyword arguments."""
+        return {"calibration_dots": self.calibration_dots, "artery_dots": self.artery_dots,
+                "line_points": self.line_points,
+                "angle_sets": [self.measurements[i]["points"] for i in self._angle_measurement_indices()] + [self.angle_points],
+                "tick_segments": self.line_measurement_points}
+
+    def export_overlay(self, reuse_path=False):
+        """Writes only the overlays as SVG (or compact JSON), linked to the untouched source image."""
+        if not self.img_original:
+            messagebox.showerror("Export Error", "No image loaded to export.", parent=self.root)
+            return
+
+        save_path = self.overlay_export_path if reuse_path else None
+        if not save_path:
+            base_name = os.path.splitext(os.path.basename(self.file_path))[0] if self.file_path else "image"
+            save_path = filedialog.asksaveasfilename(
+                title="Save Overlay As",
+                initialfile=os.path.basename(self.overlay_export_path or f"{base_name}_overlay.svg"),
+                defaultextension=".svg",
+                filetypes=[("SVG Overlay", "*.svg"), ("Overlay JSON", "*.json")],
+                parent=self.root
+            )
+            if not save_path:
+                return
+
+        try:
+            start = time.perf_counter()
+            write_overlay_export(save_path, self._overlay_geometry(), self.img_original.size, self.file_path)
+            self.overlay_export_path = save_path
+            self.measurement.set(f"Status: Overlay saved to {os.path.basename(save_path)} "
+                                 f"in {(time.perf_counter() - start) * 1000:.0f} ms.")
+        except Exception as e:
+            messagebox.showerror("Export Error", f"Failed to save overlay:\n{e}", parent=self.root)
+            print(traceback.format_exc())
+
     def save_measurements_to_json(self):
         """Saves all collected measurement data, calibration, and metadata to a JSON file."""
         if not self.file_path:
@@ -2282,57 +3892,10 @@ class ImageAnalyzer:
 
         current_time = datetime.datetime.now()
         time_str = current_time.strftime("%Y-%m-%d_%H-%M-%S")
-        time_iso = current_time.isoformat()
-
-        data = {
-            "metadata": {
-                "source_image_path": self.file_path,
-                "source_image_name": os.path.basename(self.file_path),
-                "analysis_name": name,
-                "analysis_timestamp_iso": time_iso,
-                "expected_real_diameter_mm": real_diameter,
-                "software_version": "ImageAnalyzer_1.4_JsonMmAvg" # Example version
-            },
-            "calibration": {
-                "calibrated": self.calibration_done,
-                "pixels_per_mm": round(self.calibration_factor, 6) if self.calibration_done else None,
-                "calibration_points": [(round(p[0], 1), round(p[1], 1)) for p in self.calibration_dots]
-            },
-            "measurements": []
-        }
-
-        # Add measurements, ensuring consistent formatting
-        for meas in self.measurements:
-            clean_meas = meas.copy() # Work on a copy
-
-            # Round floats for cleaner output - Revised to handle specific keys better
-            for key, value in clean_meas.items():
-                 if isinstance(value, float):
-                     round_digits = 4 # Default rounding for floats
-                     if key.endswith("_mm"): round_digits = 4
-                     elif key.endswith("_px"): round_digits = 2
-                     elif key.endswith("_deg"): round_digits = 2
-                     elif key == "calibration_factor": round_digits = 6
-                     # Apply rounding
-                     clean_meas[key] = round(value, round_digits)
-
-                 elif isinstance(value, list): # Handle lists (like points or distance lists)
-                     if key == "points":
-                          # Round points (tuples) within the list
-                          clean_meas[key] = [(round(pt[0], 1), round(pt[1], 1))
-                                             if isinstance(pt, (list, tuple)) and len(pt)==2
-                                             else pt
-                                             for pt in value]
-                     elif key == "distances_px":
-                         # Round pixel distances in the list
-                         clean_meas[key] = [round(d, 2) if isinstance(d, (int, float)) else d for d in value]
-                     elif key == "distances_mm":
-                          # Round mm distances in the list
-                          clean_meas[key] = [round(d, 4) if isinstance(d, (int, float)) else d for d in value]
-
-            # Add the processed measurement to the final data
-            data["measurements"].append(clean_meas)
-
+        data = build_analysis_data(self.file_path, name, real_diameter,
+                                   self.calibration_factor if self.calibration_done else None,
+                                   self.calibration_dots, self.measurements, current_time,
+                                   filters=self._filter_settings(), intensity_stats=self._roi_statistics())
 
         # Ask for save file location
         default_filename = f"analysis_{name}_{time_str}.json"
@@ -2346,16 +3909,477 @@ class ImageAnalyzer:
 
         if filename:
             try:
-                with open(filename, 'w') as f:
+                with TRACE.span("save analysis", "io"), open(filename, 'w') as f:
                     json.dump(data, f, indent=4) # Use indent for readability
+                self._journal_record("saved", path=filename, image=self.file_path)
                 messagebox.showinfo("Save Successful", f"Analysis data saved to:\n{filename}", parent=self.root)
             except Exception as e:
                 messagebox.showerror("Save Error", f"Failed to save JSON file:\n{e}", parent=self.root)
                 print(traceback.format_exc())
 
                 
+    # --- Session Journal ---
+    def _journal_record(self, event, **data):
+        if self.journal:
+            self.journal.record(event, **data)
+
+    def _journal_added(self, meas):
+        """Journals one appended measurement; the per-click case, so it costs O(1)."""
+        if self.journal:
+            self.journal.record("measurement", measurement=dict(meas))
+
+    def _journal_snapshot(self):
+        """Journals the whole measurement list and calibration after a removal, in-place edit, undo/redo or restore."""
+        if not self.journal:
+            return
+        self.journal.record("measurements", measurements=[dict(m) for m in self.measurements])
+        self.journal.record("calibration", done=self.calibration_done, factor=self.calibration_factor,
+                            dots=list(self.calibration_dots))
+
+    def _update_journal_status(self):
+        """Shows journal write rate and backlog in the status bar (polled)."""
+        if not self.journal or not self.root.winfo_exists():
+            return
+        stats = self.journal.stats()
+        if stats["last_error"]:
+            self.journal_info.set("Journal: ERROR")
+        else:
+            self.journal_info.set(f"Journal: {stats['records_written']} rec, {stats['rate_per_sec']:.1f}/s, backlog {stats['backlog']}")
+        self.root.after(2000, self._update_journal_status)
+
+    def _offer_journal_recovery(self):
+        """On startup, offers to replay the newest journal a crashed session left with unsaved work."""
+        journals = find_recoverable_journals(exclude=self.journal.path if self.journal else None)
+        if not journals:
+            return
+        path, summary = journals[0]
+        image_name = os.path.basename(summary["last_image"] or "?")
+        recover = messagebox.askyesno("Recover Session",
+                                      f"Found {len(journals)} unsaved session journal(s) from a previous run.\n"
+                                      f"Recover the most recent one (last image: {image_name})?", parent=self.root)
+        # Either way, don't offer these journals again on the next start
+        for journal_path, _ in journals:
+            try: os.replace(journal_path, journal_path + ".closed")
+            except OSError: pass
+        if recover:
+            self._apply_journal(summary)
+
+    def recover_session(self):
+        """Lets the user pick any journal (open or closed) and replays it."""
+        journal_path = filedialog.askopenfilename(
+            title="Select Session Journal",
+            initialdir=JOURNAL_DIR if os.path.isdir(JOURNAL_DIR) else None,
+            filetypes=[("Session Journals", "*.jsonl *.closed"), ("All Files", "*.*")],
+            parent=self.root
+        )
+        if not journal_path:
+            return
+        try:
+            summary = scan_journal(journal_path)
+        except OSError as e:
+            messagebox.showerror("Recover Session", f"Could not read journal:\n{e}", parent=self.root)
+            return
+        self._apply_journal(summary)
+
+    def _apply_journal(self, summary):
+        """Opens the last image of a replayed journal and restores its measurements and calibration."""
+        image_path = summary["last_image"]
+        if not image_path or not os.path.isfile(image_path):
+            messagebox.showerror("Recover Session", f"Image from the journal not found:\n{image_path}", parent=self.root)
+            return
+        if not self.open_image_path(image_path):
+            return
+        state = summary["states"].get(image_path, {})
+        self._restore_measurements(state.get("measurements", []), state.get("calibration"))
+        self.measurement.set(f"Status: Recovered {len(self.measurements)} measurement(s) from journal.")
+
+    def _restore_measurements(self, measurements, calibration=None, redraw=True):
+        """Replaces the current image's measurements and calibration in bulk, redrawing once at the end."""
+        restored = []
+        for meas in measurements:
+            if not isinstance(meas, dict) or "type" not in meas:
+                continue
+            meas = dict(meas)
+            if isinstance(meas.get("points"), list): # JSON turns tuples into lists
+                meas["points"] = [tuple(p) for p in meas["points"]]
+            restored.append(meas)
+        self.measurements = restored
+
+        # Rebuild the point lists the overlays are drawn from
+        self.artery_dots, self.line_points, _ = overlay_points_from_measurements(restored)
+        self.line_measurement_points = []
+        self.line_measurements = []
+        self.angle_points = []
+
+        calib_meas = next((m for m in restored if m["type"] == "calibration"), None)
+        if calibration and calibration.get("done"):
+            self.calibration_done = True
+            self.calibration_factor = float(calibration.get("factor") or 1.0)
+            self.calibration_dots = [tuple(p) for p in calibration.get("dots") or []]
+        elif calib_meas and calib_meas.get("calibration_factor"):
+            self.calibration_done = True
+            self.calibration_factor = float(calib_meas["calibration_factor"])
+            self.calibration_dots = list(calib_meas.get("points", []))
+        else:
+            self.calibration_done = False
+            self.calibration_factor = 1.0
+            self.calibration_dots = [tuple(p) for p in (calibration or {}).get("dots") or []]
+
+        if len(self.line_points) == 4:
+            self.calculate_line_measurements() # Rebuilds the tick overlay only
+        self.point_index = None
+        self._journal_snapshot()
+        if redraw:
+            self.update_dot_coords_display()
+            self.update_tables()
+            self.display_image()
+
+    # --- Per-Image Sessions ---
+    def _capture_image_session(self):
+        """Returns the current image's analysis state as plain JSON-able data (None if there is nothing to keep)."""
+        roi = self._canny_roi_image_coords()
+        state = {
+            "image_path": self.file_path,
+            "image_size": list(self.img_original.size) if self.img_original else None,
+            "measurements": [dict(m) for m in self.measurements],
+            "calibration": {"done": self.calibration_done, "factor": self.calibration_factor,
+                            "dots": list(self.calibration_dots)},
+            "artery_dots": list(self.artery_dots),
+            "line_points": list(self.line_points),
+            "angle_points": list(self.angle_points),
+            "filters": self._filter_settings(),
+            "name": self.name_var.get(),
+            "diameter": self.diameter_var.get(),
+        }
+        has_work = (state["measurements"] or self.calibration_dots or self.artery_dots or self.line_points
+                    or self.angle_points or self.global_canny_active or roi)
+        return state if has_work else None
+
+    def _stash_image_session(self):
+        """Stores the current image's state before switching images. Returns it for calibration carry-forward."""
+        if not self.file_path or not self.img_original:
+            return None
+        state = self._capture_image_session()
+        if state:
+            self.image_sessions.put(self.file_path, state)
+        else:
+            self.image_sessions.discard(self.file_path)
+        return state
+
+    def _show_new_image(self, previous_session=None):
+        """Displays a freshly loaded image: its stored session if any, else auto thresholds if enabled."""
+        self._start_integrals_build()
+        if not self._restore_image_session(previous_session):
+            if self.auto_canny_on_load.get():
+                self.apply_auto_thresholds() # Also filters and displays
+            else:
+                self.display_image()
+        self._enforce_memory_budget() # New image and display buffers: the largest allocation there is
+
+    def _restore_image_session(self, previous_session=None):
+        """Restores the stored state of the newly loaded image, or carries calibration forward.
+
+        Returns True if the image was (re)displayed.
+        """
+        state = self.image_sessions.get(self.file_path)
+        if state is None:
+            return self._carry_calibration_forward(previous_session)
+
+        self._restore_measurements(state["measurements"], state["calibration"], redraw=False)
+        self.artery_dots = [tuple(p) for p in state["artery_dots"]]
+        self.line_points = [tuple(p) for p in state["line_points"]]
+        self.angle_points = [tuple(p) for p in state["angle_points"]]
+        if len(self.line_points) != 4:
+            self.line_measurement_points = []
+        self.name_var.set(state.get("name", ""))
+        self.diameter_var.set(state.get("diameter", ""))
+
+        self._apply_filter_settings(state["filters"])
+
+        self.update_dot_coords_display()
+        self.update_tables()
+        self.apply_filters_and_display() # Recomputes the (cached) filter output and displays
+        self.measurement.set(f"Status: Restored session for {os.path.basename(self.file_path)} "
+                             f"({len(self.measurements)} measurement(s)).")
+        return True
+
+    def _filter_settings(self):
+        """Current filter configuration as plain data (kept in image sessions and the analysis JSON)."""
+        roi = self._canny_roi_image_coords()
+        return {"global_canny": self.global_canny_active, "canny_roi": list(roi) if roi else None,
+                "canny_low": self.canny_low.get(), "canny_high": self.canny_high.get(),
+                "filter_pipeline": self.filter_pipeline.to_json()}
+
+    def _apply_filter_settings(self, filters):
+        """Restores _filter_settings() output without filtering; the caller applies once afterwards."""
+        self._suppress_filter_trace = True
+        try:
+            self.canny_low.set(filters["canny_low"])
+            self.canny_high.set(filters["canny_high"])
+        finally:
+            self._suppress_filter_trace = False
+        if "filter_pipeline" in filters: # Sessions/analyses from before the pipeline existed keep the current one
+            self.filter_pipeline = FilterPipeline.from_json(filters["filter_pipeline"])
+            self._refresh_pipeline_list()
+        self.global_canny_active = filters["global_canny"]
+        roi = filters["canny_roi"]
+        if roi and not self.global_canny_active:
+            # ROI is kept in image coords; the canvas selection depends on the current zoom
+            self.canny_start = (roi[0] * self.zoom_factor, roi[1] * self.zoom_factor)
+            self.canny_end = (roi[2] * self.zoom_factor, roi[3] * self.zoom_factor)
+        if "Global Canny" in self.buttons:
+            self.buttons["Global Canny"].config(relief=tk.SUNKEN if self.global_canny_active else tk.RAISED)
+
+    def _carry_calibration_forward(self, previous_session):
+        """Copies the previous image's calibration if enabled and the new image is from the same series."""
+        if not self.carry_calibration.get() or not previous_session or not self.img_original:
+            return False
+        calibration = previous_session["calibration"]
+        previous_path = previous_session["image_path"]
+        if not calibration["done"] or previous_session["image_size"] != list(self.img_original.size):
+            return False
+        calib_meas = next((m for m in previous_session["measurements"] if m.get("type") == "calibration"), None)
+        if not calib_meas or image_series_key(previous_path) != image_series_key(self.file_path):
+            return False
+
+        self.calibration_done = True
+        self.calibration_factor = calibration["factor"]
+        carried = dict(calib_meas)
+        carried["carried_from"] = os.path.basename(previous_path)
+        self.measurements = [carried]
+        self._journal_snapshot()
+        self.update_tables()
+        self.measurement.set(f"Calibrated (carried from {carried['carried_from']}): {self.calibration_factor:.4f} px/mm")
+        return False # Caller still displays the image
+
+    # --- Tracing ---
+    def toggle_trace(self):
+        """Starts/stops recording trace spans. Stopping keeps the buffer so it can still be dumped."""
+        TRACE.enabled = not TRACE.enabled
+        self.buttons["Record Trace"].config(relief=tk.SUNKEN if TRACE.enabled else tk.RAISED)
+        self.measurement.set(f"Status: Trace recording {'ON' if TRACE.enabled else 'OFF'}")
+
+    def dump_trace(self):
+        """Asks for a file and writes the last TRACE_DUMP_SECONDS of spans in Chrome trace-event format."""
+        if not len(TRACE):
+            messagebox.showinfo("Dump Trace", "No trace spans recorded. Turn on 'Record Trace' (or start with --trace) and reproduce the problem first.", parent=self.root)
+            return
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        filename = filedialog.asksaveasfilename(
+            title="Save Trace As",
+            initialdir=TRACE_DIR,
+            initialfile=f"trace_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json",
+            defaultextension=".json",
+            filetypes=[("Trace JSON", "*.json"), ("All Files", "*.*")],
+            parent=self.root
+        )
+        if filename:
+            self._write_trace(filename)
+
+    def dump_trace_to_default(self):
+        """Writes the trace to TRACE_DIR without a dialog (used by SIGUSR1)."""
+        try:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+        except OSError as e:
+            print(f"Could not create trace folder: {e}")
+            return
+        self._write_trace(os.path.join(TRACE_DIR, f"trace_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"))
+
+    def _write_trace(self, filename):
+        try:
+            count = TRACE.dump(filename, last_s=TRACE_DUMP_SECONDS)
+        except OSError as e:
+            messagebox.showerror("Dump Trace", f"Failed to write trace:\n{e}", parent=self.root)
+            print(traceback.format_exc())
+            return
+        print(f"Trace with {count} spans written to {filename}")
+        self.measurement.set(f"Status: Trace ({count} spans) saved to {os.path.basename(filename)} - open in ui.perfetto.dev")
+
+    # --- Memory Budget ---
+    def _display_nbytes(self):
+        """Tk keeps PhotoImages as 32-bit pixels."""
+        return sum(photo.width() * photo.height() * 4 for photo in (self.photo, self.zoom_box_photo) if photo)
+
+    def _cache_sizes(self):
+        """[(name, bytes)] of the recomputable caches, in eviction order (least often reused first)."""
+        def nbytes(*arrays):
+            return sum(arr.nbytes for arr in arrays if arr is not None)
+        return [("pipeline", self.filter_pipeline.nbytes()),
+                ("gray", nbytes(self.img_gray_np)),
+                ("display", nbytes(self._display_array)),
+                ("edges", nbytes(self.edge_map)),
+                ("snap", nbytes(*(self.edge_snap_index or ())))]
+
+    def _cache_nbytes(self):
+        return sum(size for _, size in self._cache_sizes())
+
+    def _drop_cache(self, name):
+        if name == "pipeline":
+            self.filter_pipeline.clear_cache()
+        elif name == "gray":
+            self.img_gray_np = None
+        elif name == "display":
+            self._display_array = None
+            self._display_array_src = None
+        elif name == "edges":
+            self.edge_map = None
+            self.edge_map_key = None
+        elif name == "snap":
+            self.edge_snap_index = None
+            self.edge_snap_key = None
+
+    def _evict_caches(self, bytes_to_free):
+        """Drops recomputable caches one at a time until bytes_to_free is reached, skipping _pinned_caches."""
+        freed = 0
+        for name, size in self._cache_sizes():
+            if freed >= bytes_to_free:
+                break
+            if size and name not in self._pinned_caches:
+                self._drop_cache(name)
+                freed += size
+        return freed
+
+    def _evict_integrals(self, bytes_to_free):
+        """Drops the ROI statistics tables; the next ROI update rebuilds them in the background."""
+        freed = self.intensity_integrals.nbytes if self.intensity_integrals else 0
+        self.intensity_integrals = None
+        self._roi_stats_key = None
+        return freed
+
+    def _evict_sessions(self, bytes_to_free):
+        """Spills stored per-image sessions to disk (lossless, just slower to go back to)."""
+        before = self.image_sessions.memory_bytes()
+        self.image_sessions.spill(max(0, before - bytes_to_free))
+        return before - self.image_sessions.memory_bytes()
+
+    @staticmethod
+    def _state_nbytes(state):
+        # Point lists and measurement dicts are small next to the image copy; ~200 B each is close enough
+        return image_nbytes(state.get("img_filtered")) + 200 * len(state.get("measurements", []))
+
+    def _history_nbytes(self):
+        return sum(self._state_nbytes(state) for state in self.undo_stack + self.redo_stack)
+
+    def _evict_history(self, bytes_to_free):
+        """Drops the oldest undo steps (keeping MIN_UNDO_STATES), then the farthest redo steps."""
+        freed = 0
+        while freed < bytes_to_free and len(self.undo_stack) > self.MIN_UNDO_STATES:
+            freed += self._state_nbytes(self.undo_stack.pop(0))
+        while freed < bytes_to_free and self.redo_stack:
+            freed += self._state_nbytes(self.redo_stack.pop(0))
+        return freed
+
+    def _enforce_memory_budget(self, pinned=()):
+        """Called from the 2 s poll and after large allocations (image load, snap index), not per click.
+
+        pinned: cache names (see _cache_sizes) that were just built for the caller and must survive.
+        """
+        breakdown = self.memory.breakdown()
+        self._pinned_caches = pinned
+        try:
+            evicted = self.memory.enforce(breakdown)
+        finally:
+            self._pinned_caches = ()
+        if evicted:
+            print("Memory budget exceeded, freed " + ", ".join(f"{name} {freed / 1024**2:.1f} MB" for name, freed in evicted))
+            breakdown = self.memory.breakdown()
+        self._show_memory_usage(breakdown)
+
+    def _show_memory_usage(self, breakdown=None):
+        breakdown = breakdown if breakdown is not None else self.memory.breakdown()
+        total = sum(size for _, size in breakdown)
+        parts = " ".join(f"{name[:5]} {size / 1024**2:.0f}" for name, size in breakdown if size)
+        self.memory_info.set(f"Mem: {total / 1024**2:.0f}/{self.memory.budget_bytes / 1024**2:.0f} MB" + (f" ({parts})" if parts else ""))
+
+    def _update_memory_status(self):
+        """Polls usage for the status bar; also catches growth between enforcement points."""
+        if not self.root.winfo_exists():
+            return
+        self._enforce_memory_budget()
+        self.root.after(2000, self._update_memory_status)
+
+    # --- Stall Watchdog ---
+    def _watchdog_heartbeat(self):
+        if self.watchdog:
+            self.watchdog.beat()
+            self.root.after(StallWatchdog.HEARTBEAT_MS, self._watchdog_heartbeat)
+
+    def _stall_context(self):
+        """State logged with a stall. Runs on the watchdog thread, so only plain attributes are read."""
+        img = self.img_filtered or self.img_original
+        return {
+            "global_canny_active": self.global_canny_active,
+            "canny_selection_mode": self.canny_selection_mode,
+            "edit_points_mode": self.edit_points_mode,
+            "zoom_factor": round(self.zoom_factor, 3),
+            "image_size": img.size if img is not None else None,
+            "measurements": len(self.measurements),
+            "undo_depth": len(self.undo_stack),
+            "image": os.path.basename(self.file_path) if self.file_path else None,
+        }
+
+    def on_close(self):
+        """Closes the journal cleanly before the window is destroyed."""
+        if self.watchdog:
+            self.watchdog.stop()
+            self.watchdog = None
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        self.image_sessions.close()
+        self.root.destroy()
+
+    def open_analysis(self):
+        """Loads a saved analysis JSON and restores its image, calibration and measurements."""
+        analysis_path = filedialog.askopenfilename(
+            title="Open Analysis",
+            filetypes=[("JSON Files", "*.json"), ("All Files", "*.*")],
+            parent=self.root
+        )
+        if not analysis_path:
+            return
+        try:
+            data = load_analysis_file(analysis_path)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Open Analysis", f"Could not load analysis:\n{e}", parent=self.root)
+            return
+
+        metadata = data["metadata"]
+        image_path = resolve_source_image(analysis_path, metadata)
+        if not image_path:
+            image_name = metadata.get("source_image_name") or metadata.get("source_image_path")
+            messagebox.showwarning("Open Analysis", f"Source image not found:\n{image_name}\n\nPlease locate it.", parent=self.root)
+            image_path = filedialog.askopenfilename(
+                title=f"Locate {image_name}",
+                initialdir=os.path.dirname(os.path.abspath(analysis_path)),
+                filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.gif;*.tif;*.tiff"), ("All Files", "*.*")],
+                parent=self.root
+            )
+            if not image_path:
+                return
+        if not self.open_image_path(image_path):
+            return
+
+        calibration = data["calibration"]
+        self.name_var.set(metadata.get("analysis_name") or "")
+        diameter = metadata.get("expected_real_diameter_mm")
+        self.diameter_var.set("" if diameter is None else str(diameter))
+        self._restore_measurements(data["measurements"], {
+            "done": bool(calibration.get("calibrated")),
+            "factor": calibration.get("pixels_per_mm"),
+            "dots": calibration.get("calibration_points") or [],
+        })
+        filters = data.get("filters")
+        if filters and all(k in filters for k in ("canny_low", "canny_high", "global_canny", "canny_roi")):
+            self._apply_filter_settings(filters)
+            self.apply_filters_and_display()
+        self._journal_record("saved", path=analysis_path, image=image_path) # Already on disk, nothing unsaved
+        self.measurement.set(f"Status: Loaded {len(self.measurements)} measurement(s) from {os.path.basename(analysis_path)}.")
+
+    @traced("update_tables", "table")
     def update_tables(self):
         """Updates the measurement summary table more robustly."""
+        self._refresh_line_profile()
         if not hasattr(self, 'measurement_table') or not self.measurement_table or not self.measurement_table.winfo_exists():
             return
 
@@ -2390,6 +4414,8 @@ class ImageAnalyzer:
                          mm_dist_str = f"{mm_dist_recalc:.3f}"
                     elif self.calibration_done: mm_dist_str = "Error"
                     else: mm_dist_str = "Uncalib."
+                    if str(meas.get('method', '')).startswith("auto"):
+                        m_type_display = "Artery (Auto)"
 
                 elif m_type_orig == "angle":
                     angle = meas.get('angle_deg')
@@ -2439,29 +4465,37 @@ class ImageAnalyzer:
                 except tk.TclError: pass
 
 
+_MODULE_LOADED = time.perf_counter()
+
 # Main execution
 if __name__ == "__main__":
+    cli_args = build_arg_parser().parse_args()
+    STARTUP_PROFILE.enabled = cli_args.profile_startup
+    STARTUP_PROFILE.origin = _PROCESS_START
+    STARTUP_PROFILE.record("module imports", _PROCESS_START, _MODULE_LOADED)
+    TRACE.enabled = cli_args.trace
+    if cli_args.batch:
+        sys.exit(run_batch(cli_args))
+    if cli_args.export_annotated:
+        sys.exit(run_export_batch(cli_args))
+
     root = None # Initialize root to None
     try:
-        # Create the main window first
-        root = tk.Tk()
-        # Optional: Set a theme for a more modern look (requires ttkthemes)
-        try:
-             from ttkthemes import ThemedTk
-             # Ensure root is destroyed before creating ThemedTk if necessary
-             if root: root.destroy()
-             root = ThemedTk(theme="arc") # Example theme: arc, plastique, clearlooks etc.
-        except ImportError:
-             print("ttkthemes not found, using default Tk theme.")
-             if not root or not root.winfo_exists(): root = tk.Tk()
-             pass
-        except tk.TclError as theme_error:
-             print(f"Error setting ttk theme: {theme_error}. Using default Tk theme.")
-             if not root or not root.winfo_exists(): root = tk.Tk()
-             pass
+        # Create the main window once: themed if ttkthemes is available, plain Tk otherwise
+        with STARTUP_PROFILE.phase("create root window"):
+            try:
+                 from ttkthemes import ThemedTk
+                 root = ThemedTk(theme="arc") # Example theme: arc, plastique, clearlooks etc.
+            except ImportError:
+                 print("ttkthemes not found, using default Tk theme.")
+            except tk.TclError as theme_error:
+                 print(f"Error setting ttk theme: {theme_error}. Using default Tk theme.")
+            if root is None:
+                 root = tk.Tk()
 
         # Now initialize the application with the root window
-        app = ImageAnalyzer(root)
+        with STARTUP_PROFILE.phase("ImageAnalyzer.__init__"):
+            app = ImageAnalyzer(root, memory_budget_mb=cli_args.memory_budget)
         root.mainloop()
 
     except Exception as e:
@@ -0,0 +1,375 @@
+# -----------------------------------------------------------------------------
+# Image Analyzer - hot path benchmarks
+#
+# Runs offline on synthetic images and writes machine-readable results, so a
+# change can be compared against a stored baseline:
+#
+#   python benchmarks/bench_hotpaths.py --out bench.json --save-baseline benchmarks/baseline.json
+#   python benchmarks/bench_hotpaths.py --baseline benchmarks/baseline.json --fail-on-regression
+#
+# Benchmarks that need Tk (PhotoImage, canvas, Treeview) start a virtual X
+# server (Xvfb) when no display is available, and are skipped if neither works.
+# -----------------------------------------------------------------------------
+import argparse
+import atexit
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import cv2
+from PIL import Image
+
+import AnalysisCore as core
+
+DEFAULT_SIZES_MP = [1, 4, 16]
+FULL_SIZES_MP = [1, 4, 16, 100]
+MODES = ["gray", "rgb", "gray16"]
+CANNY_SWEEP = [(30, 90), (50, 150), (100, 200), (150, 300)]
+VIEWPORT = (1600, 1000) # Typical visible canvas area in screen pixels
+
+
+# --- Synthetic Images ---
+def make_image(megapixels, mode, seed=0):
+    """Deterministic test image: smooth background, vessel-like dark bands and noise."""
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    rng = np.random.default_rng(seed)
+    xs = (np.arange(width, dtype=np.uint16) * 160 // width).astype(np.uint8)
+    ys = (np.arange(height, dtype=np.uint16) * 60 // height).astype(np.uint8)
+    gray = np.add.outer(ys, xs) # 0..220 gradient
+    for i in range(6): # Horizontal-ish dark bands
+        y0 = height * (i + 1) // 8
+        band = max(4, height // 60)
+        gray[y0:y0 + band] //= 3
+    gray += rng.integers(0, 24, size=gray.shape, dtype=np.uint8)
+
+    if mode == "gray":
+        return Image.fromarray(gray, "L")
+    if mode == "gray16":
+        return Image.fromarray(gray.astype(np.uint16) * 257) # Mode I;16
+    rgb = np.empty((height, width, 3), dtype=np.uint8)
+    rgb[..., 0] = gray
+    rgb[..., 1] = gray // 2 + 40
+    rgb[..., 2] = 255 - gray
+    return Image.fromarray(rgb, "RGB")
+
+
+def make_measurements(count, seed=1):
+    """Mixed artery/angle/line measurements as the GUI stores them."""
+    rng = np.random.default_rng(seed)
+    measurements = []
+    for i in range(count):
+        pts = [tuple(p) for p in rng.random((4, 2)) * 2000]
+        if i % 3 == 0:
+            measurements.append(core.artery_measurement(pts[0], pts[1], 12.5))
+        elif i % 3 == 1:
+            measurements.append({"type": "angle", "points": pts[:3], "angle_deg": core.angle_at_vertex(*pts[:3]) or 0.0})
+        else:
+            pts[2] = (pts[0][0], pts[0][1] + 40)
+            pts[3] = (pts[1][0], pts[1][1] + 45)
+            result, _ = core.line_mode_measurement(pts, 12.5)
+            if result:
+                measurements.append(result)
+    return measurements
+
+
+# --- Timing ---
+class BenchRunner:
+    def __init__(self, repeat, min_time):
+        self.repeat = repeat
+        self.min_time = min_time
+        self.results = {}
+        self.skipped = {}
+
+    def run(self, name, func, setup=None, **params):
+        """Times func (after one warm-up call) and stores min/median/p95 in milliseconds."""
+        key = name + "[" + ",".join(f"{k}={v}" for k, v in params.items()) + "]"
+        try:
+            if setup:
+                setup()
+            func()
+            samples = []
+            started = time.perf_counter()
+            while len(samples) < self.repeat or (time.perf_counter() - started < self.min_time and len(samples) < 100):
+                if setup:
+                    setup()
+                t0 = time.perf_counter()
+                func()
+                samples.append((time.perf_counter() - t0) * 1000)
+        except Exception as e:
+            self.skipped[key] = f"{type(e).__name__}: {e}"
+            print(f"  {key:<58} FAILED {e}")
+            return
+        samples.sort()
+        entry = {
+            "min_ms": round(samples[0], 4),
+            "median_ms": round(statistics.median(samples), 4),
+            "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+            "runs": len(samples),
+            "params": params,
+        }
+        self.results[key] = entry
+        print(f"  {key:<58} median {entry['median_ms']:10.2f} ms   p95 {entry['p95_ms']:10.2f} ms")
+
+    def skip(self, name, reason):
+        self.skipped[name] = reason
+        print(f"  {name:<58} SKIPPED ({reason})")
+
+
+# --- Headless Benchmarks ---
+def bench_image_paths(runner, img, mp, mode):
+    """Decode-side conversion, full and viewport rendering, zoom box and Canny sweeps for one image."""
+    tag = {"mp": mp, "mode": mode}
+    rgba = img.convert("RGBA") # What open_image_path does after decoding
+    runner.run("convert_rgba", lambda: img.convert("RGBA"), **tag)
+    runner.run("to_gray_array", lambda: core.to_gray_array(rgba), **tag)
+
+    # display_image resizes the whole image to the zoom level
+    fit = min(VIEWPORT[0] / rgba.width, VIEWPORT[1] / rgba.height)
+    for zoom in (fit, 1.0):
+        size = (max(1, int(rgba.width * zoom)), max(1, int(rgba.height * zoom)))
+        if size[0] * size[1] > 40e6:
+            runner.skip(f"render_full[zoom={zoom:.2f},mp={mp},mode={mode}]", "output above 40 MP")
+            continue
+        runner.run("render_full", lambda: rgba.resize(size, Image.Resampling.LANCZOS), zoom=round(zoom, 3), **tag)
+    # Only the visible window (what display_image renders), per resampling preset
+    rgba_array = np.asarray(rgba) # The GUI caches this for the cv2 backend
+    for zoom in sorted({round(fit, 3), 1.0, 2.0}):
+        box_w, box_h = min(rgba.width, VIEWPORT[0] / zoom), min(rgba.height, VIEWPORT[1] / zoom)
+        box = (rgba.width / 2 - box_w / 2, rgba.height / 2 - box_h / 2, rgba.width / 2 + box_w / 2, rgba.height / 2 + box_h / 2)
+        view = (max(1, int(box_w * zoom)), max(1, int(box_h * zoom)))
+        for preset, (backend, _, _) in core.RESAMPLING_PRESETS.items():
+            source = rgba_array if backend == "cv2" else rgba
+            runner.run("render_viewport", lambda: core.resample_region(source, box, view, preset),
+                       zoom=zoom, preset=preset, **tag)
+
+    # update_zoom_box_content: 45x45 crop scaled to 180x180 with NEAREST, 50 mouse moves
+    def zoom_box_moves():
+        for i in range(50):
+            x = (i * 97) % (rgba.width - 45)
+            y = (i * 53) % (rgba.height - 45)
+            rgba.crop((x, y, x + 45, y + 45)).resize((180, 180), Image.Resampling.NEAREST)
+    runner.run("zoom_box_50_moves", zoom_box_moves, **tag)
+
+    gray = core.to_gray_array(rgba)
+    roi = (rgba.width // 4, rgba.height // 4, rgba.width // 4 + 1000, rgba.height // 4 + 1000)
+    roi = core.clamp_roi(roi, rgba.width, rgba.height)
+    for low, high in CANNY_SWEEP:
+        runner.run("canny_global", lambda: core.canny_edges(gray, low, high), low=low, high=high, **tag)
+        runner.run("canny_roi_1k", lambda: core.canny_edges(gray, low, high, roi), low=low, high=high, **tag)
+    runner.run("canny_global_tiled", lambda: core.canny_edges_tiled(gray, 100, 200), low=100, high=200, **tag)
+    runner.run("intensity_integrals", lambda: core.IntensityIntegrals(gray), **tag)
+    integrals = core.IntensityIntegrals(gray)
+    runner.run("roi_stats_x1000", lambda: [integrals.stats((i, i, rgba.width - i, rgba.height - i)) for i in range(1000)], **tag)
+    sweep_gray, _ = core.sweep_source(gray)
+    sweep_lows, sweep_highs = [20, 40, 60, 80], [80, 120, 160, 200]
+    runner.run("canny_sweep_16", lambda: core.canny_sweep(sweep_gray, sweep_lows, sweep_highs), **tag)
+    edges = core.canny_edges(gray, 100, 200)
+    runner.run("render_canny_result", lambda: core.render_canny_result(rgba, edges), **tag)
+
+    lines_y = np.linspace(rgba.height * 0.1, rgba.height * 0.9, 500)
+    starts = np.stack([np.full(500, rgba.width * 0.5), lines_y - 40], axis=1)
+    ends = np.stack([np.full(500, rgba.width * 0.5), lines_y + 40], axis=1)
+    runner.run("sample_line_profiles_500", lambda: core.sample_line_profiles(gray, starts, ends, 320), **tag)
+    diagonal = ((rgba.width * 0.1, rgba.height * 0.1), (rgba.width * 0.9, rgba.height * 0.9))
+    runner.run("line_profile_width15", lambda: core.line_profile(gray, *diagonal, width=15), **tag)
+
+
+def bench_geometry(runner):
+    line_pts = [(10.0, 10.0), (1900.0, 40.0), (10.0, 210.0), (1900.0, 260.0)]
+    runner.run("line_mode_measurement_x1000", lambda: [core.line_mode_measurement(line_pts, 12.5) for _ in range(1000)])
+    pts = [tuple(p) for p in np.random.default_rng(2).random((2000, 2)) * 1000]
+    runner.run("artery_measurement_x1000", lambda: [core.artery_measurement(pts[i], pts[i + 1], 12.5) for i in range(0, 2000, 2)])
+    grid = core.PointGridIndex()
+    for i, (x, y) in enumerate(pts):
+        grid.insert(i, x, y)
+    runner.run("point_index_nearest_x1000", lambda: [grid.nearest(x, y, 8) for x, y in pts[:1000]])
+
+
+def bench_json(runner, tmp_dir):
+    for count in (1000, 10000):
+        measurements = make_measurements(count)
+        path = os.path.join(tmp_dir, f"analysis_{count}.json")
+
+        def save():
+            data = core.build_analysis_data(os.path.join(tmp_dir, "image.png"), "bench", 3.0, 12.5,
+                                            [(10.0, 10.0), (60.0, 10.0)], measurements)
+            with open(path, "w") as f:
+                json.dump(data, f, indent=4)
+        runner.run("json_save", save, measurements=count)
+        runner.run("json_load", lambda: core.load_analysis_file(path), measurements=count)
+
+
+# --- Tk Benchmarks ---
+def ensure_display():
+    """Starts Xvfb on a free display number if there is no DISPLAY. Returns a reason string on failure."""
+    if os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin"):
+        return None
+    xvfb = shutil.which("Xvfb")
+    if not xvfb:
+        return "no DISPLAY and Xvfb not installed"
+    for number in range(99, 130):
+        if os.path.exists(f"/tmp/.X{number}-lock"):
+            continue
+        proc = subprocess.Popen([xvfb, f":{number}", "-screen", "0", "1920x1080x24", "-nolisten", "tcp"],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        atexit.register(proc.terminate)
+        for _ in range(50):
+            if os.path.exists(f"/tmp/.X11-unix/X{number}"):
+                os.environ["DISPLAY"] = f":{number}"
+                return None
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+        proc.terminate()
+    return "could not start Xvfb"
+
+
+def bench_gui(runner, images, measurement_counts):
+    """Benchmarks through a real (hidden) ImageAnalyzer window: display_image, zoom box, undo, tables."""
+    reason = ensure_display()
+    if reason:
+        runner.skip("gui/*", reason)
+        return
+    import tkinter as tk
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        runner.skip("gui/*", f"Tk unavailable: {e}")
+        return
+    import ImageAnalyzer as gui
+    app = gui.ImageAnalyzer(root)
+    root.update()
+
+    for (mp, mode), img in images.items():
+        tag = {"mp": mp, "mode": mode}
+        app.reset_image_state()
+        app.img_original = img.convert("RGBA")
+        fit = min(VIEWPORT[0] / img.width, VIEWPORT[1] / img.height)
+        app.zoom_factor = fit
+        runner.run("gui/display_image_fit", app.display_image, **tag)
+
+        app.zoom_box_mode = True
+        if not app.zoom_box or not app.zoom_box.winfo_exists():
+            app.zoom_box = tk.Canvas(app.image_frame, width=app.ZOOM_BOX_SIZE, height=app.ZOOM_BOX_SIZE)
+        runner.run("gui/update_zoom_box_content", app.update_zoom_box_content, **tag)
+        app.zoom_box_mode = False
+
+        # Undo snapshots copy the filtered image, which is the expensive part
+        app.img_filtered = core.render_canny_result(app.img_original, core.canny_edges(core.to_gray_array(app.img_original), 100, 200))
+        runner.run("gui/save_state", app.save_state, setup=app.undo_stack.clear, **tag)
+        app.img_filtered = None
+
+    app.img_original = images[min(images)].convert("RGBA")
+    for count in measurement_counts:
+        measurements = make_measurements(count)
+
+        def fill():
+            app.measurements = [dict(m) for m in measurements]
+        runner.run("gui/update_tables", app.update_tables, setup=fill, rows=count)
+    app.on_close()
+
+
+# --- Baseline Comparison ---
+def compare(results, baseline, threshold):
+    """Prints median ratios against the baseline. Returns the keys slower than threshold."""
+    regressions = []
+    print("\n--- Comparison with baseline (median, new / old) ---")
+    for key, entry in results.items():
+        old = baseline.get("results", {}).get(key)
+        if not old or not old.get("median_ms"):
+            continue
+        ratio = entry["median_ms"] / old["median_ms"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  <-- slower"
+            regressions.append(key)
+        elif ratio < 1 / threshold:
+            flag = "  faster"
+        print(f"  {key:<58} {old['median_ms']:10.2f} -> {entry['median_ms']:10.2f} ms  x{ratio:5.2f}{flag}")
+    missing = sorted(set(baseline.get("results", {})) - set(results))
+    if missing:
+        print(f"  ({len(missing)} baseline entries were not run)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for Image Analyzer rendering, filtering and geometry hot paths.")
+    parser.add_argument("--sizes", nargs="+", type=float, help=f"Image sizes in megapixels (default {DEFAULT_SIZES_MP}).")
+    parser.add_argument("--full", action="store_true", help=f"Use sizes {FULL_SIZES_MP} (needs several GB of RAM).")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES, help="Image modes to generate.")
+    parser.add_argument("--repeat", type=int, default=5, help="Minimum timed runs per benchmark.")
+    parser.add_argument("--min-time", type=float, default=0.5, help="Keep repeating fast benchmarks for this many seconds.")
+    parser.add_argument("--no-gui", action="store_true", help="Skip benchmarks that need Tk.")
+    parser.add_argument("--out", default="bench_results.json", help="Results file (JSON).")
+    parser.add_argument("--baseline", help="Baseline results file to compare against.")
+    parser.add_argument("--save-baseline", help="Also write the results to this baseline file.")
+    parser.add_argument("--threshold", type=float, default=1.15, help="Slowdown ratio reported as a regression.")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if any benchmark regressed.")
+    args = parser.parse_args()
+
+    sizes = args.sizes or (FULL_SIZES_MP if args.full else DEFAULT_SIZES_MP)
+    runner = BenchRunner(args.repeat, args.min_time)
+    images = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mp in sizes:
+            for mode in args.modes:
+                print(f"\n{mp} MP {mode}")
+                img = make_image(mp, mode)
+                bench_image_paths(runner, img, mp, mode)
+                images[(mp, mode)] = img if mp <= 16 else None # Big images are not kept for the GUI pass
+        print("\ngeometry / json")
+        bench_geometry(runner)
+        bench_json(runner, tmp_dir)
+        if not args.no_gui:
+            print("\ngui")
+            bench_gui(runner, {k: v for k, v in images.items() if v is not None}, (1000, 5000))
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "opencv_threads": cv2.getNumThreads(),
+            "pillow": Image.__version__,
+            "sizes_mp": sizes,
+            "modes": args.modes,
+        },
+        "results": runner.results,
+        "skipped": runner.skipped,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.out} ({len(runner.results)} benchmarks, {len(runner.skipped)} skipped)")
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(runner.results, baseline, args.threshold)
+        print(f"\n{len(regressions)} regression(s) above x{args.threshold}")
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())